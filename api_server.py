@@ -0,0 +1,374 @@
+# api_server.py
+"""
+轻量级 HTTP 任务服务：通过 HTTP 提交笔记生成任务，并以 SSE (server-sent events) 实时推送进度。
+
+接口:
+    POST /jobs?filename=<文件名>&query=<Notes|Q&A|Quiz>
+         请求体为上传文件的原始字节；处理音视频时需在请求头 X-OpenAI-Api-Key 中提供密钥。
+         成功返回 202 和任务信息；服务器繁忙时返回 429 (带 Retry-After)。
+    GET  /jobs/<id>            查询任务状态
+    GET  /jobs/<id>/events     SSE 事件流 (progress / sub_progress / llm_chunk / done 等)，
+                               支持 Last-Event-ID 断线续传
+    GET  /jobs/<id>/result     下载生成的 Markdown 结果
+    GET  /healthz              健康检查
+    GET  /metrics              Prometheus 文本格式的指标
+
+启动:
+    python api_server.py --port 8000 --max-jobs 4
+"""
+import argparse
+import json
+import os
+import shutil
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, quote, unquote, urlparse
+
+# 上传文件大小上限，与 .streamlit/config.toml 中的 maxUploadSize 保持一致
+MAX_UPLOAD_BYTES = 4096 * 1024 * 1024
+# 已结束任务的保留时间 (秒)，过期后工作目录会被清理
+FINISHED_JOB_TTL = 3600
+# SSE 心跳间隔 (秒)，防止代理因空闲而断开连接
+SSE_HEARTBEAT_INTERVAL = 15
+VALID_QUERIES = ("Notes", "Q&A", "Quiz")
+
+
+class ServerSaturated(Exception):
+    """并发任务数已达上限。"""
+
+
+class Job:
+    """一个笔记生成任务及其事件历史。事件按顺序编号，供 SSE 客户端断线续传。"""
+
+    def __init__(self, job_id: str, filename: str, query: str, work_dir: str):
+        self.id = job_id
+        self.filename = filename
+        self.query = query
+        self.work_dir = work_dir
+        self.status = "queued"
+        self.created_at = time.time()
+        self.finished_at = None
+        self.result_path = None
+        self.error = None
+        self.warnings = []  # 流程自行恢复、未中止任务的错误
+        self.events = []
+        self._cond = threading.Condition()
+
+    def publish(self, event_type: str, value=None, text: str = ""):
+        with self._cond:
+            payload = {"seq": len(self.events), "ts": time.time(), "value": value}
+            if text:
+                payload["text"] = text
+            self.events.append((event_type, payload))
+            self._cond.notify_all()
+
+    def succeed(self, result_path: str):
+        """记录结果并把状态置为 succeeded。在产出 done 事件之前调用，客户端收到 done 后即可下载结果。"""
+        with self._cond:
+            self.result_path = result_path
+            self.status = "succeeded"
+
+    def finish(self, status: str):
+        with self._cond:
+            self.status = status
+            self.finished_at = time.time()
+            self._cond.notify_all()
+
+    def wait_for_events(self, start: int, timeout: float) -> tuple[list, bool]:
+        """阻塞等待编号 >= start 的新事件，返回 (新事件列表, 任务是否已结束)。"""
+        with self._cond:
+            if len(self.events) <= start and self.finished_at is None:
+                self._cond.wait(timeout)
+            return self.events[start:], self.finished_at is not None
+
+    def to_dict(self) -> dict:
+        return {
+            "job_id": self.id,
+            "filename": self.filename,
+            "query": self.query,
+            "status": self.status,
+            "created_at": self.created_at,
+            "finished_at": self.finished_at,
+            "num_events": len(self.events),
+            "error": self.error,
+            "warnings": self.warnings,
+            "events_url": f"/jobs/{self.id}/events",
+            "result_url": f"/jobs/{self.id}/result" if self.result_path else None,
+        }
+
+
+class JobManager:
+    """负责准入控制、在后台线程中运行任务，以及清理过期任务。"""
+
+    def __init__(self, jobs_root: str, dify_api_key: str, max_active_jobs: int = 4):
+        self.jobs_root = jobs_root
+        self.dify_api_key = dify_api_key
+        self.max_active_jobs = max_active_jobs
+        self._jobs = {}
+        self._active = 0
+        self._lock = threading.Lock()
+        os.makedirs(jobs_root, exist_ok=True)
+
+    def get(self, job_id: str) -> Job | None:
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def reserve(self) -> None:
+        """占用一个任务名额；已满时抛出 ServerSaturated。"""
+        self._purge_expired()
+        with self._lock:
+            if self._active >= self.max_active_jobs:
+                raise ServerSaturated()
+            self._active += 1
+
+    def release(self) -> None:
+        with self._lock:
+            self._active -= 1
+
+    def create_job(self, filename: str, query: str) -> Job:
+        job_id = uuid.uuid4().hex
+        work_dir = os.path.join(self.jobs_root, job_id)
+        os.makedirs(work_dir, exist_ok=True)
+        job = Job(job_id, filename, query, work_dir)
+        with self._lock:
+            self._jobs[job_id] = job
+        return job
+
+    def start(self, job: Job, input_path: str, openai_api_key: str) -> None:
+        threading.Thread(target=self._run, args=(job, input_path, openai_api_key), daemon=True).start()
+
+    def _run(self, job: Job, input_path: str, openai_api_key: str) -> None:
+        from main import main_process_generator
+
+        job.status = "running"
+        final_status = "failed"
+        try:
+            generator = main_process_generator(
+                input_path, openai_api_key, self.dify_api_key,
+                os.path.join(job.work_dir, "result"), job.query, work_dir=job.work_dir
+            )
+            for event_type, value, *rest in generator:
+                text = rest[0] if rest else ""
+                if event_type == "done":
+                    job.succeed(value)
+                    job.publish("done", f"/jobs/{job.id}/result", text)
+                    final_status = "succeeded"
+                    continue
+                job.publish(event_type, value, text)
+                if event_type == "persistent_error":
+                    job.error = text
+                    break
+                if event_type == "error":
+                    # 流程产出 error 后可能继续 (例如文字稿文件保存失败)；致命的 error 之后流程自行结束
+                    job.warnings.append(text)
+        except Exception as e:
+            job.error = f"{type(e).__name__}: {e}"
+            job.publish("persistent_error", 0, f"**服务器内部错误**\n\n`{job.error}`")
+        finally:
+            try:
+                os.remove(input_path)
+            except OSError:
+                pass
+            if final_status == "failed" and job.error is None and job.warnings:
+                job.error = job.warnings[-1]
+            job.finish(final_status)
+            self.release()
+
+    def _purge_expired(self) -> None:
+        now = time.time()
+        with self._lock:
+            expired = [j for j in self._jobs.values() if j.finished_at and now - j.finished_at > FINISHED_JOB_TTL]
+            for job in expired:
+                del self._jobs[job.id]
+        for job in expired:
+            shutil.rmtree(job.work_dir, ignore_errors=True)
+
+
+class JobRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    manager: JobManager = None  # 由 make_server 注入
+
+    def log_message(self, format, *args):
+        pass
+
+    # --- 工具方法 ---
+    def _send_json(self, status: int, payload: dict, headers: dict | None = None):
+        body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _route(self):
+        parsed = urlparse(self.path)
+        parts = [p for p in parsed.path.split("/") if p]
+        return parts, parse_qs(parsed.query)
+
+    # --- 路由 ---
+    def do_POST(self):
+        parts, params = self._route()
+        if parts != ["jobs"]:
+            self._send_json(404, {"error": "not found"})
+            return
+        self._handle_submit(params)
+
+    def do_GET(self):
+        parts, _ = self._route()
+        if parts == ["healthz"]:
+            self._send_json(200, {"status": "ok"})
+            return
+        if parts == ["metrics"]:
+            self._handle_metrics()
+            return
+        if len(parts) < 2 or parts[0] != "jobs":
+            self._send_json(404, {"error": "not found"})
+            return
+
+        job = self.manager.get(parts[1])
+        if job is None:
+            self._send_json(404, {"error": "任务不存在或已过期"})
+        elif len(parts) == 2:
+            self._send_json(200, job.to_dict())
+        elif parts[2:] == ["events"]:
+            self._handle_events(job)
+        elif parts[2:] == ["result"]:
+            self._handle_result(job)
+        else:
+            self._send_json(404, {"error": "not found"})
+
+    # --- 处理函数 ---
+    def _handle_submit(self, params: dict):
+        filename = os.path.basename(unquote(params.get("filename", [""])[0]))
+        query = params.get("query", ["Notes"])[0]
+        length = int(self.headers.get("Content-Length") or 0)
+
+        error = None
+        if not filename:
+            error = "缺少 filename 参数"
+        elif query not in VALID_QUERIES:
+            error = f"query 必须是 {', '.join(VALID_QUERIES)} 之一"
+        elif length <= 0:
+            error = "请求体为空，请上传文件内容"
+        elif length > MAX_UPLOAD_BYTES:
+            error = "上传文件过大"
+        if error:
+            self.close_connection = True
+            self._send_json(400, {"error": error})
+            return
+
+        try:
+            self.manager.reserve()
+        except ServerSaturated:
+            # 不读取请求体直接拒绝，连接随后关闭
+            self.close_connection = True
+            self._send_json(429, {"error": "服务器繁忙，请稍后重试"}, {"Retry-After": "5"})
+            return
+
+        try:
+            job = self.manager.create_job(filename, query)
+            input_path = os.path.join(job.work_dir, filename)
+            with open(input_path, "wb") as f:
+                remaining = length
+                while remaining > 0:
+                    block = self.rfile.read(min(remaining, 1024 * 1024))
+                    if not block:
+                        raise IOError("上传在完成前中断")
+                    f.write(block)
+                    remaining -= len(block)
+        except Exception as e:
+            self.manager.release()
+            self.close_connection = True
+            self._send_json(400, {"error": f"接收上传文件失败: {e}"})
+            return
+
+        self.manager.start(job, input_path, self.headers.get("X-OpenAI-Api-Key", ""))
+        self._send_json(202, job.to_dict(), {"Location": f"/jobs/{job.id}"})
+
+    def _handle_events(self, job: Job):
+        try:
+            next_seq = int(self.headers.get("Last-Event-ID", -1)) + 1
+        except ValueError:
+            next_seq = 0
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream; charset=utf-8")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+
+        try:
+            while True:
+                events, finished = job.wait_for_events(next_seq, SSE_HEARTBEAT_INTERVAL)
+                if not events and not finished:
+                    self.wfile.write(b": keep-alive\n\n")
+                for event_type, payload in events:
+                    message = f"id: {payload['seq']}\nevent: {event_type}\ndata: {json.dumps(payload, ensure_ascii=False)}\n\n"
+                    self.wfile.write(message.encode("utf-8"))
+                self.wfile.flush()
+                next_seq += len(events)
+                if finished and next_seq >= len(job.events):
+                    return
+        except (BrokenPipeError, ConnectionResetError):
+            # 客户端断开，任务本身继续运行，可通过 Last-Event-ID 重新订阅
+            return
+
+    def _handle_metrics(self):
+        from metrics import REGISTRY
+        body = REGISTRY.render_prometheus().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _handle_result(self, job: Job):
+        if job.status != "succeeded" or not job.result_path or not os.path.exists(job.result_path):
+            self._send_json(409, {"error": f"结果尚不可用 (任务状态: {job.status})"})
+            return
+        with open(job.result_path, "rb") as f:
+            body = f.read()
+        download_name = os.path.splitext(job.filename)[0] + ".md"
+        self.send_response(200)
+        self.send_header("Content-Type", "text/markdown; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Content-Disposition", f"attachment; filename*=UTF-8''{quote(download_name, safe='')}")
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def make_server(host: str, port: int, manager: JobManager) -> ThreadingHTTPServer:
+    handler = type("ConfiguredJobRequestHandler", (JobRequestHandler,), {"manager": manager})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="笔记生成 HTTP 任务服务 (SSE 进度推送)。")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--max-jobs", type=int, default=4, help="同时运行的任务上限，超出时返回 429")
+    parser.add_argument("--jobs-dir", default="api_jobs", help="任务工作目录的根目录")
+    args = parser.parse_args()
+
+    from config import get_dify_api_key
+    # 服务的每个任务都需要 Dify 密钥，缺失时在启动时就报错，而不是接受任务后再失败
+    manager = JobManager(args.jobs_dir, get_dify_api_key(), args.max_jobs)
+    server = make_server(args.host, args.port, manager)
+    print(f"任务服务已启动: http://{args.host}:{server.server_address[1]} (最多 {args.max_jobs} 个并发任务)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
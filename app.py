@@ -1,13 +1,15 @@
 # app.py
 import streamlit as st
 import os
-from main import main_process_generator
-from config import DIFY_API_KEY 
+import uuid
+# main (及 openai、requests 等依赖) 在第一次点击“开始生成”时才导入，页面冷启动不必等待它们加载
+from config import get_dify_api_key
+import speculative
 
 st.set_page_config(page_title="智能笔记 Agent", layout="wide")
 st.title("👨‍💻 智能内容生成 Agent")
 st.markdown("上传您的视频、音频或文本文档，即可自动生成结构化笔记、Q&A 或测验。")
-st.info("💡 **提示**: 仅在处理视频或音频文件时需要提供 OpenAI API Key 用于语音转文字。处理文本文档则无需填写。")
+st.info("💡 **提示**: 仅在使用 OpenAI Whisper 处理视频或音频文件时需要提供 OpenAI API Key 用于语音转文字。处理文本文档或使用本地模型转录则无需填写。")
 
 with st.sidebar:
     st.header("⚙️ 参数配置")
@@ -19,11 +21,22 @@ with st.sidebar:
     )
     output_filename = st.text_input("请输入希望的笔记文件名 (无需后缀)", value="我的学习笔记")
 
-    query_option = st.selectbox(
-        "请选择生成内容类型:",
-        ("Notes", "Q&A", "Quiz"),
-        index=0,
-        help="选择 'Notes' 生成结构化笔记, 'Q&A' 生成问答对, 'Quiz' 生成测验题。"
+    transcription_labels = {
+        "openai": "OpenAI Whisper (云端)",
+        "local": "本地模型 (faster-whisper，需配置 LOCAL_WHISPER_MODEL)",
+    }
+    transcription_backend = st.selectbox(
+        "音视频转录方式:",
+        list(transcription_labels),
+        format_func=transcription_labels.get,
+        help="本地模型在本机 CPU 上转录，不需要 OpenAI API Key，也不产生按分钟计费。"
+    )
+
+    query_options = st.multiselect(
+        "请选择生成内容类型 (可多选):",
+        ["Notes", "Q&A", "Quiz"],
+        default=["Notes"],
+        help="选择 'Notes' 生成结构化笔记, 'Q&A' 生成问答对, 'Quiz' 生成测验题。多选时只转录一次，各类内容同时生成。"
     )
 
     st.markdown("---")
@@ -55,14 +68,47 @@ uploaded_file = st.file_uploader(
     type=all_exts
 )
 
+# 文件一上传就在后台开始落盘、探测与转录 (见 speculative.py)，点击“开始生成”时通常只剩内容生成。
+# 同一份上传只计算一次内容哈希；换了文件、删除了上传或换了转录方式时放弃旧的预处理
+speculative_store = speculative.get_store()
+# 缓存在所有会话之间共享，按会话计引用：一个会话放弃某个文件不会删掉其他会话正在用的预处理
+session_id = st.session_state.setdefault("speculative_session", uuid.uuid4().hex)
+speculative_entry = None
+if uploaded_file is not None:
+    upload_id = getattr(uploaded_file, "file_id", None) or f"{uploaded_file.name}:{uploaded_file.size}"
+    if st.session_state.get("upload_id") != upload_id:
+        st.session_state["upload_id"] = upload_id
+        st.session_state["upload_digest"] = speculative.content_hash(uploaded_file.getbuffer())
+    speculative_entry = speculative_store.ensure(st.session_state["upload_digest"], uploaded_file.getbuffer(),
+                                                 uploaded_file.name, openai_api_key, transcription_backend,
+                                                 session=session_id)
+    st.caption(speculative_entry.describe())
+
+previous_key = st.session_state.get("speculative_key")
+current_key = speculative_entry.key if speculative_entry else None
+if previous_key and previous_key != current_key:
+    speculative_store.abandon(previous_key, session_id)
+st.session_state["speculative_key"] = current_key
+
 if uploaded_file is not None:
     if st.button("开始生成", use_container_width=True, type="primary"):
         
         file_ext = os.path.splitext(uploaded_file.name)[1].lower().replace('.', '')
         is_media_file = file_ext in video_exts or file_ext in audio_exts
 
-        if is_media_file and not openai_api_key:
+        # Dify 密钥在任务开始时才读取和校验，缺失时只影响本次任务，不会让整个页面无法加载
+        config_error = None
+        try:
+            dify_api_key = get_dify_api_key()
+        except ValueError as e:
+            dify_api_key, config_error = None, str(e)
+
+        if config_error:
+            st.error(f"❌ {config_error}")
+        elif is_media_file and transcription_backend == "openai" and not openai_api_key:
             st.error("❌ 处理视频或音频文件需要 OpenAI API Key，请在左侧边栏输入。")
+        elif not query_options:
+            st.error("❌ 请在左侧边栏至少选择一种生成内容类型。")
         else:
             st.markdown("---")
             st.subheader("处理进度")
@@ -79,87 +125,104 @@ if uploaded_file is not None:
                 "Q&A": "正在进行 Q&A (实时输出中...)",
                 "Quiz": "正在生成测验 (实时输出中...)"
             }
-            st.subheader(processing_headers.get(query_option, "正在处理..."))
-            st.info(f"当前生成模式: **{query_option}**")
-            
-            classification_display = st.empty()
-            llm_output_container = st.empty()
-            full_llm_response = ""
+            if len(query_options) == 1:
+                st.subheader(processing_headers.get(query_options[0], "正在处理..."))
+            else:
+                st.subheader("正在同时生成多项内容 (实时输出中...)")
+            st.info(f"当前生成模式: **{' / '.join(query_options)}**")
+
+            # 每种生成类型一个标签页，各自显示分类结果、实时输出和下载按钮
+            tabs = dict(zip(query_options, st.tabs(query_options)))
+            classification_displays = {q: tabs[q].empty() for q in query_options}
+            llm_output_containers = {q: tabs[q].empty() for q in query_options}
+            full_llm_responses = {q: "" for q in query_options}
             
-            final_result_path = None
+            final_result_paths = {}
             processing_has_failed = False
 
-            temp_dir = "temp_uploads"
-            if not os.path.exists(temp_dir):
-                os.makedirs(temp_dir)
-            temp_file_path = os.path.join(temp_dir, uploaded_file.name)
-            with open(temp_file_path, "wb") as f:
-                f.write(uploaded_file.getbuffer())
-
-            generator = main_process_generator(temp_file_path, openai_api_key, DIFY_API_KEY, output_filename, query_option)
-            for event_type, value, *rest in generator:
-                text = rest[0] if rest else ""
-
-                if event_type == "progress":
-                    main_progress_bar.progress(float(value))
-                    main_progress_text.info(text)
-                elif event_type == "sub_progress":
-                    sub_progress_bar.progress(float(value))
-                    sub_progress_text.text(text)
+            query_arg = query_options[0] if len(query_options) == 1 else query_options
+            # 上传后已开始的预处理还在进行时先等待它完成；已有文字稿时只运行内容生成
+            speculative_store.claim(speculative_entry)
+            generator = speculative.process_generator(speculative_entry, openai_api_key, dify_api_key, output_filename,
+                                                      query_arg)
+            try:
+                for event_type, value, *rest in generator:
+                    text = rest[0] if rest else ""
+                    # llm_chunk / display_classification / query_* 事件的第三个元素是所属的生成类型
+                    query_of_event = rest[0] if rest and rest[0] in tabs else query_options[0]
+
+                    if event_type == "progress":
+                        main_progress_bar.progress(float(value))
+                        main_progress_text.info(text)
+                    elif event_type == "sub_progress":
+                        sub_progress_bar.progress(float(value))
+                        sub_progress_text.text(text)
                 
-                elif event_type == "display_classification":
-                    classification_display.success(f"✅ **笔记分类**: {value}")
+                    elif event_type == "display_classification":
+                        classification_displays[query_of_event].success(f"✅ **笔记分类**: {value}")
+
+                    elif event_type == "llm_chunk":
+                        full_llm_responses[query_of_event] += value
+                        llm_output_containers[query_of_event].markdown(full_llm_responses[query_of_event] + " ▌")
+
+                    elif event_type == "query_done":
+                        llm_output_containers[query_of_event].markdown(full_llm_responses[query_of_event])
 
-                elif event_type == "llm_chunk":
-                    full_llm_response += value
-                    llm_output_container.markdown(full_llm_response + " ▌")
+                    elif event_type == "query_error":
+                        llm_output_containers[query_of_event].error(f"**错误详情:**\n\n{value}")
                 
-                elif event_type == "persistent_error":
-                    st.error(f"处理失败: {text}")
-                    main_progress_text.error("一个关键步骤在多次重试后仍然失败，已停止处理。")
-                    llm_output_container.error(f"**错误详情:**\n\n{text}")
-                    if st.button("🔄 重新开始"):
-                        st.experimental_rerun()
-                    processing_has_failed = True
-                    break
+                    elif event_type == "persistent_error":
+                        st.error(f"处理失败: {text}")
+                        main_progress_text.error("一个关键步骤在多次重试后仍然失败，已停止处理。")
+                        for container in llm_output_containers.values():
+                            container.error(f"**错误详情:**\n\n{text}")
+                        if st.button("🔄 重新开始"):
+                            st.experimental_rerun()
+                        processing_has_failed = True
+                        break
                 
-                elif event_type == "error":
-                    st.error(text)
-                    llm_output_container.error(text)
-                    processing_has_failed = True
-                    break
-
-                elif event_type == "done":
-                    main_progress_bar.progress(1.0)
-                    sub_progress_bar.empty()
-                    sub_progress_text.empty()
-                    llm_output_container.markdown(full_llm_response)
-                    st.success(text)
-                    final_result_path = value
+                    elif event_type == "error":
+                        st.error(text)
+                        for container in llm_output_containers.values():
+                            container.error(text)
+                        processing_has_failed = True
+                        break
+
+                    elif event_type == "done":
+                        main_progress_bar.progress(1.0)
+                        sub_progress_bar.empty()
+                        sub_progress_text.empty()
+                        st.success(text)
+                        # 单个生成类型时 value 为保存路径，多个时为 {生成类型: 保存路径}
+                        final_result_paths = value if isinstance(value, dict) else {query_options[0]: value}
+                        for q in final_result_paths:
+                            llm_output_containers[q].markdown(full_llm_responses[q])
+            finally:
+                generator.close()
+                speculative_store.release(speculative_entry, keep_files=keep_temp_files)
             
-            if final_result_path and os.path.exists(final_result_path) and not processing_has_failed:
-                st.download_button(
-                    label=f"下载结果 ({os.path.basename(final_result_path)})",
-                    data=full_llm_response,
-                    file_name=os.path.basename(final_result_path),
-                    mime="text/markdown",
-                    use_container_width=True
-                )
+            if not processing_has_failed:
+                for q, final_result_path in final_result_paths.items():
+                    if not os.path.exists(final_result_path):
+                        continue
+                    tabs[q].download_button(
+                        label=f"下载结果 ({os.path.basename(final_result_path)})",
+                        data=full_llm_responses[q],
+                        file_name=os.path.basename(final_result_path),
+                        mime="text/markdown",
+                        use_container_width=True,
+                        key=f"download_{q}"
+                    )
             
             if not keep_temp_files:
-                # 1. 清理上传的临时文件
-                try:
-                    if os.path.exists(temp_file_path):
-                        os.remove(temp_file_path)
-                except OSError as e:
-                    st.warning(f"无法自动删除临时上传文件 '{temp_file_path}': {e}")
-
-                # 2. 清理生成的文字稿文件
-                transcript_path = "source_transcript.txt"
-                try:
-                    if os.path.exists(transcript_path):
-                        os.remove(transcript_path)
-                except OSError as e:
-                    st.warning(f"无法自动删除文字稿文件 '{transcript_path}': {e}")
+                # 上传的文件与后台转录的中间文件留在预处理缓存中，供同一文件再次生成时复用，
+                # 换文件、删除上传或长时间未使用后自动删除 (见 speculative.py)。
+                # 这里清理生成的文字稿文件 (dify_input.txt 为文件传输模式下待上传的文字稿)
+                for transcript_path in ("source_transcript.txt", "dify_input.txt"):
+                    try:
+                        if os.path.exists(transcript_path):
+                            os.remove(transcript_path)
+                    except OSError as e:
+                        st.warning(f"无法自动删除文字稿文件 '{transcript_path}': {e}")
             else:
                 st.info("已根据您的设置，保留了中间文件。")
\ No newline at end of file
@@ -0,0 +1,360 @@
+# async_pipeline.py
+"""
+处理流程的 asyncio 版本，产出的事件与 main.main_process_generator 完全相同。
+
+- ffmpeg / ffprobe 作为 asyncio 子进程运行 (splitter.split_media_to_audio_chunks_async)
+- 转录通过后端的 transcribe_async 完成 (video_processor.backends)：Whisper 使用 AsyncOpenAI，
+  本地模型的推理队列返回 future，等待时都不占用线程
+- Dify 使用 httpx.AsyncClient，同一事件循环上的任务共用客户端 (连接池)
+- 重试等待使用 asyncio.sleep (utils.retry_async)；Whisper 请求仍经过共享调度器，排队时不占用线程
+- 文件读写、文字稿压缩等短暂的阻塞操作放到 asyncio.to_thread 中执行
+
+等待网络和子进程时不占用线程，单个事件循环即可同时运行大量任务。
+asyncio 程序中直接使用 main_process_async；同步代码通过 main_process_generator(engine="async") 使用，
+它在进程内共享的后台事件循环中运行本流程 (见 iter_async)。
+"""
+import asyncio
+import os
+import queue
+import shutil
+import threading
+from contextlib import aclosing
+
+from video_processor.splitter import split_media_to_audio_chunks_async
+from video_processor.scheduler import get_scheduler
+from video_processor.backends import backend_name, get_backend
+from dify_api import get_async_client as get_dify_client, run_workflow_streaming_async, upload_file_async
+from metrics import REGISTRY, write_summary_log
+from main import (
+    AUDIO_EXTS, CHUNK_DURATION, DEFAULT_MAX_PARALLEL_QUERIES, INCOMPLETE_TRANSCRIPT_MESSAGE, TEXT_EXTS, VIDEO_EXTS,
+    _backend_error_message, _chunk_seconds, _DifyResultHandler, _done_event, _no_chunks_message, _no_result_message,
+    _prepare_job, _prepare_llm_input, _read_error_message, _read_text_input, _split_error_message, _tag_query_event,
+    _transcription_error_message, _unsupported_type_message, _upload_error_message,
+)
+
+# 单个任务同时在途的 Whisper 请求数上限 (与线程引擎的线程池大小一致)
+TRANSCRIBE_CONCURRENCY = 10
+
+_background_loop = None
+_background_loop_lock = threading.Lock()
+
+
+async def main_process_async(input_path: str, openai_api_key: str, dify_api_key: str, output_filename: str, query, work_dir: str | None = None, metrics_log: str | None = None, time_budget: float | None = None, max_parallel_queries: int = DEFAULT_MAX_PARALLEL_QUERIES, compaction: bool | None = None, transfer_mode: str | None = None, transcription_backend=None, transcript: str | None = None):
+    """main_process_generator 的异步生成器版本：参数 (engine 除外)、产出的事件和任务摘要完全相同。"""
+    backend_name(transcription_backend)
+    queries, compaction, transfer_mode, deadline, metrics = _prepare_job(input_path, query, time_budget, compaction, transfer_mode)
+    pipeline = run_pipeline_async(input_path, openai_api_key, dify_api_key, output_filename, queries, isinstance(query, str),
+                                  max_parallel_queries, compaction, transfer_mode, work_dir, metrics, deadline,
+                                  transcription_backend, transcript)
+    REGISTRY.job_started()
+    status = "failed"
+    try:
+        async for event in pipeline:
+            if event[0] == "done":
+                status = "succeeded"
+            yield event
+    finally:
+        # 调用方提前关闭 (或任务被取消) 时同样会记录摘要
+        await pipeline.aclose()
+        summary = metrics.summary(status)
+        REGISTRY.observe_job(summary)
+        write_summary_log(summary, metrics_log)
+    yield "job_summary", summary
+
+
+def get_background_loop() -> asyncio.AbstractEventLoop:
+    """返回在后台守护线程中运行的事件循环 (进程内共享，首次调用时创建)。"""
+    global _background_loop
+    with _background_loop_lock:
+        if _background_loop is None:
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, name="async-pipeline", daemon=True).start()
+            _background_loop = loop
+        return _background_loop
+
+
+def iter_async(async_iterator):
+    """
+    在后台事件循环中消费异步生成器，把事件依次交给调用线程 (同步生成器)。
+    调用方提前关闭本生成器时取消后台任务，异步生成器的 finally 块照常执行。
+    """
+    events = queue.Queue()
+    finished = object()
+
+    async def pump():
+        error = None
+        try:
+            async with aclosing(async_iterator):
+                async for event in async_iterator:
+                    events.put(event)
+        except Exception as e:
+            error = e
+        finally:
+            events.put((finished, error))
+
+    future = asyncio.run_coroutine_threadsafe(pump(), get_background_loop())
+    try:
+        while True:
+            event = events.get()
+            if event[0] is finished:
+                if event[1] is not None:
+                    raise event[1]
+                return
+            yield event
+    finally:
+        future.cancel()
+
+
+async def _fan_out_async(sources: dict, max_parallel: int):
+    """_fan_out 的异步版本：最多 max_parallel 个异步生成器同时运行，按到达顺序产出 (key, event)。"""
+    events = asyncio.Queue()
+    limit = asyncio.Semaphore(max(1, max_parallel))
+    finished = object()
+
+    async def drain(key, generator):
+        try:
+            async with limit, aclosing(generator):
+                async for event in generator:
+                    await events.put((key, event))
+        except Exception as e:
+            await events.put((key, ("persistent_error", 0, f"**内容生成失败**\n\n处理 '{key}' 时发生意外错误。\n\n**原始错误信息:**\n`{e}`")))
+        finally:
+            events.put_nowait((key, finished))
+
+    tasks = [asyncio.ensure_future(drain(key, generator)) for key, generator in sources.items()]
+    try:
+        pending = len(tasks)
+        while pending:
+            key, event = await events.get()
+            if event is finished:
+                pending -= 1
+            else:
+                yield key, event
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+async def _transcribe_media_async(input_path: str, openai_api_key: str, output_dir: str, is_video: bool, metrics,
+                                  deadline, transcription_backend=None):
+    """
+    main._transcribe_media 的异步生成器版本：产出相同的进度事件，成功时最后产出 ('transcript', 完整文字稿)
+    (异步生成器不能返回值)，失败时产出 persistent_error 后结束。
+    """
+    total_steps = 4 if is_video else 3
+    current_progress = 0
+
+    step_name = "视频" if is_video else "音频"
+    yield "progress", current_progress / total_steps, f"步骤 {current_progress + 1}/{total_steps}: 正在切分{step_name}为音频块..."
+
+    audio_chunks = []
+    media_duration = None
+    split_started = metrics.now()
+    splitter = split_media_to_audio_chunks_async(input_path, output_dir, CHUNK_DURATION, metrics=metrics)
+    async with aclosing(splitter):
+        async for event_type, val1, *val2 in splitter:
+            if event_type == 'progress':
+                completed, total = val1, val2[0]
+                yield "sub_progress", completed / total, f"正在切分... ({completed}/{total})"
+            elif event_type == 'duration':
+                media_duration = val1
+            elif event_type == 'result':
+                audio_chunks = val1
+            elif event_type == 'error':
+                yield "persistent_error", 0, _split_error_message(input_path, val1)
+                return
+
+    if not audio_chunks:
+        yield "persistent_error", 0, _no_chunks_message(step_name)
+        return
+
+    metrics.record("split", split_started)
+    yield "sub_progress", 1.0, f"✅ {step_name}切分全部完成！"
+    current_progress += 1
+    yield "progress", current_progress / total_steps, f"✅ {step_name}切分完成，准备开始转录..."
+
+    try:
+        backend = get_backend(transcription_backend, openai_api_key)
+    except (ValueError, ImportError) as e:
+        yield "persistent_error", 0, _backend_error_message(e)
+        return
+    metrics.set("transcription_backend", backend.name)
+
+    yield "progress", current_progress / total_steps, f"步骤 {current_progress + 1}/{total_steps}: 正在并行转录 {len(audio_chunks)} 个音频块..."
+    all_transcripts = [None] * len(audio_chunks)
+    transcribe_started = metrics.now()
+
+    chunk_seconds = _chunk_seconds(media_duration, len(audio_chunks))
+    scheduler = get_scheduler()
+    scheduler.register_job(metrics.job_id, sum(chunk_seconds))
+    limit = asyncio.Semaphore(TRANSCRIBE_CONCURRENCY)
+
+    async def transcribe(index, chunk):
+        async with limit:
+            return index, await backend.transcribe_async(
+                chunk, metrics=metrics, deadline=deadline,
+                job_id=metrics.job_id, audio_seconds=chunk_seconds[index]
+            )
+
+    tasks = [asyncio.ensure_future(transcribe(i, chunk)) for i, chunk in enumerate(audio_chunks)]
+    try:
+        for num_transcribed, next_done in enumerate(asyncio.as_completed(tasks), start=1):
+            index, result = await next_done
+            if result is None:
+                raise Exception(f"转录任务未返回有效文本 (块索引: {index})。")
+            all_transcripts[index] = result
+            yield "sub_progress", num_transcribed / len(audio_chunks), f"正在转录... ({num_transcribed}/{len(audio_chunks)})"
+
+    except Exception as e:
+        yield "persistent_error", 0, _transcription_error_message(e)
+        return
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        # 记录本任务在调度器中的排队深度与等待时间
+        metrics.set("whisper_queue", scheduler.unregister_job(metrics.job_id))
+
+    if any(t is None for t in all_transcripts):
+        yield "persistent_error", 0, INCOMPLETE_TRANSCRIPT_MESSAGE
+        return
+
+    metrics.record("transcribe", transcribe_started)
+    yield "sub_progress", 1.0, "✅ 音频转录全部完成！"
+    current_progress += 1
+    yield "progress", current_progress / total_steps, "所有音频块转录完成！"
+    await asyncio.to_thread(shutil.rmtree, output_dir, ignore_errors=True)
+
+    yield "transcript", "\n\n".join(filter(None, all_transcripts))
+
+
+async def run_pipeline_async(input_path: str, openai_api_key: str, dify_api_key: str, output_filename: str, queries: list[str], single: bool, max_parallel_queries: int, compaction: bool, transfer_mode: str, work_dir: str | None, metrics, deadline, transcription_backend=None, transcript: str | None = None):
+    """main._run_pipeline 的异步生成器版本，参数与产出的事件相同。"""
+    output_dir = os.path.join(work_dir, "output_chunks") if work_dir else "output_chunks"
+    file_ext = os.path.splitext(input_path)[1].lower()
+    current_progress = 0
+    llm_input = ""
+    llm_input_path = None
+    dify_client = get_dify_client()
+
+    async def run_dify_and_yield_results(query, upload_file_id=None):
+        handler = _DifyResultHandler(query, output_filename, single, metrics)
+        dify_generator = run_workflow_streaming_async(
+            llm_input, query, "streamlit_user", dify_api_key, dify_client,
+            metrics=metrics, deadline=deadline, upload_file_id=upload_file_id
+        )
+        async with aclosing(dify_generator):
+            async for event_type, data in dify_generator:
+                event = handler.handle(event_type, data)
+                if event is not None:
+                    yield event
+                if handler.finished:
+                    break
+        for event in await asyncio.to_thread(handler.result_events):
+            yield event
+
+    async def run_all_queries(progress, saved_paths):
+        """为每个 query 运行 Dify 工作流 (多个时并发)，保存路径写入 saved_paths。"""
+        failures = {}
+        dify_started = metrics.now()
+        upload_file_id = None
+        if transfer_mode == "file":
+            try:
+                upload_file_id = await upload_file_async(llm_input_path, "streamlit_user", dify_api_key, dify_client,
+                                                         metrics=metrics, deadline=deadline)
+            except Exception as e:
+                metrics.record("dify", dify_started, ok=False)
+                yield "persistent_error", 0, _upload_error_message(e)
+                return
+        sources = {q: run_dify_and_yield_results(q, upload_file_id) for q in queries}
+        async with aclosing(_fan_out_async(sources, max_parallel_queries)) as fan_out:
+            async for q, event in fan_out:
+                event = _tag_query_event(q, event, single, progress, saved_paths, failures)
+                if event is not None:
+                    yield event
+        metrics.record("dify", dify_started, ok=bool(saved_paths))
+
+        if not saved_paths:
+            yield "persistent_error", 0, _no_result_message(queries, failures)
+
+    # === 文本文件工作流 ===
+    if file_ext in TEXT_EXTS:
+        total_steps = 2
+        yield "progress", 0 / total_steps, "步骤 1/2: 正在读取文本文档..."
+        try:
+            llm_input, llm_input_path = await asyncio.to_thread(_read_text_input, input_path, transfer_mode, metrics)
+        except Exception as e:
+            yield "persistent_error", 0, _read_error_message(input_path, e)
+            return
+
+        current_progress += 1
+        yield "progress", current_progress / total_steps, "步骤 2/2: 正在提交给 Dify 工作流 (流式传输)..."
+
+        saved_paths = {}
+        async with aclosing(run_all_queries(current_progress / total_steps, saved_paths)) as dify_events:
+            async for event in dify_events:
+                yield event
+
+        if saved_paths:
+            current_progress += 1
+            yield "progress", current_progress / total_steps, "处理完成！"
+            yield _done_event(saved_paths, queries, single)
+        return
+
+    # === 视频和音频文件工作流 ===
+    elif file_ext in VIDEO_EXTS or file_ext in AUDIO_EXTS:
+        is_video = file_ext in VIDEO_EXTS
+        total_steps = 4 if is_video else 3
+
+        if transcript is None:
+            full_transcript = None
+            transcriber = _transcribe_media_async(input_path, openai_api_key, output_dir, is_video,
+                                                  metrics, deadline, transcription_backend)
+            async with aclosing(transcriber):
+                async for event in transcriber:
+                    if event[0] == "transcript":
+                        full_transcript = event[1]
+                    else:
+                        yield event
+            if full_transcript is None:
+                return
+        else:
+            # 文字稿已经预先转录好 (例如上传后的预处理，见 speculative.py)，直接进入 Dify 阶段
+            full_transcript = transcript
+            metrics.set("pretranscribed", True)
+            yield "progress", 2 / total_steps, "✅ 已使用预先转录的文字稿，跳过切分与转录。"
+        current_progress = 2
+
+        if is_video:
+            yield "progress", current_progress / total_steps, f"步骤 {current_progress + 1}/{total_steps}: 正在汇总文字稿并保存..."
+
+        # 保存与压缩是 CPU/磁盘操作，放到线程中执行，避免阻塞其他任务
+        events, llm_input, llm_input_path = await asyncio.to_thread(
+            _prepare_llm_input, full_transcript, work_dir, compaction, transfer_mode, metrics, current_progress / total_steps
+        )
+        full_transcript = None
+        for event in events:
+            yield event
+        if llm_input is None:
+            return
+
+        if is_video:
+            current_progress += 1
+            yield "progress", current_progress / total_steps, "文字稿汇总完成。"
+
+        yield "progress", current_progress / total_steps, f"步骤 {current_progress + 1}/{total_steps}: 正在提交给 Dify 工作流 (流式传输)..."
+
+        saved_paths = {}
+        async with aclosing(run_all_queries(current_progress / total_steps, saved_paths)) as dify_events:
+            async for event in dify_events:
+                yield event
+
+        if saved_paths:
+            current_progress += 1
+            yield "progress", current_progress / total_steps, "处理完成！"
+            yield _done_event(saved_paths, queries, single)
+        return
+
+    else:
+        yield "error", 0, _unsupported_type_message(file_ext)
+        return
@@ -0,0 +1,323 @@
+# batch_cli.py
+"""
+无界面的批处理入口：对目录 (或 glob) 中的所有课程文件运行 main_process_generator。
+
+- 使用进程池并发处理多个文件 (--jobs)
+- 所有进程共享一个 Whisper 并发请求上限 (--whisper-concurrency)
+- 进度与每个文件的耗时以 JSONL 追加写入日志 (--log)
+- 输出已存在的文件会被跳过，因此中断后重新运行即可断点续跑
+
+示例:
+    python batch_cli.py lectures/ -o notes/ --jobs 4 --whisper-concurrency 8
+    python batch_cli.py "lectures/**/*.mp4" -o notes/ --query Quiz
+
+配合本地桩服务器测试:
+    python -m bench.stub_servers --port 8765
+    python batch_cli.py samples/ -o out/ --openai-base-url http://127.0.0.1:8765/v1 \\
+        --dify-base-url http://127.0.0.1:8765/v1 --openai-api-key sk-test --dify-api-key app-test
+"""
+import argparse
+import concurrent.futures
+import glob
+import json
+import multiprocessing
+import os
+import queue
+import shutil
+import sys
+import time
+
+from video_processor.backends import BACKENDS, TRANSCRIPTION_BACKEND_ENV
+
+# 与 main.py 中的 VIDEO_EXTS / AUDIO_EXTS / TEXT_EXTS 保持一致。
+# 这里不直接导入 main，避免父进程为了收集文件列表而加载 openai 等重量级依赖。
+SUPPORTED_EXTS = {
+    '.mp4', '.mov', '.mpeg', '.webm',
+    '.mp3', '.m4a', '.wav', '.amr', '.mpga',
+    '.txt', '.md', '.mdx', '.markdown', '.pdf', '.html', '.xlsx', '.xls', '.doc', '.docx',
+    '.csv', '.eml', '.msg', '.pptx', '.ppt', '.xml', '.epub',
+}
+
+# LLM 文本块数量很多，默认不写入进度日志
+QUIET_EVENTS = {"llm_chunk"}
+
+# 工作进程内的全局变量，由 _init_worker 设置
+_event_queue = None
+
+
+def collect_inputs(source: str) -> list[str]:
+    """把目录或 glob 模式展开为按路径排序的受支持文件列表。"""
+    if os.path.isdir(source):
+        candidates = [os.path.join(root, name) for root, _, names in os.walk(source) for name in names]
+    else:
+        candidates = glob.glob(source, recursive=True)
+    files = [p for p in candidates if os.path.isfile(p) and os.path.splitext(p)[1].lower() in SUPPORTED_EXTS]
+    return sorted(files)
+
+
+def plan_outputs(files: list[str], output_dir: str) -> list[dict]:
+    """为每个输入文件确定输出文件与工作目录。同名文件追加序号，保证输出互不覆盖。"""
+    tasks = []
+    used_names = set()
+    for path in files:
+        stem = os.path.splitext(os.path.basename(path))[0]
+        name, n = stem, 1
+        while name in used_names:
+            n += 1
+            name = f"{stem}_{n}"
+        used_names.add(name)
+        tasks.append({
+            "input": path,
+            "name": name,
+            "output": os.path.join(output_dir, f"{name}.md"),
+            "work_dir": os.path.join(output_dir, ".work", name),
+        })
+    return tasks
+
+
+def _init_worker(event_queue, whisper_semaphore):
+    """工作进程初始化：保存事件队列，并为 Whisper 请求安装跨进程并发上限。"""
+    global _event_queue
+    _event_queue = event_queue
+    from video_processor.scheduler import set_request_limiter
+    set_request_limiter(whisper_semaphore)
+
+
+def _emit(record: dict):
+    _event_queue.put(record)
+
+
+def run_single_job(task: dict, openai_api_key: str, dify_api_key: str, query: str, keep_temp: bool, metrics_log: str) -> dict:
+    """(工作进程) 处理单个文件，把事件转发到父进程，返回该文件的结果与耗时。"""
+    from main import main_process_generator
+
+    name = task["name"]
+    work_dir = task["work_dir"]
+    # 上次中断留下的中间文件不可信，直接清掉重来
+    shutil.rmtree(work_dir, ignore_errors=True)
+    os.makedirs(work_dir, exist_ok=True)
+
+    start = time.perf_counter()
+    stage_started = start
+    stages = []
+    result = {"file": task["input"], "name": name, "status": "failed", "output": None, "error": None}
+
+    def elapsed():
+        return round(time.perf_counter() - start, 3)
+
+    _emit({"file": task["input"], "event": "start", "t": 0.0})
+    try:
+        # 结果先写在工作目录里，成功后再移动到最终位置，避免中断时留下半成品被误判为已完成
+        generator = main_process_generator(
+            task["input"], openai_api_key, dify_api_key, os.path.join(work_dir, name), query,
+            work_dir=work_dir, metrics_log=metrics_log
+        )
+        for event_type, value, *rest in generator:
+            text = rest[0] if rest else ""
+            if event_type == "progress":
+                now = time.perf_counter()
+                if stages:
+                    stages[-1]["seconds"] = round(now - stage_started, 3)
+                stages.append({"stage": text, "at": elapsed(), "seconds": None})
+                stage_started = now
+            if event_type not in QUIET_EVENTS:
+                record = {"file": task["input"], "event": event_type, "t": elapsed()}
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    record["value"] = round(value, 4)
+                elif isinstance(value, dict):
+                    record["value"] = value
+                elif value is not None:
+                    record["value"] = str(value)
+                if text:
+                    record["text"] = text
+                _emit(record)
+
+            if event_type in ("persistent_error", "error"):
+                result["error"] = text or str(value)
+            if event_type == "done":
+                os.replace(value, task["output"])
+                result["status"] = "succeeded"
+                result["output"] = task["output"]
+            elif event_type == "job_summary":
+                result["summary"] = value
+    except Exception as e:
+        result["error"] = f"{type(e).__name__}: {e}"
+    finally:
+        if stages and stages[-1]["seconds"] is None:
+            stages[-1]["seconds"] = round(time.perf_counter() - stage_started, 3)
+        if result["status"] == "succeeded" and not keep_temp:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    result["elapsed_seconds"] = elapsed()
+    result["stages"] = stages
+    return result
+
+
+class JsonlLog:
+    """追加写入的 JSONL 日志，每行一个事件并立即落盘。"""
+
+    def __init__(self, path: str):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._f = open(path, "a", encoding="utf-8")
+
+    def write(self, record: dict):
+        record.setdefault("ts", round(time.time(), 3))
+        self._f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self._f.flush()
+
+    def close(self):
+        self._f.close()
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="批量处理课程录像/录音/文档，生成智能笔记。")
+    parser.add_argument("source", help="输入目录，或 glob 模式 (如 'lectures/**/*.mp4'，请加引号)")
+    parser.add_argument("-o", "--output-dir", default="batch_output", help="输出目录 (默认: batch_output)")
+    parser.add_argument("-q", "--query", default="Notes", choices=["Notes", "Q&A", "Quiz"], help="生成内容类型")
+    parser.add_argument("-j", "--jobs", type=int, default=max(1, (os.cpu_count() or 2) // 2), help="同时处理的文件数")
+    parser.add_argument("--whisper-concurrency", type=int, default=10, help="所有任务合计的 Whisper 并发请求上限")
+    parser.add_argument("--whisper-rpm", type=float, default=None,
+                        help="所有任务合计的 Whisper 每分钟请求数上限，平均分给各工作进程 (默认读取 WHISPER_RPM)")
+    parser.add_argument("--log", default=None, help="JSONL 进度日志路径 (默认: <输出目录>/batch_progress.jsonl)")
+    parser.add_argument("--metrics-log", default=None, help="每个任务的指标摘要 JSONL (默认: <输出目录>/metrics.jsonl)")
+    parser.add_argument("--metrics-port", type=int, default=None, help="在该端口提供 Prometheus 文本格式的 /metrics")
+    parser.add_argument("--time-budget", type=float, default=None, help="单个文件的时间预算 (秒)，重试不会超出该预算")
+    parser.add_argument("--force", action="store_true", help="即使输出已存在也重新处理")
+    parser.add_argument("--keep-temp", action="store_true", help="保留每个任务的工作目录 (音频块、文字稿)")
+    parser.add_argument("--openai-api-key", default=os.getenv("OPENAI_API_KEY"), help="默认读取环境变量 OPENAI_API_KEY")
+    parser.add_argument("--dify-api-key", default=None, help="默认读取环境变量或 .env 中的 DIFY_API_KEY")
+    parser.add_argument("--openai-base-url", default=None, help="覆盖 OpenAI API 地址 (例如本地桩服务器)")
+    parser.add_argument("--dify-base-url", default=None, help="覆盖 Dify API 地址 (例如本地桩服务器)")
+    parser.add_argument("--transcription-backend", choices=BACKENDS, default=None,
+                        help="音视频转录后端 (默认读取环境变量 TRANSCRIPTION_BACKEND，未设置时为 openai)")
+    parser.add_argument("--local-model", default=None,
+                        help="本地转录模型目录 (覆盖 LOCAL_WHISPER_MODEL)。每个工作进程各加载一份模型，建议配合 --jobs 1")
+    return parser
+
+
+def main(argv=None) -> int:
+    args = build_parser().parse_args(argv)
+
+    if not args.dify_api_key:
+        # 与 Web 应用和 HTTP 服务一样，通过 config 读取并校验 .env / 环境变量中的密钥
+        from config import get_dify_api_key
+        try:
+            args.dify_api_key = get_dify_api_key()
+        except ValueError as e:
+            print(f"{e} (或通过 --dify-api-key 提供)", file=sys.stderr)
+            return 2
+    if args.jobs < 1 or args.whisper_concurrency < 1:
+        print("错误：--jobs 与 --whisper-concurrency 必须为正整数。", file=sys.stderr)
+        return 2
+
+    # 工作进程会继承这些环境变量 (OpenAI SDK 原生读取 OPENAI_BASE_URL)
+    if args.openai_base_url:
+        os.environ["OPENAI_BASE_URL"] = args.openai_base_url
+    if args.dify_base_url:
+        os.environ["DIFY_API_BASE"] = args.dify_base_url
+    if args.time_budget:
+        os.environ["JOB_TIME_BUDGET"] = str(args.time_budget)
+    if args.transcription_backend:
+        os.environ[TRANSCRIPTION_BACKEND_ENV] = args.transcription_backend
+    if args.local_model:
+        os.environ["LOCAL_WHISPER_MODEL"] = args.local_model
+
+    files = collect_inputs(args.source)
+    if not files:
+        print(f"在 '{args.source}' 中没有找到受支持的文件。", file=sys.stderr)
+        return 1
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    log = JsonlLog(args.log or os.path.join(args.output_dir, "batch_progress.jsonl"))
+    tasks = plan_outputs(files, args.output_dir)
+    metrics_log = args.metrics_log or os.path.join(args.output_dir, "metrics.jsonl")
+    if args.metrics_port:
+        from metrics import start_metrics_server
+        start_metrics_server(args.metrics_port)
+        print(f"指标服务: http://127.0.0.1:{args.metrics_port}/metrics")
+
+    pending = []
+    for task in tasks:
+        if os.path.exists(task["output"]) and not args.force:
+            log.write({"file": task["input"], "event": "skipped", "output": task["output"]})
+        else:
+            pending.append(task)
+
+    print(f"共发现 {len(tasks)} 个文件，跳过 {len(tasks) - len(pending)} 个已完成的，待处理 {len(pending)} 个。")
+    log.write({"event": "batch_started", "total": len(tasks), "pending": len(pending),
+               "jobs": args.jobs, "whisper_concurrency": args.whisper_concurrency})
+
+    batch_start = time.perf_counter()
+    results = []
+    ctx = multiprocessing.get_context()
+    event_queue = ctx.Queue()
+    whisper_semaphore = ctx.BoundedSemaphore(args.whisper_concurrency)
+    if args.whisper_rpm:
+        # 每个工作进程各有一个调度器，按进程数平分总配额
+        os.environ["WHISPER_RPM"] = str(args.whisper_rpm / args.jobs)
+
+    def drain_events(timeout: float = 0.0):
+        try:
+            while True:
+                log.write(event_queue.get(timeout=timeout))
+                timeout = 0.0
+        except queue.Empty:
+            pass
+
+    executor = concurrent.futures.ProcessPoolExecutor(
+        max_workers=args.jobs,
+        mp_context=ctx,
+        initializer=_init_worker,
+        initargs=(event_queue, whisper_semaphore),
+    )
+    interrupted = False
+    try:
+        futures = {
+            executor.submit(run_single_job, task, args.openai_api_key, args.dify_api_key, args.query,
+                            args.keep_temp, metrics_log): task
+            for task in pending
+        }
+        not_done = set(futures)
+        while not_done:
+            done, not_done = concurrent.futures.wait(not_done, timeout=0.2, return_when=concurrent.futures.FIRST_COMPLETED)
+            drain_events()
+            for future in done:
+                task = futures[future]
+                try:
+                    result = future.result()
+                except Exception as e:
+                    # 工作进程意外退出等情况
+                    result = {"file": task["input"], "name": task["name"], "status": "failed",
+                              "error": f"{type(e).__name__}: {e}", "output": None}
+                results.append(result)
+                summary = result.pop("summary", None)
+                if summary and args.metrics_port:
+                    from metrics import REGISTRY
+                    REGISTRY.observe_job(summary, finished_here=False)
+                log.write({"event": "finished", **result})
+                mark = "✅" if result["status"] == "succeeded" else "❌"
+                print(f"{mark} [{len(results)}/{len(pending)}] {task['input']} "
+                      f"({result.get('elapsed_seconds', 0):.1f}s){'' if result['status'] == 'succeeded' else ' - ' + str(result['error'])[:200]}")
+    except KeyboardInterrupt:
+        interrupted = True
+        print("\n收到中断信号，正在取消尚未开始的任务... 重新运行同一命令即可继续。")
+        executor.shutdown(wait=False, cancel_futures=True)
+    finally:
+        executor.shutdown(wait=not interrupted, cancel_futures=True)
+        drain_events(timeout=0.1)
+
+    succeeded = sum(1 for r in results if r["status"] == "succeeded")
+    failed = len(results) - succeeded
+    wall = round(time.perf_counter() - batch_start, 3)
+    log.write({"event": "batch_finished", "succeeded": succeeded, "failed": failed,
+               "skipped": len(tasks) - len(pending), "interrupted": interrupted, "wall_seconds": wall})
+    log.close()
+
+    print(f"完成: 成功 {succeeded} 个，失败 {failed} 个，用时 {wall:.1f}s。")
+    if interrupted:
+        return 130
+    return 0 if failed == 0 else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
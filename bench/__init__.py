@@ -0,0 +1,3 @@
+# bench/__init__.py
+# 本地测试与性能评估工具：桩服务器、批处理/服务的压测脚本等。
+# 这些工具只依赖标准库，可在离线环境中运行。
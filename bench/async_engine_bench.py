@@ -0,0 +1,194 @@
+# bench/async_engine_bench.py
+"""
+同时运行大量任务时，两种处理引擎的资源占用对比：
+
+- threads: 每个任务一个消费线程运行 main_process_generator(engine="threads")
+           (任务内部再使用转录线程池与 Dify 线程池，即 Web 应用 / 批处理 CLI 的现状)
+- bridged: 同上，但 engine="async"：任务在共享的后台事件循环中运行，消费线程只负责转发事件
+- async:   单个事件循环中用 asyncio.gather 运行 async_pipeline.main_process_async，不使用消费线程
+
+每种引擎在独立子进程中运行 --jobs 个同时开始的任务 (默认 50 个)，Whisper 与 Dify 都指向
+父进程中的本地桩服务器。报告峰值线程数 (每 10 毫秒采样一次)、RSS 增量与峰值、墙钟时间和每分钟完成的任务数。
+默认输入为合成文字稿；安装了 ffmpeg 时可用 --kind audio 让任务经过切分和转录阶段。
+
+示例:
+    python -m bench.async_engine_bench
+    python -m bench.async_engine_bench --jobs 50 --profile slow --queries Notes Quiz "Q&A"
+    python -m bench.async_engine_bench --kind audio --duration 1800
+"""
+import argparse
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from bench import synthetic_media  # noqa: E402
+from bench.stub_servers import PROFILES, start_stub_server  # noqa: E402
+
+ENGINES = ("threads", "bridged", "async")
+
+
+def _rss_mb() -> float | None:
+    """当前进程的 RSS (MB)，读取 /proc，其他平台返回 None。"""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+class _Sampler:
+    """后台采样线程数与 RSS 的峰值 (采样线程本身不计入)。"""
+
+    def __init__(self, interval: float = 0.01):
+        self.interval = interval
+        self.peak_threads = 0
+        self.peak_rss_mb = 0.0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.peak_threads = max(self.peak_threads, threading.active_count() - 1)
+            self.peak_rss_mb = max(self.peak_rss_mb, _rss_mb() or 0.0)
+            self._stop.wait(self.interval)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+
+def _job_args(spec: dict, work_dir: str, i: int) -> tuple:
+    job_dir = os.path.join(work_dir, f"job_{i:03d}")
+    os.makedirs(job_dir, exist_ok=True)
+    query = spec["queries"][0] if len(spec["queries"]) == 1 else spec["queries"]
+    return (spec["input"], "sk-bench", "app-bench", os.path.join(job_dir, "result"), query), {"work_dir": job_dir}
+
+
+def _status(events) -> str:
+    return events[-1][1]["status"] if events and events[-1][0] == "job_summary" else "failed"
+
+
+def run_child(spec: dict) -> dict:
+    import asyncio
+
+    from async_pipeline import main_process_async
+    from main import main_process_generator
+
+    work_dir = tempfile.mkdtemp(prefix="bench_engine_")
+    jobs = [_job_args(spec, work_dir, i) for i in range(spec["jobs"])]
+    statuses = []
+    baseline_rss = _rss_mb()
+    baseline_threads = threading.active_count()
+
+    def consume(args, kwargs, engine):
+        statuses.append(_status(list(main_process_generator(*args, engine=engine, **kwargs))))
+
+    async def run_async():
+        async def consume_async(args, kwargs):
+            events = [event async for event in main_process_async(*args, **kwargs)]
+            statuses.append(_status(events))
+        await asyncio.gather(*(consume_async(args, kwargs) for args, kwargs in jobs))
+
+    started = time.perf_counter()
+    try:
+        with _Sampler() as sampler:
+            if spec["engine"] == "async":
+                asyncio.run(run_async())
+            else:
+                engine = "threads" if spec["engine"] == "threads" else "async"
+                workers = [threading.Thread(target=consume, args=(args, kwargs, engine)) for args, kwargs in jobs]
+                for worker in workers:
+                    worker.start()
+                for worker in workers:
+                    worker.join()
+        wall = time.perf_counter() - started
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    rss_scale = 1024 * 1024 if sys.platform == "darwin" else 1024
+    succeeded = statuses.count("succeeded")
+    return {
+        "jobs": spec["jobs"],
+        "succeeded": succeeded,
+        "wall_seconds": round(wall, 3),
+        "jobs_per_minute": round(succeeded / wall * 60, 1),
+        "baseline_threads": baseline_threads,
+        "peak_threads": sampler.peak_threads,
+        "baseline_rss_mb": round(baseline_rss, 1) if baseline_rss is not None else None,
+        "peak_rss_mb": round(sampler.peak_rss_mb or resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / rss_scale, 1),
+        "rss_growth_mb": round(sampler.peak_rss_mb - baseline_rss, 1) if baseline_rss is not None else None,
+    }
+
+
+def run_once(spec: dict, env: dict) -> dict:
+    proc = subprocess.run(
+        [sys.executable, "-m", "bench.async_engine_bench", "--child", json.dumps(spec)],
+        cwd=ROOT, env=env, capture_output=True, text=True,
+    )
+    if proc.returncode != 0:
+        return {"status": "crashed", "error": proc.stderr[-2000:]}
+    # 子进程的最后一行是结果 JSON，之前是流程中的打印信息
+    return json.loads(proc.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="threads / async 处理引擎在大量并发任务下的资源占用对比。")
+    parser.add_argument("--jobs", type=int, default=50, help="同时开始的任务数")
+    parser.add_argument("--engines", nargs="+", choices=ENGINES, default=list(ENGINES))
+    parser.add_argument("--kind", choices=["text", "audio"], default="text", help="输入类型 (audio 需要 ffmpeg)")
+    parser.add_argument("--chars", type=int, default=50000, help="文字稿字符数 (--kind text)")
+    parser.add_argument("--duration", type=int, default=1800, help="音频时长 (秒，--kind audio)")
+    parser.add_argument("--queries", nargs="+", default=["Notes", "Quiz", "Q&A"], help="每个任务的生成类型")
+    parser.add_argument("--profile", choices=sorted(PROFILES), default="typical", help="桩服务器的故障画像")
+    parser.add_argument("--data-dir", default=os.path.join(ROOT, "bench_data"), help="合成输入的缓存目录")
+    parser.add_argument("--child", default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(run_child(json.loads(args.child)), ensure_ascii=False))
+        return 0
+
+    if args.kind == "audio":
+        if not synthetic_media.ffmpeg_available():
+            print("未找到 ffmpeg/ffprobe，无法生成音频输入；请改用 --kind text。", file=sys.stderr)
+            return 1
+        input_path = synthetic_media.make_audio(args.duration, args.data_dir)
+    else:
+        input_path = synthetic_media.make_text(args.chars, args.data_dir)
+
+    stub, base_url = start_stub_server(**PROFILES[args.profile])
+    env = dict(os.environ, DIFY_API_BASE=base_url, OPENAI_BASE_URL=base_url, PYTHONUNBUFFERED="1")
+    env.pop("METRICS_LOG", None)
+
+    results = []
+    for engine in args.engines:
+        spec = {"engine": engine, "jobs": args.jobs, "input": input_path, "queries": args.queries}
+        run = run_once(spec, env)
+        results.append({"engine": engine, **run})
+        print(f"[{engine}] {run.get('succeeded')}/{args.jobs} 成功 峰值线程={run.get('peak_threads')} "
+              f"RSS 增量={run.get('rss_growth_mb')}MB 吞吐={run.get('jobs_per_minute')} 任务/分钟", file=sys.stderr)
+    stub.shutdown()
+
+    print(json.dumps({"input": input_path, "profile": args.profile, "queries": args.queries, "results": results},
+                     ensure_ascii=False, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,53 @@
+# bench/compaction_bench.py
+"""
+文字稿压缩的速度与效果：对不同长度的合成文字稿运行 compaction.compact_transcript，
+报告耗时、每秒处理字符数和估算 token 减少比例。耗时应随长度线性增长。
+
+示例:
+    python -m bench.compaction_bench --sizes 50000 100000 200000 400000
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from bench import synthetic_media  # noqa: E402
+from compaction import compact_transcript  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description="文字稿压缩基准测试。")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[50000, 100000, 200000, 400000], help="文字稿字符数")
+    parser.add_argument("--repeats", type=int, default=5, help="每个长度运行次数，报告取中位数")
+    parser.add_argument("--data-dir", default=os.path.join(ROOT, "bench_data"), help="合成输入的缓存目录")
+    args = parser.parse_args()
+
+    results = []
+    for size in args.sizes:
+        with open(synthetic_media.make_text(size, args.data_dir), encoding="utf-8") as f:
+            text = f.read()
+        timings = []
+        for _ in range(args.repeats):
+            started = time.perf_counter()
+            _, report = compact_transcript(text)
+            timings.append(time.perf_counter() - started)
+        seconds = statistics.median(timings)
+        results.append({
+            "chars": len(text),
+            "median_seconds": round(seconds, 4),
+            "chars_per_second": round(len(text) / seconds),
+            "microseconds_per_char": round(seconds / len(text) * 1e6, 3),
+            **{key: report[key] for key in ("tokens_before", "tokens_after", "token_reduction",
+                                            "exact_duplicates_removed", "near_duplicates_removed",
+                                            "disfluencies_removed", "estimated_prefill_seconds_saved")},
+        })
+    print(json.dumps(results, ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,160 @@
+# bench/import_profile.py
+"""
+各入口模块的冷启动导入耗时，以及导入时是否意外加载了重量级依赖。
+
+每个模块在全新的解释器中用 python -X importtime -c "import <模块>" 导入 --repeats 次，报告:
+- import_ms:   importtime 记录的该模块累计导入耗时 (中位数)
+- wall_ms:     子进程墙钟时间减去空解释器 (python -c pass) 的中位数
+- top_modules: 自身耗时 (self) 最高的几个被导入模块 (不含空解释器启动时就会导入的模块)
+- heavy:       导入后 sys.modules 中出现的重量级依赖
+
+EXPECTATIONS 记录每个模块导入时“不应该”加载的依赖 (例如导入 main 不应加载 openai / requests，
+导入 keyframe_extractor 不应加载 cv2 / numpy / PIL)。出现违规，或设置了 --budget-ms 且某个模块
+超出预算时，以退出码 1 结束，可以直接放进 CI。--save / --compare 用于保存结果并与上次对比，跟踪冷启动的变化。
+
+示例:
+    python -m bench.import_profile
+    python -m bench.import_profile --modules main app --repeats 9 --budget-ms 100
+    python -m bench.import_profile --save bench_data/import_profile.json
+    python -m bench.import_profile --compare bench_data/import_profile.json
+"""
+import argparse
+import importlib.util
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+HEAVY_MODULES = (
+    "openai", "requests", "urllib3", "httpx", "asyncio", "dotenv", "http.server", "email.utils",
+    "cv2", "numpy", "PIL", "scenedetect", "faster_whisper", "streamlit",
+)
+_NETWORK = ("openai", "requests", "urllib3", "httpx")
+_VISION = ("cv2", "numpy", "PIL", "scenedetect")
+
+# 模块 -> 导入它时不应出现在 sys.modules 中的依赖
+EXPECTATIONS = {
+    "config": ("dotenv",) + _NETWORK,
+    "utils": ("asyncio", "email.utils") + _NETWORK,
+    "metrics": ("http.server", "asyncio") + _NETWORK,
+    "dify_api": ("asyncio",) + _NETWORK + _VISION,
+    "main": ("asyncio",) + _NETWORK + _VISION,
+    "async_pipeline": ("openai",) + _VISION,
+    "batch_cli": ("asyncio",) + _NETWORK + _VISION,
+    "api_server": ("asyncio",) + _NETWORK + _VISION,
+    "video_processor.scheduler": ("asyncio",) + _NETWORK,
+    "video_processor.splitter": ("asyncio",) + _NETWORK,
+    "video_processor.transcriber": _VISION,
+    "video_processor.keyframe_extractor": _VISION + _NETWORK,
+    # streamlit 自身会加载一部分网络库，这里只检查处理流程没有被提前导入
+    "app": ("main", "openai", "dify_api"),
+}
+# 需要额外依赖才能导入的模块，依赖缺失时跳过
+REQUIRES = {"app": "streamlit"}
+
+_PROBE = "import sys, json; import {module}; print(json.dumps([m for m in {heavy!r} if m in sys.modules]))"
+
+
+def _run(code: str, importtime: bool) -> tuple[float, str, str]:
+    command = [sys.executable] + (["-X", "importtime"] if importtime else []) + ["-c", code]
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    started = time.perf_counter()
+    proc = subprocess.run(command, cwd=ROOT, env=env, capture_output=True, text=True)
+    wall = time.perf_counter() - started
+    if proc.returncode != 0:
+        raise RuntimeError(proc.stderr.strip().splitlines()[-1] if proc.stderr.strip() else f"exit {proc.returncode}")
+    return wall, proc.stdout, proc.stderr
+
+
+def parse_importtime(stderr: str) -> dict:
+    """把 -X importtime 的输出解析为 {模块名: (self 微秒, cumulative 微秒)}。"""
+    timings = {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "imported package" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        timings[name.strip()] = (int(self_us), int(cumulative_us))
+    return timings
+
+
+def profile_module(module: str, repeats: int, baseline_wall: float, baseline_modules: set, top: int) -> dict:
+    imports, walls, heavy, timings = [], [], [], {}
+    code = _PROBE.format(module=module, heavy=HEAVY_MODULES)
+    for _ in range(repeats):
+        wall, stdout, stderr = _run(code, importtime=True)
+        timings = parse_importtime(stderr)
+        imports.append(timings.get(module, (0, 0))[1] / 1000)
+        walls.append(max(0.0, wall - baseline_wall) * 1000)
+        heavy = json.loads(stdout.strip().splitlines()[-1])
+    own = [(name, t) for name, t in timings.items() if name not in baseline_modules]
+    top_modules = sorted(own, key=lambda item: item[1][0], reverse=True)[:top]
+    return {
+        "module": module,
+        "import_ms": round(statistics.median(imports), 1),
+        "wall_ms": round(statistics.median(walls), 1),
+        "top_modules": [{"module": name, "self_ms": round(self_us / 1000, 1)} for name, (self_us, _) in top_modules],
+        "heavy": heavy,
+        "unexpected": [m for m in heavy if m in EXPECTATIONS.get(module, ())],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="入口模块的冷启动导入耗时与重量级依赖检查。")
+    parser.add_argument("--modules", nargs="+", default=list(EXPECTATIONS), help="要测量的模块")
+    parser.add_argument("--repeats", type=int, default=5, help="每个模块导入的次数，取中位数")
+    parser.add_argument("--top", type=int, default=5, help="报告自身耗时最高的前几个被导入模块")
+    parser.add_argument("--budget-ms", type=float, default=None, help="import_ms 超过该值时以退出码 1 结束")
+    parser.add_argument("--save", default=None, help="把结果写入该 JSON 文件")
+    parser.add_argument("--compare", default=None, help="与之前 --save 的结果对比")
+    args = parser.parse_args()
+
+    baseline_wall = statistics.median(_run("pass", importtime=False)[0] for _ in range(args.repeats))
+    baseline_modules = set(parse_importtime(_run("pass", importtime=True)[2]))
+    previous = {}
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            previous = {r["module"]: r for r in json.load(f)["results"]}
+
+    results, failures = [], []
+    for module in args.modules:
+        required = REQUIRES.get(module)
+        if required and importlib.util.find_spec(required) is None:
+            print(f"[{module}] 跳过：未安装 {required}", file=sys.stderr)
+            continue
+        try:
+            result = profile_module(module, args.repeats, baseline_wall, baseline_modules, args.top)
+        except RuntimeError as e:
+            results.append({"module": module, "error": str(e)})
+            failures.append(f"{module}: 导入失败 ({e})")
+            print(f"[{module}] 导入失败: {e}", file=sys.stderr)
+            continue
+        if module in previous and "import_ms" in previous[module]:
+            result["previous_import_ms"] = previous[module]["import_ms"]
+        results.append(result)
+
+        if result["unexpected"]:
+            failures.append(f"{module}: 意外加载了 {', '.join(result['unexpected'])}")
+        if args.budget_ms is not None and result["import_ms"] > args.budget_ms:
+            failures.append(f"{module}: {result['import_ms']} ms 超出预算 {args.budget_ms} ms")
+        change = f" (之前 {result['previous_import_ms']} ms)" if "previous_import_ms" in result else ""
+        print(f"[{module}] import {result['import_ms']} ms{change} / 墙钟 +{result['wall_ms']} ms "
+              f"重量级依赖={result['heavy'] or '-'}", file=sys.stderr)
+
+    report = {"python": sys.version.split()[0], "baseline_wall_ms": round(baseline_wall * 1000, 1),
+              "results": results, "failures": failures}
+    if args.save:
+        os.makedirs(os.path.dirname(os.path.abspath(args.save)), exist_ok=True)
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+    for failure in failures:
+        print(f"违规: {failure}", file=sys.stderr)
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,169 @@
+# bench/load_test_api.py
+"""
+HTTP 任务服务 (api_server.py) 的压测脚本，全部在本机完成，不访问外部网络。
+
+流程: 启动本地 Whisper/Dify 桩服务器 -> 启动任务服务 -> 多个客户端在指定时长内
+循环提交文本任务并订阅 SSE 事件流 -> 统计持续吞吐量 (jobs/min)、事件延迟、429 次数。
+
+事件延迟 = 客户端收到事件的时间 - 服务器产生该事件时写入的 ts (同一台机器，时钟一致)。
+
+示例:
+    python -m bench.load_test_api --clients 8 --max-jobs 4 --duration 30 --dify-latency 0.2
+"""
+import argparse
+import http.client
+import json
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from urllib.parse import quote
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench.stub_servers import start_stub_server  # noqa: E402
+
+
+def percentile(values: list[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def read_sse(response):
+    """逐个解析 SSE 事件，产出 (event_type, data_dict, 接收时间)。"""
+    event_type, data_lines = "message", []
+    for raw in response:
+        line = raw.decode("utf-8").rstrip("\r\n")
+        if not line:
+            if data_lines:
+                yield event_type, json.loads("\n".join(data_lines)), time.time()
+            event_type, data_lines = "message", []
+        elif line.startswith(":"):
+            continue
+        elif line.startswith("event:"):
+            event_type = line[len("event:"):].strip()
+        elif line.startswith("data:"):
+            data_lines.append(line[len("data:"):].lstrip())
+
+
+class LoadStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.job_seconds = []
+        self.event_latencies_ms = []
+
+    def to_dict(self, wall: float) -> dict:
+        lat = self.event_latencies_ms
+        return {
+            "wall_seconds": round(wall, 3),
+            "jobs_completed": self.completed,
+            "jobs_failed": self.failed,
+            "rejected_429": self.rejected,
+            "jobs_per_minute": round(self.completed / wall * 60, 2) if wall else 0.0,
+            "job_seconds_p50": round(percentile(self.job_seconds, 50), 3),
+            "job_seconds_p95": round(percentile(self.job_seconds, 95), 3),
+            "events_observed": len(lat),
+            "event_latency_ms_mean": round(statistics.fmean(lat), 3) if lat else 0.0,
+            "event_latency_ms_p50": round(percentile(lat, 50), 3),
+            "event_latency_ms_p95": round(percentile(lat, 95), 3),
+            "event_latency_ms_p99": round(percentile(lat, 99), 3),
+            "event_latency_ms_max": round(max(lat), 3) if lat else 0.0,
+        }
+
+
+def client_loop(host: str, port: int, payload: bytes, deadline: float, stats: LoadStats):
+    while time.time() < deadline:
+        started = time.perf_counter()
+        conn = http.client.HTTPConnection(host, port, timeout=120)
+        conn.request("POST", f"/jobs?filename={quote('lecture.txt')}&query=Notes", body=payload,
+                     headers={"Content-Type": "application/octet-stream"})
+        response = conn.getresponse()
+        body = response.read()
+        conn.close()
+
+        if response.status == 429:
+            with stats.lock:
+                stats.rejected += 1
+            time.sleep(float(response.getheader("Retry-After", "1")) / 10)
+            continue
+        if response.status != 202:
+            with stats.lock:
+                stats.failed += 1
+            continue
+
+        job = json.loads(body)
+        conn = http.client.HTTPConnection(host, port, timeout=120)
+        conn.request("GET", job["events_url"])
+        events = conn.getresponse()
+        outcome, latencies = "failed", []
+        for event_type, data, received_at in read_sse(events):
+            latencies.append((received_at - data["ts"]) * 1000)
+            if event_type == "done":
+                outcome = "done"
+            elif event_type in ("persistent_error", "error"):
+                break
+        conn.close()
+
+        with stats.lock:
+            stats.event_latencies_ms.extend(latencies)
+            if outcome == "done":
+                stats.completed += 1
+                stats.job_seconds.append(time.perf_counter() - started)
+            else:
+                stats.failed += 1
+
+
+def main():
+    parser = argparse.ArgumentParser(description="HTTP 任务服务压测 (本地桩后端)。")
+    parser.add_argument("--clients", type=int, default=8, help="并发客户端数")
+    parser.add_argument("--max-jobs", type=int, default=4, help="任务服务的并发任务上限")
+    parser.add_argument("--duration", type=float, default=20.0, help="压测时长 (秒)")
+    parser.add_argument("--transcript-kb", type=int, default=64, help="每个任务上传的文本大小 (KB)")
+    parser.add_argument("--dify-latency", type=float, default=0.1, help="桩服务器的首包延迟 (秒)")
+    parser.add_argument("--chunk-delay", type=float, default=0.01, help="桩服务器 text_chunk 间隔 (秒)")
+    parser.add_argument("--json", action="store_true", help="只输出 JSON 结果")
+    args = parser.parse_args()
+
+    stub, stub_url = start_stub_server(latency=args.dify_latency, chunk_delay=args.chunk_delay)
+    os.environ["DIFY_API_BASE"] = stub_url
+    os.environ["OPENAI_BASE_URL"] = stub_url
+
+    from api_server import JobManager, make_server
+
+    with tempfile.TemporaryDirectory() as jobs_dir:
+        manager = JobManager(jobs_dir, dify_api_key="app-stub", max_active_jobs=args.max_jobs)
+        server = make_server("127.0.0.1", 0, manager)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        host, port = server.server_address[:2]
+
+        line = "这是一段用于压测的课程文字稿。" * 4 + "\n"
+        payload = (line * (args.transcript_kb * 1024 // len(line.encode("utf-8")) + 1)).encode("utf-8")
+
+        stats = LoadStats()
+        start = time.time()
+        deadline = start + args.duration
+        threads = [threading.Thread(target=client_loop, args=(host, port, payload, deadline, stats))
+                   for _ in range(args.clients)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        wall = time.time() - start
+
+        server.shutdown()
+        stub.shutdown()
+
+    result = {"config": vars(args), "results": stats.to_dict(wall)}
+    print(json.dumps(result, ensure_ascii=False, indent=None if args.json else 2))
+
+
+if __name__ == "__main__":
+    main()
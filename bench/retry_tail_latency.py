@@ -0,0 +1,122 @@
+# bench/retry_tail_latency.py
+"""
+对比两种重试策略在“不稳定上游”下的尾延迟：
+
+- fixed:   旧行为 —— 固定间隔重试，不加抖动，不理会 Retry-After，没有熔断
+- backoff: 新行为 —— 指数退避 + 随机抖动，遵循 Retry-After，共享熔断器
+
+模拟若干个并发任务 (每个任务一个 10 线程的线程池，与 main.py 一致) 把音频块发往本地的
+Whisper 桩服务器，统计每块的完成时间分位数、失败块数，以及桩服务器实际收到的请求数。
+
+示例:
+    python -m bench.retry_tail_latency --profile flaky --jobs 3 --chunks 40
+    python -m bench.retry_tail_latency --profile rate_limited --jobs 3 --chunks 20
+"""
+import argparse
+import concurrent.futures
+import json
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench.stub_servers import PROFILES, start_stub_server  # noqa: E402
+
+
+def percentile(values: list[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, round(pct / 100 * (len(ordered) - 1)))]
+
+
+def run_policy(name: str, transcribe, audio_path: str, jobs: int, chunks: int, stub) -> dict:
+    with stub.stub_state["lock"]:
+        stub.stub_state["window"].clear()
+        for key in stub.stub_counts:
+            stub.stub_counts[key] = 0
+    latencies, failures = [], 0
+
+    def one_chunk(_):
+        started = time.perf_counter()
+        try:
+            transcribe(audio_path, "sk-bench")
+            return time.perf_counter() - started, None
+        except Exception as e:
+            return time.perf_counter() - started, e
+
+    wall_start = time.perf_counter()
+    # 每个任务一个线程池，多个任务同时运行
+    pools = [concurrent.futures.ThreadPoolExecutor(max_workers=10) for _ in range(jobs)]
+    futures = [pool.submit(one_chunk, i) for pool in pools for i in range(chunks)]
+    for future in concurrent.futures.as_completed(futures):
+        latency, error = future.result()
+        latencies.append(latency)
+        failures += error is not None
+    for pool in pools:
+        pool.shutdown()
+    wall = time.perf_counter() - wall_start
+
+    return {
+        "policy": name,
+        "chunks": len(latencies),
+        "failed_chunks": failures,
+        "wall_seconds": round(wall, 3),
+        "p50_seconds": round(percentile(latencies, 50), 3),
+        "p95_seconds": round(percentile(latencies, 95), 3),
+        "p99_seconds": round(percentile(latencies, 99), 3),
+        "max_seconds": round(max(latencies), 3),
+        "upstream_requests": stub.stub_counts["requests"],
+        "upstream_429": stub.stub_counts["429"],
+        "upstream_500": stub.stub_counts["500"],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="重试策略尾延迟对比 (本地不稳定桩服务器)。")
+    parser.add_argument("--profile", choices=sorted(PROFILES), default="flaky")
+    parser.add_argument("--error-rate", type=float, default=None, help="覆盖画像中的 500 概率")
+    parser.add_argument("--jobs", type=int, default=3, help="同时运行的任务数")
+    parser.add_argument("--chunks", type=int, default=40, help="每个任务的音频块数")
+    parser.add_argument("--delay", type=float, default=1.0, help="两种策略共同的基础重试间隔 (秒)")
+    parser.add_argument("--max-retries", type=int, default=4)
+    args = parser.parse_args()
+
+    options = dict(PROFILES[args.profile])
+    if args.error_rate is not None:
+        options["error_rate"] = args.error_rate
+    stub, base_url = start_stub_server(**options)
+    os.environ["OPENAI_BASE_URL"] = base_url
+
+    from utils import retry
+    from video_processor.transcriber import RETRYABLE_EXCEPTIONS, transcribe_single_audio_chunk
+
+    raw = transcribe_single_audio_chunk.__wrapped__
+    policies = {
+        "fixed": retry(max_retries=args.max_retries, delay=args.delay, backoff=1.0, jitter=False,
+                       allowed_exceptions=RETRYABLE_EXCEPTIONS)(raw),
+        "backoff": retry(max_retries=args.max_retries, delay=args.delay, allowed_exceptions=RETRYABLE_EXCEPTIONS,
+                         upstream="whisper-bench")(raw),
+    }
+
+    with tempfile.NamedTemporaryFile(suffix=".mp3") as audio:
+        audio.write(b"\0" * 32 * 1024)
+        audio.flush()
+        results = []
+        for name, transcribe in policies.items():
+            # 桩服务器与转录函数的打印信息很多，这里只保留结果
+            with open(os.devnull, "w") as devnull:
+                stdout, sys.stdout = sys.stdout, devnull
+                try:
+                    results.append(run_policy(name, transcribe, audio.name, args.jobs, args.chunks, stub))
+                finally:
+                    sys.stdout = stdout
+
+    stub.shutdown()
+    print(json.dumps({"config": {**vars(args), "stub": options}, "results": results}, ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
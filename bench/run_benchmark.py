@@ -0,0 +1,291 @@
+# bench/run_benchmark.py
+"""
+端到端基准测试：用合成输入在本地桩服务器上运行 main_process_generator，
+记录墙钟时间、CPU 时间、峰值内存 (RSS) 以及各阶段耗时，输出可比较的 JSON。
+
+- 完全离线：Whisper 与 Dify 都由 bench.stub_servers 提供，可分别指定故障画像
+- 每次运行都在独立子进程中执行，峰值 RSS 与 CPU 时间互不干扰 (ffmpeg 子进程单独统计)
+- 没有 ffmpeg 时自动跳过音视频场景
+
+示例:
+    python -m bench.run_benchmark -o bench_results/base.json
+    python -m bench.run_benchmark --scenario text:200000 --scenario audio:1800 --repeats 3 \\
+        --whisper-profile typical --dify-profile typical -o bench_results/new.json \\
+        --compare bench_results/base.json --threshold 0.10
+
+--compare 时，任一场景的中位墙钟时间、CPU 时间或峰值内存超过基线 (1 + threshold) 倍即以退出码 1 结束，
+可直接用于 CI 门禁。
+
+--backend 可重复指定，音视频场景会用每个转录后端各运行一遍 (默认只用 openai，即指向桩服务器的 Whisper)，
+结束时打印各后端的转录耗时与吞吐 (每秒转录的音频秒数) 对比。local 后端需要 --local-model 指向磁盘上的模型目录:
+    python -m bench.run_benchmark --scenario audio:1800 --backend openai --backend stub \
+        --backend local --local-model models/faster-whisper-small
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import resource
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from bench import synthetic_media  # noqa: E402
+from bench.stub_servers import PROFILES, start_stub_server  # noqa: E402
+from video_processor.backends import BACKENDS, DEFAULT_BACKEND  # noqa: E402
+
+SCHEMA_VERSION = 1
+DEFAULT_SCENARIOS = ["text:200000", "audio:1800", "video:600"]
+# 参与回归比较的指标
+COMPARED_METRICS = ("wall_seconds", "cpu_seconds", "peak_rss_mb")
+
+
+def parse_scenario(spec: str) -> dict:
+    kind, _, size = spec.partition(":")
+    if kind not in ("text", "audio", "video") or not size.isdigit():
+        raise argparse.ArgumentTypeError(f"无效的场景 '{spec}'，格式应为 text:<字符数> / audio:<秒> / video:<秒>")
+    unit = "c" if kind == "text" else "s"
+    return {"name": f"{kind}_{size}{unit}", "kind": kind, "size": int(size)}
+
+
+def prepare_input(scenario: dict, data_dir: str) -> str:
+    maker = {"text": synthetic_media.make_text, "audio": synthetic_media.make_audio,
+             "video": synthetic_media.make_video}[scenario["kind"]]
+    return maker(scenario["size"], data_dir)
+
+
+# --- 子进程：执行一次任务并写出测量结果 ---
+
+def run_child(spec: dict) -> dict:
+    from main import main_process_generator
+
+    work_dir = tempfile.mkdtemp(prefix="bench_job_")
+    summary, status, error = None, "failed", None
+    start_wall = time.perf_counter()
+    try:
+        generator = main_process_generator(
+            spec["input"], spec["openai_api_key"], spec["dify_api_key"],
+            os.path.join(work_dir, "result"), spec["query"], work_dir=work_dir,
+            transcription_backend=spec.get("transcription_backend"),
+        )
+        for event_type, value, *rest in generator:
+            if event_type == "done":
+                status = "succeeded"
+            elif event_type in ("persistent_error", "error"):
+                error = (rest[0] if rest else str(value))[:500]
+            elif event_type == "job_summary":
+                summary = value
+    finally:
+        wall = time.perf_counter() - start_wall
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    self_usage = resource.getrusage(resource.RUSAGE_SELF)
+    child_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    # Linux 上 ru_maxrss 的单位是 KB，macOS 上是字节
+    rss_scale = 1024 * 1024 if sys.platform == "darwin" else 1024
+    result = {
+        "status": status,
+        "error": error,
+        "wall_seconds": round(wall, 4),
+        "cpu_user_seconds": round(self_usage.ru_utime, 4),
+        "cpu_system_seconds": round(self_usage.ru_stime, 4),
+        "cpu_children_seconds": round(child_usage.ru_utime + child_usage.ru_stime, 4),
+        "peak_rss_mb": round(self_usage.ru_maxrss / rss_scale, 2),
+        "children_peak_rss_mb": round(child_usage.ru_maxrss / rss_scale, 2),
+        "stages": {},
+        "counters": {},
+    }
+    result["cpu_seconds"] = round(result["cpu_user_seconds"] + result["cpu_system_seconds"]
+                                  + result["cpu_children_seconds"], 4)
+    if summary:
+        result["stages"] = {name: agg["seconds"] for name, agg in summary["stages"].items()}
+        result["counters"] = summary["counters"]
+        result["dify_ttft_seconds"] = summary["info"].get("dify_ttft_seconds")
+    return result
+
+
+def run_once(spec: dict, env: dict) -> dict:
+    with tempfile.NamedTemporaryFile("r", suffix=".json", delete=False) as out:
+        out_path = out.name
+    try:
+        proc = subprocess.run(
+            [sys.executable, "-m", "bench.run_benchmark", "--child", json.dumps(spec), "--child-output", out_path],
+            cwd=ROOT, env=env, capture_output=True, text=True,
+        )
+        if proc.returncode != 0:
+            return {"status": "crashed", "error": proc.stderr[-2000:]}
+        with open(out_path, encoding="utf-8") as f:
+            return json.load(f)
+    finally:
+        os.remove(out_path)
+
+
+# --- 汇总与比较 ---
+
+def median_of(runs: list[dict]) -> dict:
+    ok = [r for r in runs if r.get("status") == "succeeded"]
+    if not ok:
+        return {}
+    median = {key: round(statistics.median(r[key] for r in ok), 4)
+              for key in ("wall_seconds", "cpu_seconds", "peak_rss_mb", "children_peak_rss_mb")}
+    stage_names = sorted({name for r in ok for name in r["stages"]})
+    median["stages"] = {name: round(statistics.median(r["stages"].get(name, 0.0) for r in ok), 4)
+                        for name in stage_names}
+    return median
+
+
+def compare(current: dict, baseline: dict, threshold: float) -> list[str]:
+    """打印对比表，返回回归项列表。"""
+    base_by_name = {s["name"]: s for s in baseline.get("scenarios", [])}
+    regressions = []
+    print(f"\n{'场景':<18}{'指标':<16}{'基线':>12}{'当前':>12}{'变化':>10}")
+    for scenario in current["scenarios"]:
+        base = base_by_name.get(scenario["name"])
+        if not base or not base.get("median") or not scenario.get("median"):
+            continue
+        for metric in COMPARED_METRICS:
+            old, new = base["median"][metric], scenario["median"][metric]
+            change = (new - old) / old if old else 0.0
+            flag = ""
+            if change > threshold:
+                flag = "  <-- 回归"
+                regressions.append(f"{scenario['name']}.{metric}: {old} -> {new} ({change:+.1%})")
+            print(f"{scenario['name']:<18}{metric:<16}{old:>12}{new:>12}{change:>+10.1%}{flag}")
+    return regressions
+
+
+def print_backend_table(report: dict):
+    """打印各转录后端在音视频场景上的转录耗时与吞吐。"""
+    rows = [s for s in report["scenarios"] if s["kind"] != "text" and s.get("median")]
+    if not rows:
+        return
+    print(f"\n{'场景':<18}{'后端':<10}{'转录 (s)':>12}{'音频秒/秒':>12}{'墙钟 (s)':>12}", file=sys.stderr)
+    for s in rows:
+        median = s["median"]
+        print(f"{s['scenario']:<18}{s['backend']:<10}{median['stages'].get('transcribe', 0.0):>12}"
+              f"{median.get('transcribe_throughput', '-'):>12}{median['wall_seconds']:>12}", file=sys.stderr)
+
+
+def host_info() -> dict:
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT,
+                                capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {
+        "platform": platform.platform(),
+        "python": platform.python_version(),
+        "cpu_count": os.cpu_count(),
+        "ffmpeg": synthetic_media.ffmpeg_available(),
+        "git_commit": commit,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="端到端基准测试 (合成输入 + 本地桩后端)。")
+    parser.add_argument("--scenario", action="append", type=parse_scenario,
+                        help=f"场景，可重复指定 (默认: {' '.join(DEFAULT_SCENARIOS)})")
+    parser.add_argument("--repeats", type=int, default=3, help="每个场景运行次数，报告取中位数")
+    parser.add_argument("--query", default="Notes", choices=["Notes", "Q&A", "Quiz"])
+    parser.add_argument("--whisper-profile", choices=sorted(PROFILES), default="typical")
+    parser.add_argument("--dify-profile", choices=sorted(PROFILES), default="typical")
+    parser.add_argument("--backend", action="append", choices=BACKENDS,
+                        help=f"转录后端，可重复指定以对比吞吐 (默认: {DEFAULT_BACKEND})")
+    parser.add_argument("--local-model", default=None, help="local 后端使用的模型目录 (覆盖 LOCAL_WHISPER_MODEL)")
+    parser.add_argument("--data-dir", default=os.path.join(ROOT, "bench_data"), help="合成输入的缓存目录")
+    parser.add_argument("-o", "--output", default=None, help="结果 JSON 路径 (默认打印到标准输出)")
+    parser.add_argument("--compare", default=None, help="与之比较的基线结果 JSON")
+    parser.add_argument("--threshold", type=float, default=0.10, help="判定回归的相对阈值 (默认 0.10)")
+    parser.add_argument("--child", default=None, help=argparse.SUPPRESS)
+    parser.add_argument("--child-output", default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        result = run_child(json.loads(args.child))
+        with open(args.child_output, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False)
+        return 0
+
+    scenarios = args.scenario or [parse_scenario(s) for s in DEFAULT_SCENARIOS]
+    whisper_stub, whisper_url = start_stub_server(**PROFILES[args.whisper_profile])
+    dify_stub, dify_url = start_stub_server(**PROFILES[args.dify_profile])
+    env = dict(os.environ, OPENAI_BASE_URL=whisper_url, DIFY_API_BASE=dify_url, PYTHONUNBUFFERED="1")
+    env.pop("METRICS_LOG", None)
+    if args.local_model:
+        env["LOCAL_WHISPER_MODEL"] = args.local_model
+    backends = args.backend or [DEFAULT_BACKEND]
+
+    report = {
+        "schema_version": SCHEMA_VERSION,
+        "created_at": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"),
+        "host": host_info(),
+        "config": {"repeats": args.repeats, "query": args.query,
+                   "whisper_profile": args.whisper_profile, "dify_profile": args.dify_profile,
+                   "backends": backends},
+        "scenarios": [],
+    }
+
+    for scenario in scenarios:
+        if scenario["kind"] != "text" and not synthetic_media.ffmpeg_available():
+            report["scenarios"].append({**scenario, "skipped": "未找到 ffmpeg/ffprobe"})
+            print(f"[跳过] {scenario['name']}: 未找到 ffmpeg/ffprobe", file=sys.stderr)
+            continue
+
+        input_path = prepare_input(scenario, args.data_dir)
+        # 文本场景不经过转录，只用第一个后端运行一遍
+        for backend in backends[:1] if scenario["kind"] == "text" else backends:
+            # 文本场景与默认后端沿用原场景名，与旧的基线结果保持可比
+            plain = scenario["kind"] == "text" or backend == DEFAULT_BACKEND
+            name = scenario["name"] if plain else f"{scenario['name']}@{backend}"
+            entry = {**scenario, "name": name, "scenario": scenario["name"], "backend": backend,
+                     "input_bytes": os.path.getsize(input_path)}
+            spec = {"input": input_path, "query": args.query, "transcription_backend": backend,
+                    "openai_api_key": "sk-bench", "dify_api_key": "app-bench"}
+            entry["runs"] = []
+            for i in range(args.repeats):
+                run = run_once(spec, env)
+                entry["runs"].append(run)
+                print(f"[{name}] 第 {i + 1}/{args.repeats} 次: {run.get('status')} "
+                      f"wall={run.get('wall_seconds')}s cpu={run.get('cpu_seconds')}s rss={run.get('peak_rss_mb')}MB",
+                      file=sys.stderr)
+            entry["median"] = median_of(entry["runs"])
+            transcribe_seconds = entry["median"].get("stages", {}).get("transcribe")
+            if scenario["kind"] != "text" and transcribe_seconds:
+                # 吞吐：每秒墙钟时间转录的音频秒数 (场景大小即音频时长)
+                entry["median"]["transcribe_throughput"] = round(scenario["size"] / transcribe_seconds, 2)
+            report["scenarios"].append(entry)
+
+    report["stub_counts"] = {"whisper": dict(whisper_stub.stub_counts), "dify": dict(dify_stub.stub_counts)}
+    whisper_stub.shutdown()
+    dify_stub.shutdown()
+    print_backend_table(report)
+
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text)
+        print(f"结果已写入 {args.output}", file=sys.stderr)
+    else:
+        print(text)
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = compare(report, baseline, args.threshold)
+        if regressions:
+            print("\n检测到性能回归:\n  " + "\n  ".join(regressions))
+            return 1
+        print("\n未检测到超过阈值的回归。")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,196 @@
+# bench/sse_parse_bench.py
+"""
+Dify 事件流解析的 CPU 开销：回放一段录制好的 SSE 流，对比
+
+- legacy:      旧实现 (requests.iter_lines 的按行拼接 + 逐行 str 解码 + 每个 data 行都 json.loads)
+- parser-json: sse_parser 增量解析 + 按事件类型预过滤 + 大事件只解码个别字段 (标准库 json)
+- parser-orjson: 同上，JSON 后端为 orjson (未安装时跳过)
+
+报告每种实现在不同读取块大小下的 CPU 时间 (毫秒/MB)，并检查各实现产出的事件完全一致。
+
+默认回放合成的录制流：workflow_started 与两个节点的 node_finished 都回显整份文字稿
+(与真实 Dify 一样)，外加大量 text_chunk。也可以用 --input 回放真实录制的流，例如:
+    curl -N -H "Authorization: Bearer $DIFY_API_KEY" -H "Content-Type: application/json" \\
+        -d @request.json https://api.dify.ai/v1/workflows/run > bench_data/recorded.sse
+
+示例:
+    python -m bench.sse_parse_bench
+    python -m bench.sse_parse_bench --transcript-chars 1000000 --chunk-sizes 512 16384
+    python -m bench.sse_parse_bench --input bench_data/recorded.sse
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from bench import synthetic_media  # noqa: E402
+from dify_api import WorkflowEventDecoder  # noqa: E402
+import sse_parser  # noqa: E402
+
+
+def make_recorded_stream(transcript_chars: int, num_text_chunks: int, data_dir: str) -> str:
+    """生成 (或复用) 一段结构与真实 Dify 工作流相同的 SSE 录制流。"""
+    path = os.path.join(data_dir, f"dify_stream_{transcript_chars}c_{num_text_chunks}t.sse")
+    if os.path.exists(path):
+        return path
+    with open(synthetic_media.make_text(transcript_chars, data_dir), encoding="utf-8") as f:
+        transcript = f.read()
+    inputs = {"source_transcript": transcript, "query": "Notes", "sys.user_id": "bench"}
+    pieces = [f"- 第 {i + 1} 段要点：梯度下降沿负梯度方向更新参数。\n" for i in range(num_text_chunks)]
+    answer = "".join(pieces)
+
+    def event(payload: dict) -> str:
+        return "data: " + json.dumps(payload, ensure_ascii=False) + "\n\n"
+
+    def node(event_name: str, title: str, **extra) -> str:
+        data = {"id": f"node-{title}", "node_id": title, "node_type": "llm", "title": title, "index": 1,
+                "predecessor_node_id": None, "inputs": inputs, **extra}
+        return event({"event": event_name, "workflow_run_id": "run-1", "task_id": "task-1", "data": data})
+
+    prompt = [{"role": "system", "text": "请根据以下文字稿生成笔记"}, {"role": "user", "text": transcript}]
+    parts = [
+        event({"event": "workflow_started", "workflow_run_id": "run-1", "task_id": "task-1",
+               "data": {"id": "run-1", "workflow_id": "wf", "inputs": inputs, "created_at": 0}}),
+        node("node_started", "LLM_SORT_NOTES"),
+        node("node_finished", "LLM_SORT_NOTES", process_data={"prompts": prompt}, outputs={"text": "NOTES_STEM"},
+             status="succeeded", error=None, elapsed_time=1.2,
+             execution_metadata={"total_tokens": 1000, "total_price": "0.001", "currency": "USD"}),
+        node("node_started", "LLM"),
+        ": ping\n\n",
+    ]
+    for piece in pieces:
+        parts.append(event({"event": "text_chunk", "workflow_run_id": "run-1", "task_id": "task-1",
+                            "data": {"text": piece, "from_variable_selector": ["llm", "text"]}}))
+    parts += [
+        node("node_finished", "LLM", process_data={"prompts": prompt}, outputs={"text": answer},
+             status="succeeded", error=None, elapsed_time=30.5,
+             execution_metadata={"total_tokens": 50000, "total_price": "0.05", "currency": "USD"}),
+        event({"event": "workflow_finished", "workflow_run_id": "run-1", "task_id": "task-1",
+               "data": {"id": "run-1", "status": "succeeded", "outputs": {"final_output": answer},
+                        "error": None, "elapsed_time": 32.0}}),
+    ]
+    os.makedirs(data_dir, exist_ok=True)
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("".join(parts))
+    return path
+
+
+def _iter_lines(chunks):
+    """requests.Response.iter_lines 的按行拼接逻辑 (旧实现所用)。"""
+    pending = None
+    for chunk in chunks:
+        if pending is not None:
+            chunk = pending + chunk
+        lines = chunk.splitlines()
+        if lines and lines[-1] and chunk and lines[-1][-1] == chunk[-1]:
+            pending = lines.pop()
+        else:
+            pending = None
+        yield from lines
+    if pending is not None:
+        yield pending
+
+
+def parse_legacy(chunks) -> list:
+    """旧版 run_workflow_streaming 的解析循环 (去掉了网络与指标部分)。"""
+    events = []
+    for line in _iter_lines(chunks):
+        if not line:
+            continue
+        decoded_line = line.decode('utf-8')
+        if not decoded_line.startswith('data:'):
+            continue
+        json_str = decoded_line[len('data:'):].strip()
+        try:
+            event_data = json.loads(json_str)
+        except json.JSONDecodeError:
+            events.append(('error', json_str))
+            continue
+        event = event_data.get('event')
+        if event == 'node_started':
+            events.append(('node_started', event_data.get('data', {}).get('title', '未知节点')))
+        elif event == 'node_finished':
+            node_data = event_data.get('data', {})
+            if node_data.get('title') == 'LLM_SORT_NOTES':
+                classification = node_data.get('outputs', {}).get('text')
+                if classification:
+                    events.append(('classification_result', classification.strip()))
+        elif event == 'text_chunk':
+            events.append(('text_chunk', event_data.get('data', {}).get('text', '')))
+        elif event == 'workflow_finished':
+            events.append(('workflow_finished', event_data.get('data', {}).get('outputs', {})))
+            break
+    return events
+
+
+def parse_new(chunks) -> list:
+    decoder = WorkflowEventDecoder()
+    events = []
+    for chunk in chunks:
+        events.extend(decoder.feed(chunk))
+        if decoder.finished:
+            break
+    return events
+
+
+def split_chunks(data: bytes, size: int) -> list[bytes]:
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+def measure(parse, chunks: list[bytes], repeats: int) -> tuple[float, list]:
+    best, events = None, None
+    for _ in range(repeats):
+        started = time.process_time()
+        events = parse(chunks)
+        elapsed = time.process_time() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best, events
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Dify SSE 事件流解析的 CPU 开销对比。")
+    parser.add_argument("--input", default=None, help="回放该 SSE 录制文件 (默认生成合成录制流)")
+    parser.add_argument("--transcript-chars", type=int, default=200000, help="合成流中回显的文字稿字符数")
+    parser.add_argument("--text-chunks", type=int, default=2000, help="合成流中的 text_chunk 事件数")
+    parser.add_argument("--chunk-sizes", type=int, nargs="+", default=[512, 16384], help="模拟的单次读取字节数")
+    parser.add_argument("--repeats", type=int, default=5, help="每种组合运行次数，取最小 CPU 时间")
+    parser.add_argument("--data-dir", default=os.path.join(ROOT, "bench_data"), help="合成数据的缓存目录")
+    args = parser.parse_args()
+
+    path = args.input or make_recorded_stream(args.transcript_chars, args.text_chunks, args.data_dir)
+    with open(path, "rb") as f:
+        data = f.read()
+    megabytes = len(data) / 1024 / 1024
+
+    implementations = [("legacy", parse_legacy, None), ("parser-json", parse_new, "json")]
+    if sse_parser.orjson is not None:
+        implementations.append(("parser-orjson", parse_new, "orjson"))
+
+    results, reference = [], None
+    for chunk_size in args.chunk_sizes:
+        chunks = split_chunks(data, chunk_size)
+        for name, parse, backend in implementations:
+            if backend is not None:
+                os.environ["SSE_JSON_BACKEND"] = backend
+            cpu, events = measure(parse, chunks, args.repeats)
+            reference = reference if reference is not None else events
+            results.append({
+                "implementation": name,
+                "chunk_size": chunk_size,
+                "cpu_ms": round(cpu * 1000, 2),
+                "cpu_ms_per_mb": round(cpu * 1000 / megabytes, 2),
+                "events": len(events),
+                "same_events_as_legacy": events == reference,
+            })
+            print(f"[{name} / {chunk_size}B] {cpu * 1000:.1f} ms ({cpu * 1000 / megabytes:.2f} ms/MB)", file=sys.stderr)
+
+    print(json.dumps({"stream": path, "stream_mb": round(megabytes, 2), "results": results},
+                     ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
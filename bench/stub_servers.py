@@ -0,0 +1,255 @@
+# bench/stub_servers.py
+"""
+OpenAI Whisper 与 Dify 工作流的本地替身 (stub)，用于离线测试批处理 CLI 等入口。
+
+- Whisper 桩: POST /v1/audio/transcriptions，返回 {"text": ...}
+- Dify 桩:    POST /v1/workflows/run，以 SSE 形式返回与真实工作流相同结构的事件；
+             POST /v1/files/upload 接收文件上传，工作流输入中可按 upload_file_id 引用
+
+可以通过“故障画像”模拟上游的不同状态：固定延迟 + 随机抖动、按概率返回 500、
+按概率或按每分钟请求数上限返回 429 (带 Retry-After)。预置画像见 PROFILES。
+
+使用方式:
+    python -m bench.stub_servers --port 8765
+
+然后把客户端指向它:
+    OPENAI_BASE_URL=http://127.0.0.1:8765/v1
+    DIFY_API_BASE=http://127.0.0.1:8765/v1
+"""
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+# 预置的故障画像，可用 --profile 选择，也可以逐项覆盖
+PROFILES = {
+    "ideal": {},
+    "typical": {"latency": 0.2, "latency_jitter": 0.1, "chunk_delay": 0.01},
+    "slow": {"latency": 1.0, "latency_jitter": 0.5, "chunk_delay": 0.05},
+    "flaky": {"latency": 0.2, "latency_jitter": 0.2, "error_rate": 0.2, "chunk_delay": 0.01},
+    "rate_limited": {"latency": 0.1, "rate_limit_rpm": 30, "retry_after": 1.0, "chunk_delay": 0.01},
+}
+
+
+class _StubHTTPServer(ThreadingHTTPServer):
+    # socketserver 默认的监听队列只有 5：大量客户端同时建连时 SYN 会被丢弃，
+    # 客户端要等 1 秒重传，测到的是桩服务器的瓶颈而不是客户端
+    request_queue_size = 256
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    # 由 make_stub_server 通过子类属性注入
+    latency = 0.0
+    latency_jitter = 0.0
+    chunk_delay = 0.0
+    num_text_chunks = 8
+    error_rate = 0.0
+    rate_limit_rate = 0.0
+    rate_limit_rpm = 0
+    retry_after = 1.0
+    state = None  # 共享的随机数发生器、请求时间窗口与计数
+
+    def log_message(self, format, *args):
+        # 桩服务器默认保持安静，避免刷屏
+        pass
+
+    def _read_body(self) -> bytes:
+        length = int(self.headers.get("Content-Length") or 0)
+        return self.rfile.read(length) if length else b""
+
+    def _send_json(self, status: int, payload: dict):
+        body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _should_rate_limit(self) -> bool:
+        state = self.state
+        with state["lock"]:
+            if self.rate_limit_rate and state["rng"].random() < self.rate_limit_rate:
+                return True
+            if self.rate_limit_rpm:
+                now = time.monotonic()
+                window = state["window"]
+                while window and now - window[0] > 60:
+                    window.pop(0)
+                if len(window) >= self.rate_limit_rpm:
+                    return True
+                window.append(now)
+        return False
+
+    def _inject_fault(self) -> bool:
+        """按画像注入 429/500，已经发送了错误响应时返回 True。"""
+        state = self.state
+        if self._should_rate_limit():
+            with state["lock"]:
+                state["counts"]["429"] += 1
+            self.send_response(429)
+            body = b'{"error": {"message": "Rate limit reached (stub)", "type": "rate_limit_error"}}'
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.send_header("Retry-After", f"{self.retry_after:g}")
+            self.end_headers()
+            self.wfile.write(body)
+            return True
+        with state["lock"]:
+            failed = self.error_rate and state["rng"].random() < self.error_rate
+            if failed:
+                state["counts"]["500"] += 1
+        if failed:
+            self._send_json(500, {"error": {"message": "Internal server error (stub)", "type": "server_error"}})
+            return True
+        return False
+
+    def do_POST(self):
+        body = self._read_body()
+        with self.state["lock"]:
+            self.state["counts"]["requests"] += 1
+            delay = self.latency + (self.state["rng"].uniform(0, self.latency_jitter) if self.latency_jitter else 0.0)
+        if delay:
+            time.sleep(delay)
+        if self._inject_fault():
+            return
+
+        if self.path.endswith("/audio/transcriptions"):
+            self._handle_transcription(body)
+        elif self.path.endswith("/workflows/run"):
+            self._handle_workflow(body)
+        elif self.path.endswith("/files/upload"):
+            self._handle_upload(body)
+        else:
+            self._send_json(404, {"error": {"message": f"未知路径: {self.path}"}})
+
+    def _handle_transcription(self, body: bytes):
+        self._send_json(200, {"text": f"这是一段长度为 {len(body)} 字节的音频的模拟转录文本。"})
+
+    def _handle_upload(self, body: bytes):
+        # 不解析 multipart，只记录大小 (近似为文件长度)
+        with self.state["lock"]:
+            file_id = f"stub-file-{len(self.state['files']) + 1}"
+            self.state["files"][file_id] = len(body)
+        self._send_json(201, {"id": file_id, "name": "transcript.txt", "size": len(body), "extension": "txt"})
+
+    def _handle_workflow(self, body: bytes):
+        try:
+            inputs = json.loads(body or b"{}").get("inputs", {})
+        except json.JSONDecodeError:
+            self._send_json(400, {"message": "请求体不是合法的 JSON"})
+            return
+
+        query = inputs.get("query", "Notes")
+        transcript_length = len(inputs.get("source_transcript", ""))
+        for value in inputs.values():
+            if isinstance(value, dict) and "upload_file_id" in value:
+                with self.state["lock"]:
+                    if value["upload_file_id"] not in self.state["files"]:
+                        self._send_json(400, {"message": "上传文件不存在"})
+                        return
+                    transcript_length = self.state["files"][value["upload_file_id"]]
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+
+        def send_event(payload: dict):
+            line = "data: " + json.dumps(payload, ensure_ascii=False) + "\n\n"
+            self.wfile.write(line.encode("utf-8"))
+            self.wfile.flush()
+
+        send_event({"event": "workflow_started", "data": {"inputs": inputs}})
+        send_event({"event": "node_started", "data": {"title": "LLM_SORT_NOTES"}})
+        send_event({
+            "event": "node_finished",
+            "data": {"title": "LLM_SORT_NOTES", "inputs": inputs, "outputs": {"text": "NOTES_STEM"}},
+        })
+        send_event({"event": "node_started", "data": {"title": "LLM"}})
+
+        chunks = [f"# {query} (stub)\n\n"]
+        chunks += [f"- 第 {i + 1} 段要点，原文长度 {transcript_length}。\n" for i in range(self.num_text_chunks)]
+        for chunk in chunks:
+            if self.chunk_delay:
+                time.sleep(self.chunk_delay)
+            send_event({"event": "text_chunk", "data": {"text": chunk}})
+
+        send_event({"event": "node_finished", "data": {"title": "LLM", "status": "succeeded"}})
+        send_event({
+            "event": "workflow_finished",
+            "data": {"status": "succeeded", "outputs": {"final_output": "".join(chunks)}},
+        })
+
+
+def make_stub_server(host: str = "127.0.0.1", port: int = 0, latency: float = 0.0,
+                     chunk_delay: float = 0.0, num_text_chunks: int = 8, latency_jitter: float = 0.0,
+                     error_rate: float = 0.0, rate_limit_rate: float = 0.0, rate_limit_rpm: int = 0,
+                     retry_after: float = 1.0, seed: int = 0) -> ThreadingHTTPServer:
+    """
+    创建 (但不启动) 一个桩服务器。port=0 时由系统分配空闲端口。
+    server.stub_counts 记录收到的请求数以及注入的 429/500 次数；server.stub_state["window"]
+    是限流用的请求时间窗口，清空即可重置限流状态。
+    """
+    state = {"lock": threading.Lock(), "rng": random.Random(seed), "window": [],
+             "counts": {"requests": 0, "429": 0, "500": 0}, "files": {}}
+    handler = type("ConfiguredStubHandler", (StubHandler,), {
+        "latency": latency,
+        "latency_jitter": latency_jitter,
+        "chunk_delay": chunk_delay,
+        "num_text_chunks": num_text_chunks,
+        "error_rate": error_rate,
+        "rate_limit_rate": rate_limit_rate,
+        "rate_limit_rpm": rate_limit_rpm,
+        "retry_after": retry_after,
+        "state": state,
+    })
+    server = _StubHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    server.stub_counts = state["counts"]
+    server.stub_state = state
+    return server
+
+
+def start_stub_server(**kwargs) -> tuple[ThreadingHTTPServer, str]:
+    """在后台线程中启动桩服务器，返回 (server, base_url)。base_url 形如 http://127.0.0.1:port/v1。"""
+    server = make_stub_server(**kwargs)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    host, port = server.server_address[:2]
+    return server, f"http://{host}:{port}/v1"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="启动本地 Whisper/Dify 桩服务器。")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=None, help="每个请求的固定延迟 (秒)")
+    parser.add_argument("--chunk-delay", type=float, default=None, help="Dify 每个 text_chunk 之间的延迟 (秒)")
+    parser.add_argument("--profile", choices=sorted(PROFILES), default="ideal", help="预置故障画像")
+    parser.add_argument("--error-rate", type=float, default=None, help="返回 500 的概率")
+    parser.add_argument("--rate-limit-rpm", type=int, default=None, help="每分钟请求数上限，超出返回 429")
+    args = parser.parse_args()
+
+    options = dict(PROFILES[args.profile])
+    for key in ("latency", "chunk_delay", "error_rate", "rate_limit_rpm"):
+        value = getattr(args, key)
+        if value is not None:
+            options[key] = value
+    server = make_stub_server(args.host, args.port, **options)
+    print(f"桩服务器已启动: http://{args.host}:{server.server_address[1]}/v1")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+# bench/synthetic_media.py
+"""
+生成基准测试用的合成输入 (完全离线)：
+- 音频: ffmpeg lavfi 正弦波 (sine)
+- 视频: ffmpeg lavfi 测试图案 (testsrc) + 正弦波音轨
+- 文本: 按固定种子生成的大体积“课堂文字稿”，含口头禅和重复句，接近真实 Whisper 输出
+
+同一参数多次生成的内容完全一致，已存在的文件直接复用。
+
+示例:
+    python -m bench.synthetic_media audio 1800 bench_data/
+    python -m bench.synthetic_media text 200000 bench_data/
+"""
+import argparse
+import os
+import random
+import shutil
+import subprocess
+
+_SENTENCES = [
+    "今天我们来讲一下梯度下降法的基本思想",
+    "首先我们回顾一下上节课讲的损失函数",
+    "这个公式大家一定要记住，考试会考",
+    "那么为什么学习率不能取得太大呢",
+    "我们可以把它理解为在山谷里一步一步往下走",
+    "接下来看一个具体的例子",
+    "So the key idea here is to follow the negative gradient",
+    "注意这里的偏导数是对每一个参数分别求的",
+    "如果数据量很大，我们通常会用随机梯度下降",
+    "好，这部分有没有同学有问题",
+]
+_FILLERS = ["嗯", "那个", "就是说", "对吧", "然后", "呃", "um", "you know"]
+
+
+def ffmpeg_available() -> bool:
+    return shutil.which("ffmpeg") is not None and shutil.which("ffprobe") is not None
+
+
+def _run_ffmpeg(args: list[str], output_path: str):
+    tmp_path = output_path + ".part" + os.path.splitext(output_path)[1]
+    command = ["ffmpeg", "-v", "error", "-y", *args, tmp_path]
+    subprocess.run(command, check=True, capture_output=True, text=True)
+    os.replace(tmp_path, output_path)
+
+
+def make_audio(duration: int, output_dir: str, frequency: int = 440) -> str:
+    """生成时长为 duration 秒的单声道 mp3 正弦波。"""
+    os.makedirs(output_dir, exist_ok=True)
+    path = os.path.join(output_dir, f"sine_{duration}s.mp3")
+    if not os.path.exists(path):
+        _run_ffmpeg(["-f", "lavfi", "-i", f"sine=frequency={frequency}:duration={duration}",
+                     "-ac", "1", "-acodec", "libmp3lame", "-q:a", "9"], path)
+    return path
+
+
+def make_video(duration: int, output_dir: str, size: str = "320x240", rate: int = 10) -> str:
+    """生成时长为 duration 秒的 mp4 测试视频 (testsrc 画面 + 正弦波音轨)。"""
+    os.makedirs(output_dir, exist_ok=True)
+    path = os.path.join(output_dir, f"testsrc_{duration}s_{size}.mp4")
+    if not os.path.exists(path):
+        _run_ffmpeg(["-f", "lavfi", "-i", f"testsrc=duration={duration}:size={size}:rate={rate}",
+                     "-f", "lavfi", "-i", f"sine=frequency=440:duration={duration}",
+                     "-shortest", "-c:v", "libx264", "-preset", "ultrafast", "-pix_fmt", "yuv420p",
+                     "-c:a", "aac", "-b:a", "32k"], path)
+    return path
+
+
+def make_text(num_chars: int, output_dir: str, seed: int = 0) -> str:
+    """生成约 num_chars 个字符的 UTF-8 文字稿。"""
+    os.makedirs(output_dir, exist_ok=True)
+    path = os.path.join(output_dir, f"transcript_{num_chars}c.txt")
+    if os.path.exists(path):
+        return path
+
+    rng = random.Random(seed)
+    parts, length = [], 0
+    previous = ""
+    while length < num_chars:
+        # 约 15% 的概率重复上一句，模拟音频块接缝处的重复
+        sentence = previous if previous and rng.random() < 0.15 else rng.choice(_SENTENCES)
+        if rng.random() < 0.4:
+            sentence = f"{rng.choice(_FILLERS)}，{sentence}"
+        piece = sentence + ("。" if rng.random() < 0.8 else "。\n\n")
+        parts.append(piece)
+        length += len(piece)
+        previous = sentence
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("".join(parts)[:num_chars])
+    return path
+
+
+def main():
+    parser = argparse.ArgumentParser(description="生成基准测试用的合成输入文件。")
+    parser.add_argument("kind", choices=["audio", "video", "text"])
+    parser.add_argument("size", type=int, help="音视频为时长 (秒)，文本为字符数")
+    parser.add_argument("output_dir")
+    args = parser.parse_args()
+
+    if args.kind in ("audio", "video") and not ffmpeg_available():
+        parser.error("未找到 ffmpeg/ffprobe，无法生成音视频文件。")
+    maker = {"audio": make_audio, "video": make_video, "text": make_text}[args.kind]
+    print(maker(args.size, args.output_dir))
+
+
+if __name__ == "__main__":
+    main()
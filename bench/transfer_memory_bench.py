@@ -0,0 +1,109 @@
+# bench/transfer_memory_bench.py
+"""
+对比两种文字稿传输方式的单任务峰值内存：
+
+- inline: 文字稿读入内存，放进 JSON 请求体提交 (默认方式)
+- file:   文字稿留在磁盘上，通过 /files/upload 流式上传后按 ID 引用
+
+每次运行都在独立子进程中执行 main_process_generator (文本输入 + 本地 Dify 桩服务器)，
+用 tracemalloc 统计 Python 堆的峰值分配，同时报告进程峰值 RSS。
+
+示例:
+    python -m bench.transfer_memory_bench --sizes 200000 2000000
+"""
+import argparse
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from bench import synthetic_media  # noqa: E402
+from bench.stub_servers import start_stub_server  # noqa: E402
+
+MODES = ("inline", "file")
+
+
+def run_child(spec: dict) -> dict:
+    import tracemalloc
+
+    from main import main_process_generator
+
+    work_dir = tempfile.mkdtemp(prefix="bench_transfer_")
+    status, error = "failed", None
+    tracemalloc.start()
+    started = time.perf_counter()
+    try:
+        generator = main_process_generator(
+            spec["input"], "sk-bench", "app-bench", os.path.join(work_dir, "result"), "Notes",
+            work_dir=work_dir, transfer_mode=spec["mode"],
+        )
+        for event_type, value, *rest in generator:
+            if event_type == "done":
+                status = "succeeded"
+            elif event_type in ("persistent_error", "error"):
+                error = (rest[0] if rest else str(value))[:500]
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        wall = time.perf_counter() - started
+        tracemalloc.stop()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    rss_scale = 1024 * 1024 if sys.platform == "darwin" else 1024
+    return {
+        "status": status,
+        "error": error,
+        "wall_seconds": round(wall, 3),
+        "tracemalloc_peak_mb": round(peak / 1024 / 1024, 2),
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / rss_scale, 2),
+    }
+
+
+def run_once(spec: dict, env: dict) -> dict:
+    proc = subprocess.run(
+        [sys.executable, "-m", "bench.transfer_memory_bench", "--child", json.dumps(spec)],
+        cwd=ROOT, env=env, capture_output=True, text=True,
+    )
+    if proc.returncode != 0:
+        return {"status": "crashed", "error": proc.stderr[-2000:]}
+    # 子进程的最后一行是结果 JSON，之前是流程中的打印信息
+    return json.loads(proc.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="文字稿传输方式 (inline / file) 的峰值内存对比。")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[200000, 2000000], help="文字稿字符数")
+    parser.add_argument("--data-dir", default=os.path.join(ROOT, "bench_data"), help="合成输入的缓存目录")
+    parser.add_argument("--child", default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(run_child(json.loads(args.child)), ensure_ascii=False))
+        return 0
+
+    stub, base_url = start_stub_server()
+    env = dict(os.environ, DIFY_API_BASE=base_url, PYTHONUNBUFFERED="1")
+    env.pop("METRICS_LOG", None)
+
+    results = []
+    for size in args.sizes:
+        input_path = synthetic_media.make_text(size, args.data_dir)
+        for mode in MODES:
+            run = run_once({"input": input_path, "mode": mode}, env)
+            results.append({"chars": size, "input_bytes": os.path.getsize(input_path), "mode": mode, **run})
+            print(f"[{size} 字符 / {mode}] {run.get('status')} tracemalloc 峰值={run.get('tracemalloc_peak_mb')}MB "
+                  f"RSS={run.get('peak_rss_mb')}MB", file=sys.stderr)
+    stub.shutdown()
+
+    print(json.dumps(results, ensure_ascii=False, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,208 @@
+# compaction.py
+"""
+文字稿压缩：在把 Whisper 文字稿提交给 Dify 之前，去掉对 LLM 没有价值的内容，
+减少输入 token，从而缩短 DeepSeek-R1 的预填充时间并降低费用。
+
+依次执行以下三步，总耗时与文字稿长度成线性关系 (20 万字在百毫秒量级)：
+1. 空白归一化：合并连续空白，去掉中文字符之间多余的空格，保留段落分隔
+2. 去除口头禅：按语言使用口头禅列表，只删除作为独立分句出现的口头禅 (如 "嗯，"、"，对吧。"、"um,")
+3. 接缝去重：只在音频块的接缝处 (各块文字稿之间的空行) 比较，
+   每段开头的 window 句与上一段结尾的 window 句比较
+   - 忽略标点、空白和大小写后完全相同的句子，直接删除
+   - 近似重复 (可选，默认关闭)：字符 k-gram 哈希集合的 Jaccard 相似度不低于阈值时，只保留较长的一句
+   同一块之内的重复不处理："对。对。" 这类有意的重复，以及只差一个词、含义不同的句子
+   ("x大于零时……" 与 "x小于零时……") 都会保留。
+
+token 数只是估算：中文字符按每字 0.6 token 计，其他非空白字符按每 4 个字符 1 token 计。
+"""
+import os
+import re
+import time
+from collections import deque
+
+DEFAULT_WINDOW = 8
+# 开启近似去重时建议的阈值；阈值过低会把只差一两个字、含义不同的句子当成重复
+DEFAULT_NEAR_DUPLICATE_THRESHOLD = 0.95
+DEFAULT_SHINGLE_SIZE = 3
+# 估算节省时间时使用的 LLM 预填充速度 (token/秒)，可用环境变量 COMPACTION_PREFILL_TPS 覆盖
+DEFAULT_PREFILL_TOKENS_PER_SECOND = 1500.0
+
+# 各语言的口头禅。只在它们单独构成一个分句时删除，避免误删正常用词 (如 "那个公式")
+DISFLUENCIES = {
+    "zh": ["嗯", "呃", "额", "啊", "哦", "唉", "那个", "这个", "就是说", "然后呢", "对吧", "是吧", "怎么说呢", "你知道吗"],
+    "en": ["um", "uh", "uhm", "erm", "hmm", "you know", "I mean"],
+}
+
+_CJK = r"㐀-䶿一-鿿豈-﫿"
+_CJK_RE = re.compile(f"[{_CJK}]")
+_WIDE_RE = re.compile(f"[{_CJK}\u3000-\u303f\uff00-\uffef]")
+_SPACE_RE = re.compile(r"\s")
+_PARAGRAPH_RE = re.compile(r"\n\s*\n")
+_SPACES_RE = re.compile(r"\s+")
+_CJK_GAP_RE = re.compile(f"(?<=[{_CJK}，。！？；：、])\\s+(?=[{_CJK}，。！？；：、])")
+_SENTENCE_RE = re.compile(r".+?(?:[。！？!?；;]+|\.(?=\s|$)|$)")
+_KEY_STRIP_RE = re.compile(r"[\W_]+")
+_disfluency_patterns = {}
+
+
+def estimate_tokens(text: str) -> int:
+    """粗略估算文本的 token 数 (不依赖具体模型的分词器)。"""
+    cjk = len(_CJK_RE.findall(text))
+    other = len(text) - cjk - len(_SPACE_RE.findall(text))
+    return round(cjk * 0.6 + other / 4)
+
+
+def _disfluency_pattern(language: str):
+    """构造 (分句开头的口头禅, 分句结尾的口头禅) 两个正则，按语言缓存。"""
+    if language not in _disfluency_patterns:
+        if language == "auto":
+            words = [w for lang_words in DISFLUENCIES.values() for w in lang_words]
+        elif language in DISFLUENCIES:
+            words = DISFLUENCIES[language]
+        else:
+            raise ValueError(f"不支持的语言: {language} (可选 auto / {' / '.join(DISFLUENCIES)})")
+        # 长的优先，避免 "那个" 只匹配到前缀；英文口头禅要求是完整单词
+        alternatives = "|".join(
+            re.escape(w) + (r"\b" if w[-1].isascii() else "")
+            for w in sorted(words, key=len, reverse=True)
+        )
+        leading = re.compile(rf"(?:^|(?<=[\s，,、。！？!?；;：:]))(?:{alternatives})[，,、]+\s*", re.I | re.M)
+        trailing = re.compile(rf"\s*[，,、]\s*(?:{alternatives})(?=\s*(?:[。！？!?；;.]|$))", re.I | re.M)
+        _disfluency_patterns[language] = (leading, trailing)
+    return _disfluency_patterns[language]
+
+
+def _join(sentences: list[str]) -> str:
+    """拼接句子：两侧都不是中文字符或全角标点时补一个空格。"""
+    parts = []
+    for sentence in sentences:
+        if parts and not _WIDE_RE.match(parts[-1][-1]) and not _WIDE_RE.match(sentence[0]):
+            parts.append(" ")
+        parts.append(sentence)
+    return "".join(parts)
+
+
+def compact_transcript(text: str, language: str = "auto", window: int = DEFAULT_WINDOW,
+                       near_duplicate_threshold: float | None = None,
+                       shingle_size: int = DEFAULT_SHINGLE_SIZE, remove_disfluencies: bool = True,
+                       prefill_tokens_per_second: float | None = None) -> tuple[str, dict]:
+    """
+    压缩文字稿，返回 (压缩后的文本, 报告)。
+
+    - language: 口头禅列表所用语言，'zh' / 'en' / 'auto' (同时使用所有列表，适合中英混杂的课堂)
+    - window: 接缝两侧参与去重的句子数；取固定值，整体复杂度保持线性
+    - near_duplicate_threshold: 判定为近似重复的 Jaccard 相似度，None (默认) 时只删除完全重复的句子。
+      开启时建议使用 DEFAULT_NEAR_DUPLICATE_THRESHOLD
+    - shingle_size: k-gram 的长度 (按去掉标点空白后的字符计)
+    - prefill_tokens_per_second: 估算节省时间用的预填充速度，默认读取 COMPACTION_PREFILL_TPS
+
+    报告包含压缩前后的字符数与估算 token 数、删除的句子和口头禅数量、
+    本次压缩耗时，以及预计节省的 LLM 预填充时间。
+    """
+    started = time.perf_counter()
+    if prefill_tokens_per_second is None:
+        prefill_tokens_per_second = float(os.getenv("COMPACTION_PREFILL_TPS") or DEFAULT_PREFILL_TOKENS_PER_SECOND)
+
+    disfluencies_removed = 0
+    leading, trailing = _disfluency_pattern(language) if remove_disfluencies else (None, None)
+    paragraphs = []
+    for raw in _PARAGRAPH_RE.split(text):
+        paragraph = _CJK_GAP_RE.sub("", _SPACES_RE.sub(" ", raw).strip())
+        if leading is not None:
+            paragraph, n_leading = leading.subn("", paragraph)
+            paragraph, n_trailing = trailing.subn("", paragraph)
+            disfluencies_removed += n_leading + n_trailing
+        if paragraph:
+            paragraphs.append(paragraph)
+
+    # kept[p] 为第 p 段保留的句子；previous_tail 为上一段结尾的 (key, shingles, 段号, 句号)
+    kept = []
+    window = max(1, window)
+    previous_tail = []
+    exact_removed = near_removed = 0
+    for p, paragraph in enumerate(paragraphs):
+        kept.append([])
+        tail = deque(maxlen=window)
+        for i, match in enumerate(_SENTENCE_RE.finditer(paragraph)):
+            sentence = match.group().strip()
+            key = _KEY_STRIP_RE.sub("", sentence).lower()
+            if not key:
+                continue
+            at_seam = i < window and previous_tail
+            if at_seam and any(key == entry[0] for entry in previous_tail):
+                exact_removed += 1
+                continue
+
+            shingles = None
+            if at_seam and near_duplicate_threshold is not None and len(key) >= 2 * shingle_size:
+                # k-gram 长度固定，对每个切片求哈希与滚动哈希同为线性，且在 CPython 中更快
+                shingles = {hash(key[i:i + shingle_size]) for i in range(len(key) - shingle_size + 1)}
+                duplicate_of = None
+                for entry in previous_tail:
+                    other = entry[1]
+                    if other is None:
+                        other = entry[1] = {hash(entry[0][i:i + shingle_size])
+                                            for i in range(len(entry[0]) - shingle_size + 1)} or None
+                        if other is None:
+                            continue
+                    if min(len(other), len(shingles)) < near_duplicate_threshold * max(len(other), len(shingles)):
+                        continue  # 集合大小相差太多，Jaccard 不可能达到阈值
+                    common = len(shingles & other)
+                    if common >= near_duplicate_threshold * (len(shingles) + len(other) - common):
+                        duplicate_of = entry
+                        break
+                if duplicate_of is not None:
+                    near_removed += 1
+                    if len(key) > len(duplicate_of[0]):
+                        # 保留信息更完整的一句 (常见于接缝处前一句被截断)
+                        kept[duplicate_of[2]][duplicate_of[3]] = sentence
+                        duplicate_of[0], duplicate_of[1] = key, shingles
+                    continue
+
+            tail.append([key, shingles, p, len(kept[p])])
+            kept[p].append(sentence)
+        previous_tail = list(tail)
+
+    compacted = "\n\n".join(_join(sentences) for sentences in kept if sentences)
+
+    tokens_before, tokens_after = estimate_tokens(text), estimate_tokens(compacted)
+    tokens_saved = tokens_before - tokens_after
+    report = {
+        "chars_before": len(text),
+        "chars_after": len(compacted),
+        "tokens_before": tokens_before,
+        "tokens_after": tokens_after,
+        "token_reduction": round(tokens_saved / tokens_before, 4) if tokens_before else 0.0,
+        "exact_duplicates_removed": exact_removed,
+        "near_duplicates_removed": near_removed,
+        "disfluencies_removed": disfluencies_removed,
+        "compaction_seconds": round(time.perf_counter() - started, 4),
+        "estimated_prefill_seconds_saved": round(tokens_saved / prefill_tokens_per_second, 2),
+    }
+    return compacted, report
+
+
+def compaction_enabled() -> bool:
+    """读取环境变量 TRANSCRIPT_COMPACTION (默认开启；0 / false / off 关闭)。"""
+    return os.getenv("TRANSCRIPT_COMPACTION", "1").strip().lower() not in ("0", "false", "off", "no")
+
+
+if __name__ == "__main__":
+    import argparse
+    import json
+
+    parser = argparse.ArgumentParser(description="压缩文字稿并输出压缩报告。")
+    parser.add_argument("input", help="UTF-8 文字稿")
+    parser.add_argument("-o", "--output", default=None, help="压缩结果的保存路径 (默认不保存)")
+    parser.add_argument("--language", default="auto", choices=["auto", *DISFLUENCIES])
+    parser.add_argument("--window", type=int, default=DEFAULT_WINDOW)
+    parser.add_argument("--threshold", type=float, default=None,
+                        help=f"开启接缝处的近似去重并使用该阈值 (建议 {DEFAULT_NEAR_DUPLICATE_THRESHOLD})，默认只删除完全重复的句子")
+    args = parser.parse_args()
+
+    with open(args.input, encoding="utf-8") as f:
+        compacted, report = compact_transcript(f.read(), args.language, args.window, args.threshold)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(compacted)
+    print(json.dumps(report, ensure_ascii=False, indent=2))
@@ -1,12 +1,33 @@
 # config.py
+"""
+配置读取。导入本模块没有副作用：.env 在第一次读取配置时才加载，
+缺少 DIFY_API_KEY 也只在任务真正需要它时才报错，而不是在 import 时。
+"""
 import os
-from dotenv import load_dotenv
 
-# 加载 .env 文件中的环境变量
-load_dotenv(override=True)
+_env_loaded = False
 
-DIFY_API_KEY = os.getenv("DIFY_API_KEY")
 
+def load_env():
+    """加载 .env 文件中的环境变量 (进程内只加载一次)。"""
+    global _env_loaded
+    if not _env_loaded:
+        from dotenv import load_dotenv
+        load_dotenv(override=True)
+        _env_loaded = True
 
-if not DIFY_API_KEY:
-    raise ValueError("错误：请在 .env 文件中设置您的 DIFY_API_KEY")
+
+def get_dify_api_key() -> str:
+    """返回 DIFY_API_KEY，未设置时抛出 ValueError。"""
+    load_env()
+    dify_api_key = os.getenv("DIFY_API_KEY")
+    if not dify_api_key:
+        raise ValueError("错误：请在 .env 文件中设置您的 DIFY_API_KEY")
+    return dify_api_key
+
+
+def __getattr__(name):
+    # 兼容旧写法 from config import DIFY_API_KEY：访问时才读取并校验
+    if name == "DIFY_API_KEY":
+        return get_dify_api_key()
+    raise AttributeError(f"module 'config' has no attribute '{name}'")
@@ -1,102 +1,489 @@
 # dify_api.py
-import requests
+"""
+Dify API 交互：文件上传、工作流的流式运行 (同步与 asyncio 两个版本) 以及事件流解码。
+requests / urllib3 只在真正发起同步请求时导入，httpx 与 asyncio 只在异步引擎中导入，
+导入本模块 (例如只读取配置) 不会加载这些库。
+"""
 import os
 import json
 import time
+import uuid
+import weakref
+from metrics import NULL_METRICS
+from sse_parser import SSEParser, find_value, loads, peek_event_type
+from utils import CircuitOpenError, compute_backoff, get_circuit_breaker, is_rate_limited, retry, retry_after_seconds, retry_async
 
-def run_workflow_streaming(input_text: str, query: str, user: str, dify_api_key: str, max_retries=3, delay=3):
+# Dify API 的基础地址。可通过环境变量 DIFY_API_BASE 指向自建实例或本地测试桩。
+DEFAULT_DIFY_API_BASE = "https://api.dify.ai/v1"
+
+# 单次退避的上限 (秒)，以及连接超时 (秒)
+MAX_RETRY_DELAY = 30
+CONNECT_TIMEOUT = 10
+
+# 文字稿的传输方式 (环境变量 DIFY_TRANSFER_MODE)：
+#   inline - 文字稿直接放在工作流输入的 source_transcript 中 (默认)
+#   file   - 先通过 /files/upload 上传，再在工作流的文件类型输入变量中按 ID 引用；
+#            文件变量名默认 source_file，可用环境变量 DIFY_FILE_VARIABLE 修改
+TRANSFER_MODES = ("inline", "file")
+DEFAULT_FILE_VARIABLE = "source_file"
+
+# 上传文件时每次读取的字节数，以及读取 SSE 响应时单次读取的上限
+UPLOAD_CHUNK_SIZE = 64 * 1024
+STREAM_READ_SIZE = 64 * 1024
+
+# 每个事件循环共用的 httpx.AsyncClient，见 get_async_client
+_async_clients = weakref.WeakKeyDictionary()
+
+
+class DifyRequestError(Exception):
+    """Dify 返回了重试也无法解决的错误 (如 Key 无效、文件类型不被接受)。"""
+
+
+def get_dify_api_base() -> str:
+    """返回当前生效的 Dify API 基础地址 (每次调用时读取环境变量)。"""
+    return os.getenv("DIFY_API_BASE", DEFAULT_DIFY_API_BASE).rstrip('/')
+
+def get_transfer_mode() -> str:
+    """返回当前生效的文字稿传输方式 (inline / file)。"""
+    mode = os.getenv("DIFY_TRANSFER_MODE", "inline").strip().lower()
+    if mode not in TRANSFER_MODES:
+        raise ValueError(f"未知的 DIFY_TRANSFER_MODE: {mode} (可选 {' / '.join(TRANSFER_MODES)})")
+    return mode
+
+def get_file_variable() -> str:
+    """返回工作流中引用上传文件的输入变量名。"""
+    return os.getenv("DIFY_FILE_VARIABLE", DEFAULT_FILE_VARIABLE)
+
+def _is_retryable(error: Exception) -> bool:
     """
-    (生成器版本) 运行Dify工作流并以事件流的形式产出结果。
-    - 包含重试逻辑，用于处理网络请求错误。
-    - 产出事件: ('text_chunk', 数据), ('workflow_finished', 最终输出), ('node_started', 节点标题), ('error', 错误信息)
-    - 新增产出事件: ('classification_result', 分类结果)
+    网络错误、超时、408/429 和 5xx 值得重试；其余 4xx (如 Key 无效) 重试也不会成功。
+    requests 与 httpx 的异常都适用。
     """
-    workflow_url = "https://api.dify.ai/v1/workflows/run"
+    if getattr(error, "response", None) is None:
+        return True
+    status = error.response.status_code
+    return status in (408, 429) or status >= 500
+
+class _MultipartFileBody:
+    """
+    流式的 multipart/form-data 请求体：按块读取文件，并提前算好 Content-Length，
+    上传大文件时不必把整个文件读入内存。可重复迭代，重试时重新从磁盘读取。
+    """
+
+    def __init__(self, path: str, fields: dict, file_field: str, filename: str, content_type: str):
+        self.path = path
+        boundary = uuid.uuid4().hex
+        self.content_type = f"multipart/form-data; boundary={boundary}"
+        head = [f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'
+                for name, value in fields.items()]
+        head.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{file_field}"; filename="{filename}"\r\n'
+                    f'Content-Type: {content_type}\r\n\r\n')
+        self._head = "".join(head).encode('utf-8')
+        self._tail = f"\r\n--{boundary}--\r\n".encode('utf-8')
+        self._file_size = os.path.getsize(path)
+
+    def __len__(self):
+        return len(self._head) + self._file_size + len(self._tail)
+
+    def __iter__(self):
+        yield self._head
+        with open(self.path, 'rb') as f:
+            while chunk := f.read(UPLOAD_CHUNK_SIZE):
+                yield chunk
+        yield self._tail
+
+    async def aiter_chunks(self):
+        """供 httpx.AsyncClient 使用的异步迭代。每块只有 64KB，从本地磁盘读取不会明显阻塞事件循环。"""
+        for chunk in self:
+            yield chunk
+
+def upload_file(file_path: str, user: str, dify_api_key: str, metrics=None, deadline=None) -> str:
+    """
+    通过 Dify 的 POST /files/upload 上传一个 UTF-8 文本文件，返回 upload_file_id。
+    - 文件按块从磁盘读取并流式发送，不会整体读入内存
+    - 网络错误、408/429 和 5xx 会按 utils.retry 的策略退避重试 (共享 'dify' 熔断器，遵循 deadline)；
+      其余错误抛出 DifyRequestError
+    """
+    import requests
+    upload = retry(max_retries=3, delay=3, max_delay=MAX_RETRY_DELAY, allowed_exceptions=(requests.exceptions.RequestException,),
+                   upstream="dify")(_upload_file_once)
+    return upload(file_path, user, dify_api_key, metrics=metrics, deadline=deadline)
+
+def _upload_file_once(file_path: str, user: str, dify_api_key: str, metrics=None, deadline=None) -> str:
+    import requests
+    metrics = metrics or NULL_METRICS
+    body = _MultipartFileBody(file_path, {"user": user}, "file", "transcript.txt", "text/plain")
     headers = {
+        "Authorization": f"Bearer {dify_api_key}",
+        "Content-Type": body.content_type,
+    }
+    remaining = deadline.remaining() if deadline is not None else None
+    try:
+        with metrics.span("dify.upload", bytes=len(body)):
+            metrics.add("dify.bytes_out", len(body))
+            response = requests.post(f"{get_dify_api_base()}/files/upload", headers=headers, data=body,
+                                     timeout=(CONNECT_TIMEOUT, max(1.0, remaining) if remaining is not None else None))
+            response.raise_for_status()
+    except requests.exceptions.RequestException as e:
+        if _is_retryable(e):
+            raise
+        raise DifyRequestError(f"上传文件到 Dify 失败: {e}\n服务器响应: {e.response.text}") from e
+
+    try:
+        return response.json()["id"]
+    except (ValueError, KeyError) as e:
+        raise DifyRequestError(f"无法解析 Dify 文件上传接口的响应: {response.text[:500]}") from e
+
+class WorkflowEventDecoder:
+    """
+    把 Dify 工作流的 SSE 字节流转换为 run_workflow_streaming 产出的事件。
+    不涉及网络 I/O，只需把收到的字节块依次交给 feed()，同步与异步客户端可以共用。
+
+    - 只处理下面 HANDLED_EVENTS 中的事件类型，其余事件 (如回显全部输入的 workflow_started) 不做 JSON 解析
+    - node_started / node_finished 只解码 title、status、elapsed_time 等少数字段；
+      只有分类节点 LLM_SORT_NOTES 才额外解码 outputs
+    - 收到 workflow_finished 或 error 后 finished 变为 True，之后的数据被忽略
+    - query 为该工作流的生成类型，节点时间线按它区分，并发的多个工作流共用一个 JobMetrics 时互不覆盖
+    """
+
+    HANDLED_EVENTS = frozenset({"node_started", "node_finished", "text_chunk", "workflow_finished", "error"})
+
+    def __init__(self, metrics=None, request_started: float | None = None, query: str | None = None):
+        self.metrics = metrics or NULL_METRICS
+        self.query = query
+        self.request_started = self.metrics.now() if request_started is None else request_started
+        self.finished = False
+        self._parser = SSEParser()
+
+    def feed(self, chunk: bytes) -> list:
+        self.metrics.add("dify.bytes_in", len(chunk))
+        events = []
+        for sse in self._parser.feed(chunk):
+            if self.finished:
+                break
+            events.extend(self._handle(sse.data))
+        return events
+
+    def _handle(self, payload: bytes) -> list:
+        if not payload.strip():
+            return []
+        event_data = None
+        event = peek_event_type(payload)
+        try:
+            if event is None:
+                event_data = loads(payload)
+                event = event_data.get('event')
+            if event not in self.HANDLED_EVENTS:
+                return []
+
+            if event == 'node_started':
+                node_title = find_value(payload, 'title') or '未知节点'
+                self.metrics.dify_node_started(node_title, self.query)
+                return [('node_started', node_title)]
+
+            if event == 'node_finished':
+                node_title = find_value(payload, 'title')
+                self.metrics.dify_node_finished(node_title or '未知节点', find_value(payload, 'status', last=True),
+                                                find_value(payload, 'elapsed_time', last=True), self.query)
+                if node_title == 'LLM_SORT_NOTES':
+                    outputs = find_value(payload, 'outputs', last=True) or {}
+                    classification = outputs.get('text')
+                    if classification:
+                        return [('classification_result', classification.strip())]
+                return []
+
+            event_data = event_data or loads(payload)
+            if event == 'text_chunk':
+                text_chunk = event_data.get('data', {}).get('text', '')
+                self.metrics.set_once('dify_ttft_seconds', round(self.metrics.now() - self.request_started, 4))
+                return [('text_chunk', text_chunk)]
+
+            self.finished = True
+            if event == 'workflow_finished':
+                # 当工作流成功结束时，返回其最终输出的 payload，而不仅仅是 None。这对于捕获安全审查结果至关重要。
+                data = event_data.get('data', {})
+                if data.get('status') == 'succeeded':
+                    return [('workflow_finished', data.get('outputs', {}))]
+                return [('error', f"Dify 工作流失败: {data.get('error', '未知工作流错误')}")]
+            return [('error', f"Dify API 返回错误: {event_data.get('message', '未知API错误')}")]
+
+        except (ValueError, AttributeError):
+            return [('error', f"无法解析从Dify API收到的数据行: {payload[:500].decode('utf-8', 'replace')}")]
+
+def _iter_response_chunks(response):
+    """逐块读取流式响应，有数据到达就立即返回，不等凑满固定长度。"""
+    import requests
+    from urllib3.exceptions import DecodeError, ProtocolError, ReadTimeoutError
+    read1 = getattr(response.raw, "read1", None)
+    if read1 is None:  # urllib3 < 2.1 没有 read1
+        yield from response.iter_content(chunk_size=512)
+        return
+    # 与 requests 的 iter_content 一样，把 urllib3 的异常转换为 requests 的异常，以便按网络错误重试
+    try:
+        while chunk := read1(STREAM_READ_SIZE, decode_content=True):
+            yield chunk
+    except ProtocolError as e:
+        raise requests.exceptions.ChunkedEncodingError(e)
+    except DecodeError as e:
+        raise requests.exceptions.ContentDecodingError(e)
+    except ReadTimeoutError as e:
+        raise requests.exceptions.ConnectionError(e)
+
+def _workflow_headers(dify_api_key: str) -> dict:
+    return {
         "Authorization": f"Bearer {dify_api_key}",
         "Content-Type": "application/json"
     }
-    data = {
-        "inputs": {
+
+def _workflow_body(input_text: str | None, query: str, user: str, upload_file_id: str | None, file_variable: str | None) -> bytes:
+    """构造 /workflows/run 的 JSON 请求体 (已编码为 bytes)。"""
+    if upload_file_id is not None:
+        inputs = {
+            file_variable or get_file_variable(): {
+                "type": "document",
+                "transfer_method": "local_file",
+                "upload_file_id": upload_file_id,
+            },
+            "query": query
+        }
+    else:
+        inputs = {
             "source_transcript": input_text,
             "query": query
-        },
+        }
+    data = {
+        "inputs": inputs,
         "response_mode": "streaming",
         "user": user,
     }
+    return json.dumps(data).encode('utf-8')
+
+def _after_request_error(e: Exception, attempts: int, max_retries: int, delay: float, breaker, deadline, metrics):
+    """
+    处理一次失败的工作流请求 (requests 或 httpx 的异常)，同步与异步版本共用。
+    返回 (错误信息, None) 表示放弃；返回 (None, 等待秒数) 表示应在等待后重试。
+    """
+    error_details = f"请求Dify API失败: {e}"
+    response = getattr(e, "response", None)
+    if response is not None:
+        error_details += f"\n状态码: {response.status_code}\n服务器响应: {response.text}"
+
+    if not _is_retryable(e):
+        breaker.record_neutral()
+        return error_details, None
+    if is_rate_limited(e):
+        breaker.record_neutral()
+    else:
+        breaker.record_failure()
+
+    if attempts >= max_retries:
+        return f"Dify API 请求在 {max_retries} 次尝试后仍然失败。最终错误: {error_details}", None
+
+    hint = retry_after_seconds(e)
+    if hint is not None and hint > MAX_RETRY_DELAY:
+        return f"Dify API 要求等待 {hint:.0f} 秒后再重试，超过了 {MAX_RETRY_DELAY:.0f} 秒的重试等待上限。最终错误: {error_details}", None
+    wait = compute_backoff(attempts, delay, MAX_RETRY_DELAY, hint=hint)
+    remaining = deadline.remaining() if deadline is not None else None
+    if remaining is not None and wait >= remaining:
+        return f"Dify API 请求失败，且剩余的任务时间预算不足以再次重试。最终错误: {error_details}", None
+
+    metrics.add("retries.run_workflow_streaming")
+    print(f"{error_details}\n将在 {wait:.1f} 秒后重试...")
+    return None, wait
 
+def run_workflow_streaming(input_text: str | None, query: str, user: str, dify_api_key: str, max_retries=3, delay=3, metrics=None, deadline=None, upload_file_id: str | None = None, file_variable: str | None = None):
+    """
+    (生成器版本) 运行Dify工作流并以事件流的形式产出结果。
+    - 包含重试逻辑，用于处理网络请求错误：指数退避 + 随机抖动，遵循服务器的 Retry-After，
+      不超过 deadline (utils.Deadline) 给出的任务时间预算；Dify 持续故障时由共享熔断器快速失败。
+    - 产出事件: ('text_chunk', 数据), ('workflow_finished', 最终输出), ('node_started', 节点标题), ('error', 错误信息)
+    - 新增产出事件: ('classification_result', 分类结果)
+    - metrics: 可选的 JobMetrics，记录请求/流式阶段耗时、收发字节数、重试次数、节点时间线和首字延迟。
+    - upload_file_id: 已通过 upload_file 上传的文字稿。指定后 input_text 被忽略，工作流输入中只引用
+      该文件 (变量名 file_variable，默认见 get_file_variable)，请求体很小，重试时也不会重复上传。
+    """
+    import requests
+    metrics = metrics or NULL_METRICS
+    workflow_url = f"{get_dify_api_base()}/workflows/run"
+    headers = _workflow_headers(dify_api_key)
+    # 只序列化一次，重试时复用同一个请求体
+    body = _workflow_body(input_text, query, user, upload_file_id, file_variable)
+
+    breaker = get_circuit_breaker("dify")
     attempts = 0
     while attempts < max_retries:
         try:
-            print(f"正在连接到 Dify 工作流 (流式模式)... 尝试次数 {attempts + 1}/{max_retries}")
-            response = requests.post(workflow_url, headers=headers, json=data, stream=True)
-            response.raise_for_status()
+            remaining = deadline.remaining() if deadline is not None else None
+            if remaining is not None and remaining <= 0:
+                yield 'error', "Dify 工作流未能在任务时间预算内完成，已停止重试。"
+                return
+            breaker.before_call()
 
-            for line in response.iter_lines():
-                if not line:
-                    continue
-
-                decoded_line = line.decode('utf-8')
-                if not decoded_line.startswith('data:'):
-                    continue
-
-                json_str = decoded_line[len('data:'):].strip()
-                try:
-                    event_data = json.loads(json_str)
-                    event = event_data.get('event')
-
-                    if event == 'node_started':
-                        node_data = event_data.get('data', {})
-                        node_title = node_data.get('title', '未知节点')
-                        yield 'node_started', node_title
-                    
-                    elif event == 'node_finished':
-                        node_data = event_data.get('data', {})
-                        node_title = node_data.get('title')
-                        if node_title == 'LLM_SORT_NOTES':
-                            outputs = node_data.get('outputs', {})
-                            classification = outputs.get('text')
-                            if classification:
-                                yield 'classification_result', classification.strip()
-
-                    elif event == 'text_chunk':
-                        text_chunk = event_data.get('data', {}).get('text', '')
-                        yield 'text_chunk', text_chunk
-                    elif event == 'workflow_finished':
-                        # --- START of MODIFICATION ---
-                        # (已修改) 当工作流成功结束时，返回其最终输出的 payload，
-                        # 而不仅仅是 None。这对于捕获安全审查结果至关重要。
-                        data = event_data.get('data', {})
-                        if data.get('status') == 'succeeded':
-                            yield 'workflow_finished', data.get('outputs', {})
-                        else:
-                            error_msg = data.get('error', '未知工作流错误')
-                            yield 'error', f"Dify 工作流失败: {error_msg}"
-                        return
-                        # --- END of MODIFICATION ---
-                    elif event == 'error':
-                        yield 'error', f"Dify API 返回错误: {event_data.get('message', '未知API错误')}"
-                        return
+            print(f"正在连接到 Dify 工作流 (流式模式)... 尝试次数 {attempts + 1}/{max_retries}")
+            request_started = metrics.now()
+            with metrics.span("dify.request", attempt=attempts + 1, query=query):
+                metrics.add("dify.bytes_out", len(body))
+                response = requests.post(workflow_url, headers=headers, data=body, stream=True,
+                                         timeout=(CONNECT_TIMEOUT, max(1.0, remaining) if remaining is not None else None))
+                response.raise_for_status()
+            breaker.record_success()
 
-                except json.JSONDecodeError:
-                    yield 'error', f"无法解析从Dify API收到的数据行: {json_str}"
-                    continue
+            decoder = WorkflowEventDecoder(metrics, request_started, query)
+            for chunk in _iter_response_chunks(response):
+                for event in decoder.feed(chunk):
+                    yield event
+                if decoder.finished:
+                    return
             
             return
 
+        except CircuitOpenError as e:
+            yield 'error', str(e)
+            return
+
         except requests.exceptions.RequestException as e:
             attempts += 1
-            error_details = f"请求Dify API失败: {e}"
-            if e.response is not None:
-                error_details += f"\n状态码: {e.response.status_code}\n服务器响应: {e.response.text}"
-            
-            if attempts >= max_retries:
-                yield 'error', f"Dify API 请求在 {max_retries} 次尝试后仍然失败。最终错误: {error_details}"
+            error_message, wait = _after_request_error(e, attempts, max_retries, delay, breaker, deadline, metrics)
+            if error_message is not None:
+                yield 'error', error_message
                 return
-            
-            print(f"{error_details}\n将在 {delay} 秒后重试...")
-            time.sleep(delay)
+            time.sleep(wait)
         
         except Exception as e:
+            # 未知错误不说明 Dify 是否健康，但要交还半开状态下可能占用的探测名额
+            breaker.record_neutral()
             yield 'error', f"运行工作流时发生未知错误: {e}"
-            return
\ No newline at end of file
+            return
+
+def get_async_client():
+    """
+    返回当前事件循环共用的 httpx.AsyncClient (首次调用时创建)。
+    创建客户端需要加载 CA 证书 (约 40 毫秒 CPU)，并发任务多时每个任务各建一个会阻塞事件循环；
+    共用一个客户端还能在任务之间复用连接。httpx 只在这里导入：同步流程不需要它。
+    """
+    import asyncio
+    import httpx
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None:
+        # 并发的工作流数量已由各任务的 max_parallel_queries 限制，这里不再限制连接数
+        client = _async_clients[loop] = httpx.AsyncClient(
+            timeout=httpx.Timeout(None, connect=CONNECT_TIMEOUT),
+            limits=httpx.Limits(max_connections=None, max_keepalive_connections=20),
+        )
+    return client
+
+def _async_timeout(deadline):
+    import httpx
+    remaining = deadline.remaining() if deadline is not None else None
+    return httpx.Timeout(max(1.0, remaining) if remaining is not None else None, connect=CONNECT_TIMEOUT)
+
+async def _aiter_slices(data: bytes, size: int):
+    view = memoryview(data)
+    for start in range(0, len(data), size):
+        yield view[start:start + size]
+
+async def _upload_file_once_async(file_path: str, user: str, dify_api_key: str, client, metrics=None, deadline=None) -> str:
+    import httpx
+    metrics = metrics or NULL_METRICS
+    body = _MultipartFileBody(file_path, {"user": user}, "file", "transcript.txt", "text/plain")
+    headers = {
+        "Authorization": f"Bearer {dify_api_key}",
+        "Content-Type": body.content_type,
+        "Content-Length": str(len(body)),
+    }
+    try:
+        with metrics.span("dify.upload", bytes=len(body)):
+            metrics.add("dify.bytes_out", len(body))
+            response = await client.post(f"{get_dify_api_base()}/files/upload", headers=headers, content=body.aiter_chunks(),
+                                         timeout=_async_timeout(deadline))
+            response.raise_for_status()
+    except httpx.HTTPStatusError as e:
+        if _is_retryable(e):
+            raise
+        raise DifyRequestError(f"上传文件到 Dify 失败: {e}\n服务器响应: {e.response.text}") from e
+
+    try:
+        return response.json()["id"]
+    except (ValueError, KeyError) as e:
+        raise DifyRequestError(f"无法解析 Dify 文件上传接口的响应: {response.text[:500]}") from e
+
+async def upload_file_async(file_path: str, user: str, dify_api_key: str, client, metrics=None, deadline=None) -> str:
+    """
+    upload_file 的异步版本，client 为 httpx.AsyncClient (通常是 get_async_client 的返回值)。
+    重试策略相同，等待使用 asyncio.sleep，不阻塞事件循环。
+    """
+    import httpx
+    upload = retry_async(max_retries=3, delay=3, max_delay=MAX_RETRY_DELAY, allowed_exceptions=(httpx.HTTPError,),
+                         upstream="dify")(_upload_file_once_async)
+    return await upload(file_path, user, dify_api_key, client, metrics=metrics, deadline=deadline)
+
+async def run_workflow_streaming_async(input_text: str | None, query: str, user: str, dify_api_key: str, client, max_retries=3, delay=3, metrics=None, deadline=None, upload_file_id: str | None = None, file_variable: str | None = None):
+    """
+    (异步生成器版本) 与 run_workflow_streaming 的参数、产出事件、重试与熔断策略完全相同，
+    区别只在于使用 httpx.AsyncClient (client) 发送请求，重试前用 asyncio.sleep 等待。
+    """
+    import asyncio
+    import httpx
+    metrics = metrics or NULL_METRICS
+    workflow_url = f"{get_dify_api_base()}/workflows/run"
+    headers = _workflow_headers(dify_api_key)
+    body = _workflow_body(input_text, query, user, upload_file_id, file_variable)
+
+    breaker = get_circuit_breaker("dify")
+    attempts = 0
+    while attempts < max_retries:
+        try:
+            remaining = deadline.remaining() if deadline is not None else None
+            if remaining is not None and remaining <= 0:
+                yield 'error', "Dify 工作流未能在任务时间预算内完成，已停止重试。"
+                return
+            breaker.before_call()
+
+            print(f"正在连接到 Dify 工作流 (流式模式)... 尝试次数 {attempts + 1}/{max_retries}")
+            request_started = metrics.now()
+            with metrics.span("dify.request", attempt=attempts + 1, query=query):
+                metrics.add("dify.bytes_out", len(body))
+                # 分片发送：传输层的写缓冲区每次只需容纳一片，而不是整个请求体的副本
+                request = client.build_request("POST", workflow_url, headers={**headers, "Content-Length": str(len(body))},
+                                               content=_aiter_slices(body, UPLOAD_CHUNK_SIZE), timeout=_async_timeout(deadline))
+                response = await client.send(request, stream=True)
+            try:
+                if response.is_error:
+                    await response.aread()  # 错误信息中需要服务器响应
+                response.raise_for_status()
+                breaker.record_success()
+
+                decoder = WorkflowEventDecoder(metrics, request_started, query)
+                # 不指定 chunk_size：httpx 会攒满 chunk_size 才交出数据，拖慢首字延迟
+                async for chunk in response.aiter_bytes():
+                    for event in decoder.feed(chunk):
+                        yield event
+                    if decoder.finished:
+                        return
+            finally:
+                await response.aclose()
+
+            return
+
+        except CircuitOpenError as e:
+            yield 'error', str(e)
+            return
+
+        except httpx.HTTPError as e:
+            attempts += 1
+            error_message, wait = _after_request_error(e, attempts, max_retries, delay, breaker, deadline, metrics)
+            if error_message is not None:
+                yield 'error', error_message
+                return
+            await asyncio.sleep(wait)
+
+        except Exception as e:
+            breaker.record_neutral()
+            yield 'error', f"运行工作流时发生未知错误: {e}"
+            return
+
+        except BaseException:
+            # 任务被取消 (客户端断开、页面重新运行、生成器被关闭)：交还半开状态下可能占用的探测名额
+            breaker.record_neutral()
+            raise
@@ -3,114 +3,546 @@ import concurrent.futures
 import time
 import os
 import sys
+import queue
 import shutil
-from openai import AuthenticationError
+import threading
 from video_processor.splitter import split_media_to_audio_chunks_generator
-from video_processor.transcriber import transcribe_single_audio_chunk
-from dify_api import run_workflow_streaming
+from video_processor.scheduler import get_scheduler
+from video_processor.backends import backend_name, get_backend
+from dify_api import get_transfer_mode, run_workflow_streaming, upload_file
+from compaction import compact_transcript, compaction_enabled
+from metrics import JobMetrics, REGISTRY, write_summary_log
+from utils import CircuitOpenError, Deadline, DeadlineExceeded
 
-def main_process_generator(input_path: str, openai_api_key: str, dify_api_key: str, output_filename: str, query: str):
+# 每个音频块的时长 (秒)
+CHUNK_DURATION = 600
+
+# 同时生成多种内容时，并发运行的 Dify 工作流数量上限
+DEFAULT_MAX_PARALLEL_QUERIES = 3
+
+# 处理引擎：threads (线程池) / async (asyncio)，未显式指定 engine 时读取环境变量 PIPELINE_ENGINE
+ENGINES = ("threads", "async")
+PIPELINE_ENGINE_ENV = "PIPELINE_ENGINE"
+
+# 未显式指定 time_budget 时，从该环境变量读取单个任务的时间预算 (秒)
+JOB_TIME_BUDGET_ENV = "JOB_TIME_BUDGET"
+
+# 部分音频块转录失败时的提示
+INCOMPLETE_TRANSCRIPT_MESSAGE = "**音频转录不完整**\n\n部分音频块在多次尝试后仍然转录失败。为确保笔记的完整性，处理已中止。"
+
+# 支持的输入文件类型 (小写扩展名，包含点号)
+VIDEO_EXTS = {'.mp4', '.mov', '.mpeg', '.webm'}
+AUDIO_EXTS = {'.mp3', '.m4a', '.wav', '.amr', '.mpga'}
+TEXT_EXTS = {'.txt', '.md', '.mdx', '.markdown', '.pdf', '.html', '.xlsx', '.xls', '.doc', '.docx', '.csv', '.eml', '.msg', '.pptx', '.ppt', '.xml', '.epub'}
+
+def main_process_generator(input_path: str, openai_api_key: str, dify_api_key: str, output_filename: str, query, work_dir: str | None = None, metrics_log: str | None = None, time_budget: float | None = None, max_parallel_queries: int = DEFAULT_MAX_PARALLEL_QUERIES, compaction: bool | None = None, transfer_mode: str | None = None, engine: str | None = None, transcription_backend=None, transcript: str | None = None):
     """
     (更新版) 一个生成器函数，执行处理流程并实时产出状态、进度和LLM文本块。
     - 新增了对持久性错误的捕护和处理，并提供对用户友好的错误日志。
     - (已修改) 适配包含安全审查的新版 Dify 工作流。
+    - work_dir: 可选的任务工作目录。指定后音频块和文字稿都写在该目录下，
+      便于多个任务并发运行而互不覆盖；不指定时沿用当前目录 (Web 应用的行为)。
+    - 流程结束后 (无论成功与否) 额外产出 ('job_summary', 指标摘要)，其中包含各阶段耗时、
+      收发字节数、重试次数、Dify 节点时间线和首字延迟；摘要同时写入 metrics_log
+      (未指定时读取环境变量 METRICS_LOG) 指向的 JSONL 文件。
+    - time_budget: 可选的任务时间预算 (秒，未指定时读取环境变量 JOB_TIME_BUDGET)。
+      Whisper 与 Dify 的重试不会超出该预算，注定失败的任务会尽早结束。
+    - query: 单个生成类型 (如 'Notes')，或多个生成类型 (如 ['Notes', 'Quiz'])。
+      多个时只切分、转录一次，然后最多 max_parallel_queries 个 Dify 工作流并发运行：
+      llm_chunk / display_classification 事件的第三个元素为所属的 query，
+      每个 query 完成时产出 ('query_done', 保存路径, query)，失败时产出 ('query_error', 错误信息, query)，
+      结果分别保存为 '{output_filename}_{query}.md'，'done' 的值为 {query: 保存路径}。
+      单个 query 时结果仍保存为 '{output_filename}.md'，'done' 的值为保存路径。
+    - compaction: 是否在提交 Dify 前压缩转录得到的文字稿 (去口头禅、去重复句，见 compaction.py)，
+      未指定时读取环境变量 TRANSCRIPT_COMPACTION (默认开启)。只作用于音视频转录结果，
+      用户上传的文本文档原样提交；保存的 source_transcript.txt 也始终是未压缩的原文。
+    - transfer_mode: 文字稿提交给 Dify 的方式，'inline' 或 'file' (未指定时读取环境变量 DIFY_TRANSFER_MODE，
+      默认 inline)。file 模式下文字稿只在工作目录落盘一次，通过 Dify 文件上传接口流式上传后在工作流
+      输入中按 ID 引用；多个 query 与所有重试共用同一个上传文件，内存中也不再保留全文和 JSON 请求体。
+    - engine: 处理引擎，'threads' 或 'async' (未指定时读取环境变量 PIPELINE_ENGINE，默认 threads)。
+      threads 为原有的线程池实现；async 在进程内共享的后台事件循环中运行 async_pipeline 的 asyncio 流程
+      (ffmpeg 作为 asyncio 子进程、Whisper/Dify 使用异步 HTTP 客户端)，产出的事件完全相同。
+      在 asyncio 程序中可直接使用 async_pipeline.main_process_async。
+    - transcription_backend: 音视频的转录后端，'openai' (Whisper API)、'stub' (模拟转录) 或 'local'
+      (本地 faster-whisper 模型)，也可以直接传入 video_processor.backends 中的后端实例；
+      未指定时读取环境变量 TRANSCRIPTION_BACKEND (默认 openai)。只有 openai 后端需要 openai_api_key。
+    - transcript: 可选，input_path 预先转录好的完整文字稿 (例如 transcribe_media_generator 的结果)。
+      只对音视频输入有效：指定后跳过切分与转录，直接压缩并提交 Dify。
     """
-    output_dir = "output_chunks"
-    final_notes_save_path = f"{output_filename}.md"
-    
-    video_exts = {'.mp4', '.mov', '.mpeg', '.webm'}
-    audio_exts = {'.mp3', '.m4a', '.wav', '.amr', '.mpga'}
-    text_exts = {'.txt', '.md', '.mdx', '.markdown', '.pdf', '.html', '.xlsx', '.xls', '.doc', '.docx', '.csv', '.eml', '.msg', '.pptx', '.ppt', '.xml', '.epub'}
+    if engine is None:
+        engine = os.getenv(PIPELINE_ENGINE_ENV, "threads").strip().lower()
+    if engine not in ENGINES:
+        raise ValueError(f"未知的处理引擎: {engine} (可选 {' / '.join(ENGINES)})")
+    backend_name(transcription_backend)  # 名称无效时立即报错；后端本身在需要转录时才创建
+    queries, compaction, transfer_mode, deadline, metrics = _prepare_job(input_path, query, time_budget, compaction, transfer_mode)
+    single = isinstance(query, str)
+    if engine == "async":
+        # 在进程内共享的后台事件循环中运行 asyncio 流程，本生成器只负责转发事件
+        from async_pipeline import iter_async, run_pipeline_async
+        pipeline = iter_async(run_pipeline_async(input_path, openai_api_key, dify_api_key, output_filename, queries, single,
+                                                 max_parallel_queries, compaction, transfer_mode, work_dir, metrics, deadline,
+                                                 transcription_backend, transcript))
+    else:
+        pipeline = _run_pipeline(input_path, openai_api_key, dify_api_key, output_filename, queries,
+                                 single, max_parallel_queries, compaction, transfer_mode, work_dir, metrics, deadline,
+                                 transcription_backend, transcript)
+    REGISTRY.job_started()
+    status = "failed"
+    try:
+        for event in pipeline:
+            if event[0] == "done":
+                status = "succeeded"
+            yield event
+    finally:
+        # 调用方提前关闭生成器时同样会记录摘要
+        pipeline.close()
+        summary = metrics.summary(status)
+        REGISTRY.observe_job(summary)
+        write_summary_log(summary, metrics_log)
+    yield "job_summary", summary
+
 
+def transcribe_media_generator(input_path: str, openai_api_key: str, work_dir: str | None = None,
+                               transcription_backend=None, time_budget: float | None = None):
+    """
+    只运行音视频的切分与转录阶段，不提交 Dify。产出与 main_process_generator 前两个步骤相同的进度事件，
+    成功时最后产出 ('transcript', 完整文字稿)，失败时产出 persistent_error / error。
+    得到的文字稿交给 main_process_generator(..., transcript=...) 即可只运行 Dify 阶段。
+    """
     file_ext = os.path.splitext(input_path)[1].lower()
-    current_progress = 0
-    full_transcript = ""
+    if file_ext not in VIDEO_EXTS and file_ext not in AUDIO_EXTS:
+        yield "error", 0, _unsupported_type_message(file_ext)
+        return
+    backend_name(transcription_backend)
+    output_dir = os.path.join(work_dir, "output_chunks") if work_dir else "output_chunks"
+    metrics = JobMetrics(input_path=input_path)
+    transcript = yield from _transcribe_media(input_path, openai_api_key, output_dir, file_ext in VIDEO_EXTS,
+                                              metrics, Deadline(time_budget), transcription_backend)
+    if transcript is not None:
+        yield "transcript", transcript
 
-    # --- START of MODIFICATION ---
-    # (已重写) 重写此辅助函数以处理新的安全审查逻辑和更复杂的工作流分支
-    def run_dify_and_yield_results():
-        """辅助生成器：运行Dify工作流并处理事件（已适配安全审查流程）。"""
-        final_llm_output_chunks = []
-        final_outputs = None  # 用于捕获工作流结束时的最终输出
 
-        dify_generator = run_workflow_streaming(
-            input_text=full_transcript,
-            query=query,
-            user="streamlit_user",
-            dify_api_key=dify_api_key
-        )
-        
-        for event_type, data in dify_generator:
-            if event_type == "text_chunk":
-                final_llm_output_chunks.append(data)
-                yield "llm_chunk", data
-            
-            elif event_type == "classification_result":
-                category_map = {
-                    "NOTES_STEM": "这是一个理工科 (STEM) 领域的笔记",
-                    "NOTES_HASS": "这是一个⼈文社科 (HASS) 领域的笔记",
-                }
-                friendly_text = category_map.get(data, f"无法识别笔记领域，将使用默认模板。识别码: {data}")
-                yield "display_classification", friendly_text
-                
-            elif event_type == "error":
-                user_friendly_error = f"**笔记生成失败**\n\n看起来在与 Dify 服务通信时遇到了问题。这通常与 API Key 或网络有关。\n\n**原始错误信息:**\n`{data}`"
-                yield "persistent_error", 0, user_friendly_error
-                return
+def _prepare_job(input_path: str, query, time_budget: float | None, compaction: bool | None, transfer_mode: str | None):
+    """解析任务参数的默认值，返回 (queries, compaction, transfer_mode, deadline, metrics)。两种引擎共用。"""
+    if compaction is None:
+        compaction = compaction_enabled()
+    if transfer_mode is None:
+        transfer_mode = get_transfer_mode()
+    if time_budget is None and os.getenv(JOB_TIME_BUDGET_ENV):
+        time_budget = float(os.getenv(JOB_TIME_BUDGET_ENV))
+    deadline = Deadline(time_budget)
+    queries = [query] if isinstance(query, str) else list(dict.fromkeys(query))
+    if not queries:
+        raise ValueError("至少需要指定一个生成类型 (query)。")
+    metrics = JobMetrics(input_path=input_path, query=query if isinstance(query, str) else queries)
+    return queries, compaction, transfer_mode, deadline, metrics
 
-            elif event_type == "node_started":
-                yield "progress_text", f"Dify 节点 '{data}' 已开始..."
 
-            elif event_type == "workflow_finished":
-                final_outputs = data  # 捕获最终输出的字典
-                break
-        
-        # 工作流已结束，现在分析最终结果
-        final_text_from_chunks = "".join(final_llm_output_chunks)
-        
+def _fan_out(sources: dict, max_workers: int):
+    """
+    在线程池中并发消费多个生成器，按到达顺序产出 (key, event)。
+    调用方提前关闭本生成器时，各线程在收到下一个事件后停止。
+    """
+    events = queue.Queue()
+    stop = threading.Event()
+    finished = object()
+
+    def drain(key, generator):
+        try:
+            for event in generator:
+                if stop.is_set():
+                    break
+                events.put((key, event))
+        except Exception as e:
+            events.put((key, ("persistent_error", 0, f"**内容生成失败**\n\n处理 '{key}' 时发生意外错误。\n\n**原始错误信息:**\n`{e}`")))
+        finally:
+            generator.close()
+            events.put((key, finished))
+
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=max(1, max_workers), thread_name_prefix="dify")
+    for key, generator in sources.items():
+        executor.submit(drain, key, generator)
+    try:
+        pending = len(sources)
+        while pending:
+            key, event = events.get()
+            if event is finished:
+                pending -= 1
+            else:
+                yield key, event
+    finally:
+        stop.set()
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+# --- 同步 (_run_pipeline) 与异步 (async_pipeline) 流程共用的部分：不涉及网络 I/O ---
+
+class _DifyResultHandler:
+    """把一个 query 的 Dify 工作流事件转换为流程事件，并在工作流结束后检查、保存结果。"""
+
+    CATEGORY_MAP = {
+        "NOTES_STEM": "这是一个理工科 (STEM) 领域的笔记",
+        "NOTES_HASS": "这是一个⼈文社科 (HASS) 领域的笔记",
+    }
+
+    def __init__(self, query: str, output_filename: str, single: bool, metrics: JobMetrics):
+        self.query = query
+        self.single = single
+        self.metrics = metrics
+        self.save_path = f"{output_filename}.md" if single else f"{output_filename}_{query}.md"
+        self.finished = False  # 收到 error 或 workflow_finished 后不必再读取事件
+        self._failed = False
+        self._chunks = []
+        self._final_outputs = None  # 用于捕获工作流结束时的最终输出
+
+    def handle(self, event_type: str, data):
+        """处理 run_workflow_streaming 的一个事件，返回需要产出的流程事件 (没有时返回 None)。"""
+        if event_type == "text_chunk":
+            self._chunks.append(data)
+            return "llm_chunk", data
+        if event_type == "classification_result":
+            return "display_classification", self.CATEGORY_MAP.get(data, f"无法识别笔记领域，将使用默认模板。识别码: {data}")
+        if event_type == "error":
+            self.finished = self._failed = True
+            return "persistent_error", 0, f"**笔记生成失败**\n\n看起来在与 Dify 服务通信时遇到了问题。这通常与 API Key 或网络有关。\n\n**原始错误信息:**\n`{data}`"
+        if event_type == "node_started":
+            return "progress_text", f"Dify 节点 '{data}' 已开始..."
+        if event_type == "workflow_finished":
+            self.finished = True
+            self._final_outputs = data  # 捕获最终输出的字典
+        return None
+
+    def result_events(self) -> list:
+        """工作流结束后调用：检查安全审查结果与回退分支，保存最终文本，返回需要产出的流程事件。"""
+        if self._failed:
+            return []
+        query = self.query
         # 从工作流的最终输出变量 'final_output' 中获取值
-        final_output_value = final_outputs.get('final_output', '').strip() if final_outputs else ""
+        final_output_value = self._final_outputs.get('final_output', '').strip() if self._final_outputs else ""
 
         # 1. 优先检查安全警告
         if final_output_value == 'INJECTION_DETECTED':
-            error_message = "**安全警告：检测到指令注入攻击**\n\n您的输入中可能包含试图操控系统行为的指令。为安全起见，处理已终止。"
-            yield "persistent_error", 0, error_message
-            return
+            return [("persistent_error", 0, "**安全警告：检测到指令注入攻击**\n\n您的输入中可能包含试图操控系统行为的指令。为安全起见，处理已终止。")]
 
         if final_output_value == 'SENSITIVE_CONTENT_DETECTED':
-            error_message = "**内容警告：检测到不当敏感内容**\n\n您的输入中可能包含不适宜的词汇。为遵守社区准则，处理已终止。"
-            yield "persistent_error", 0, error_message
-            return
-        
+            return [("persistent_error", 0, "**内容警告：检测到不当敏感内容**\n\n您的输入中可能包含不适宜的词汇。为遵守社区准则，处理已终止。")]
+
         # 2. 检查设计好的回退分支（例如，查询无效或分类失败）
         # 在这些情况下，工作流会将原始 query 作为 final_output 返回
         if final_output_value == query:
-            error_message = ""
             if query == "Notes":
                 error_message = "**笔记生成失败**\n\n无法自动识别笔记的领域 (例如理工科/人文社科)。工作流已终止，因为它无法选择合适的笔记模板。"
             else:
                 error_message = f"**无效的操作类型**\n\n请求的操作 '{query}' 不是一个有效的选项 ('Notes', 'Q&A', 'Quiz')。工作流已终止。"
-            yield "persistent_error", 0, error_message
-            return
-        
+            return [("persistent_error", 0, error_message)]
+
         # 3. 如果没有触发特定错误，则最终内容为流式输出的文本
-        final_text = final_text_from_chunks
-        
+        final_text = "".join(self._chunks)
         if "</think>" in final_text:
             final_text = final_text.split("</think>")[-1].strip()
 
         if not final_text:
-            yield "persistent_error", 0, "**笔记生成失败**\n\nDify 工作流在多次尝试后，未返回任何有效内容。请检查您的 Dify 工作流配置以及输入文本是否过长或格式异常。"
-            return
+            return [("persistent_error", 0, "**笔记生成失败**\n\nDify 工作流在多次尝试后，未返回任何有效内容。请检查您的 Dify 工作流配置以及输入文本是否过长或格式异常。")]
 
+        self.metrics.set("output_chars" if self.single else f"output_chars.{query}", len(final_text))
         try:
-            with open(final_notes_save_path, 'w', encoding='utf-8') as f:
+            with self.metrics.span("save"), open(self.save_path, 'w', encoding='utf-8') as f:
                 f.write(final_text)
-            yield "save_path", final_notes_save_path
         except IOError as e:
             user_friendly_error = f"**保存最终笔记文件失败**\n\n无法将生成的笔记写入本地文件。\n\n**可能原因:**\n- 程序没有在当前目录创建文件的权限。\n- 磁盘空间不足。\n\n**原始错误信息:**\n`{e}`"
-            yield "persistent_error", 0, user_friendly_error
-            return
+            return [("persistent_error", 0, user_friendly_error)]
+        return [("save_path", self.save_path)]
+
+
+def _tag_query_event(q: str, event: tuple, single: bool, progress: float, saved_paths: dict, failures: dict):
+    """把某个 query 的流程事件转换为对外产出的事件 (带 query 标签)，同时记录保存路径与失败信息。"""
+    event_type, value, *rest = event
+    if event_type == "persistent_error":
+        failures[q] = rest[0]
+        return None if single else ("query_error", rest[0], q)
+    if event_type in ("display_classification", "llm_chunk"):
+        return event_type, value, q
+    if event_type == "progress_text":
+        return "progress", progress, value if single else f"[{q}] {value}"
+    if event_type == "save_path":
+        saved_paths[q] = value
+        return None if single else ("query_done", value, q)
+    return None
+
+
+def _no_result_message(queries: list[str], failures: dict) -> str:
+    return next((failures[q] for q in queries if q in failures), "**内容生成失败**\n\nDify 工作流未返回任何结果。")
+
+
+def _done_event(saved_paths: dict, queries: list[str], single: bool) -> tuple:
+    if single:
+        return "done", saved_paths[queries[0]], "🎉 恭喜！智能笔记已生成！"
+    ordered = {q: saved_paths[q] for q in queries if q in saved_paths}
+    return "done", ordered, f"🎉 恭喜！已生成 {len(ordered)}/{len(queries)} 项内容！"
+
+
+def _chunk_seconds(media_duration: float | None, num_chunks: int) -> list[float]:
+    """各音频块的时长 (秒)，供调度器按音频时长限速与排队。"""
+    return [
+        min(CHUNK_DURATION, media_duration - i * CHUNK_DURATION) if media_duration else CHUNK_DURATION
+        for i in range(num_chunks)
+    ]
+
+
+def _read_text_input(input_path: str, transfer_mode: str, metrics: JobMetrics) -> tuple[str, str | None]:
+    """读取文本文档，返回 (llm_input, llm_input_path)。读取失败时抛出异常。"""
+    with metrics.span("read_text"), open(input_path, 'r', encoding='utf-8') as f:
+        if transfer_mode == "file":
+            # 直接上传原文件：这里只逐行校验编码并统计字数，不把全文读入内存
+            metrics.set("transcript_chars", sum(len(line) for line in f))
+            return "", input_path
+        full_transcript = f.read()
+    metrics.set("transcript_chars", len(full_transcript))
+    return full_transcript, None
+
+
+def _prepare_llm_input(full_transcript: str, work_dir: str | None, compaction: bool, transfer_mode: str, metrics: JobMetrics, progress: float):
+    """
+    保存转录得到的文字稿，按需压缩，file 传输模式下把待上传的文字稿落盘。
+    返回 (需要产出的事件列表, llm_input, llm_input_path)；无法继续时 llm_input 为 None。
+    file 模式下 llm_input 为空字符串，文字稿只保存在 llm_input_path 中。
+    """
+    events = []
+    metrics.set("transcript_chars", len(full_transcript))
+
+    transcript_save_path = os.path.join(work_dir, "source_transcript.txt") if work_dir else "source_transcript.txt"
+    transcript_saved = False
+    try:
+        with open(transcript_save_path, 'w', encoding='utf-8') as f:
+            f.write(full_transcript)
+        transcript_saved = True
+    except IOError as e:
+        events.append(("error", 0, f"无法保存文字稿文件: {e}"))
+
+    llm_input = full_transcript
+    if compaction:
+        compact_started = metrics.now()
+        llm_input, report = compact_transcript(full_transcript)
+        metrics.record("compact", compact_started)
+        metrics.set("compaction", report)
+        events.append(("progress", progress, (
+            f"文字稿压缩完成：估算 token {report['tokens_before']} → {report['tokens_after']} "
+            f"(减少 {report['token_reduction']:.0%}，预计节省约 {report['estimated_prefill_seconds_saved']:.0f} 秒)"
+        )))
+
+    if transfer_mode != "file":
+        return events, llm_input, None
+    if llm_input is full_transcript and transcript_saved:
+        return events, "", transcript_save_path
+    llm_input_path = os.path.join(work_dir, "dify_input.txt") if work_dir else "dify_input.txt"
+    try:
+        with open(llm_input_path, 'w', encoding='utf-8') as f:
+            f.write(llm_input)
+    except IOError as e:
+        events.append(("persistent_error", 0, f"**文字稿保存失败**\n\n无法把待上传的文字稿写入工作目录。\n\n**原始错误信息:**\n`{e}`"))
+        return events, None, None
+    return events, "", llm_input_path
+
+
+def _read_error_message(input_path: str, e: Exception) -> str:
+    return f"**读取文件失败**\n\n无法读取您上传的文本文档 '{os.path.basename(input_path)}'。\n\n**可能原因:**\n- 文件已损坏或编码格式不是 UTF-8。\n- 程序没有读取该文件的权限。\n\n**原始错误信息:**\n`{e}`"
+
+
+def _split_error_message(input_path: str, error) -> str:
+    return f"**媒体文件切分失败**\n\n无法处理您上传的媒体文件。这通常与 **FFmpeg** 配置或文件本身有关。\n\n**请检查:**\n1. **FFmpeg 是否已正确安装**: 确保 FFmpeg 已安装并在系统的环境变量 `PATH` 中。\n2. **文件是否完好**: 确认您的文件 `{os.path.basename(input_path)}` 没有损坏且格式受支持。\n\n**原始错误信息:**\n`{error}`"
+
+
+def _no_chunks_message(step_name: str) -> str:
+    return f"**{step_name}切分失败**\n\n未能从您的文件中提取出任何音频块。请确保文件时长不为零，且已正确安装 FFmpeg。"
+
+
+def _backend_error_message(e: Exception) -> str:
+    return f"**转录后端不可用**\n\n{e}"
+
+
+def _transcription_error_message(e: Exception) -> str:
+    # 只有 openai 后端会导入 openai；没有导入时错误也不可能来自它
+    openai = sys.modules.get("openai")
+    if openai is not None and isinstance(e, openai.AuthenticationError):
+        return f"**OpenAI API 认证失败**\n\n您的 OpenAI API Key 无效。请在左侧边栏重新输入正确的密钥。\n\n**常见原因:**\n- 密钥拼写错误。\n- 密钥已过期或被禁用。\n- 账户余额不足。\n\n**原始错误信息:**\n`{e}`"
+    if isinstance(e, (CircuitOpenError, DeadlineExceeded)):
+        return f"**音频转录已提前终止**\n\nOpenAI Whisper 服务当前持续出错，或本任务已用完时间预算。为避免长时间无效等待，处理已停止，请稍后重试。\n\n**原始错误信息:**\n`{e}`"
+    return f"**音频转录失败**\n\n在连接 OpenAI Whisper 服务进行语音转文字时发生无法恢复的错误。\n\n**可能原因:**\n1. **OpenAI 服务中断**: 可前往其官网查看服务状态。\n2. **网络连接问题**: 您的服务器可能无法访问 OpenAI API。\n3. **音频数据问题**: 某个音频块可能已损坏无法处理。\n\n**原始错误信息:**\n`{e}`"
+
+
+def _upload_error_message(e: Exception) -> str:
+    return f"**文字稿上传失败**\n\n无法通过 Dify 文件上传接口提交文字稿。请检查 Dify API Key、网络，以及 Dify 是否允许上传文本文件。\n\n**原始错误信息:**\n`{e}`"
+
+
+def _unsupported_type_message(file_ext: str) -> str:
+    return f"**不支持的文件类型**\n\n您上传的文件类型 (`{file_ext}`) 当前不受支持。请参照上传框下的提示，上传指定格式的视频、音频或文本文档。"
+
+
+def _transcribe_media(input_path: str, openai_api_key: str, output_dir: str, is_video: bool, metrics: JobMetrics,
+                      deadline: Deadline, transcription_backend=None):
+    """
+    音视频流程的前半段：切分为音频块并并行转录，产出进度事件 (步骤 1、2)，返回拼接后的完整文字稿；
+    失败时产出 persistent_error 并返回 None。这一段与生成类型、输出文件名无关，可以在用户提交任务前
+    预先运行 (见 transcribe_media_generator 与 speculative.py)。
+    """
+    total_steps = 4 if is_video else 3
+    current_progress = 0
+    
+    step_name = "视频" if is_video else "音频"
+    yield "progress", current_progress / total_steps, f"步骤 {current_progress + 1}/{total_steps}: 正在切分{step_name}为音频块..."
+    
+    splitter_generator = split_media_to_audio_chunks_generator(input_path, output_dir, CHUNK_DURATION, metrics=metrics)
+    audio_chunks = []
+    media_duration = None
+    split_started = metrics.now()
+    
+    for event_type, val1, *val2 in splitter_generator:
+        if event_type == 'progress':
+            completed, total = val1, val2[0]
+            yield "sub_progress", completed / total, f"正在切分... ({completed}/{total})"
+        elif event_type == 'duration':
+            media_duration = val1
+        elif event_type == 'result':
+            audio_chunks = val1
+        elif event_type == 'error':
+            yield "persistent_error", 0, _split_error_message(input_path, val1)
+            return None
+    
+    if not audio_chunks:
+        yield "persistent_error", 0, _no_chunks_message(step_name)
+        return None
+    
+    metrics.record("split", split_started)
+    yield "sub_progress", 1.0, f"✅ {step_name}切分全部完成！"
+    current_progress += 1
+    yield "progress", current_progress / total_steps, f"✅ {step_name}切分完成，准备开始转录..."
+
+    # 后端在这里才创建：openai 等依赖只有音视频任务才加载，本地模型配置有误时也只影响音视频任务
+    try:
+        backend = get_backend(transcription_backend, openai_api_key)
+    except (ValueError, ImportError) as e:
+        yield "persistent_error", 0, _backend_error_message(e)
+        return None
+    metrics.set("transcription_backend", backend.name)
+
+    yield "progress", current_progress / total_steps, f"步骤 {current_progress + 1}/{total_steps}: 正在并行转录 {len(audio_chunks)} 个音频块..."
+    all_transcripts = [None] * len(audio_chunks)
+    num_transcribed = 0
+    transcribe_started = metrics.now()
+
+    # 所有任务的 Whisper 请求共用进程内的调度器 (限速 + 任务间公平排队)
+    chunk_seconds = _chunk_seconds(media_duration, len(audio_chunks))
+    scheduler = get_scheduler()
+    scheduler.register_job(metrics.job_id, sum(chunk_seconds))
+
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=10) as executor:
+            future_to_index = {
+                executor.submit(backend.transcribe, chunk, metrics=metrics, deadline=deadline,
+                                job_id=metrics.job_id, audio_seconds=chunk_seconds[i]): i
+                for i, chunk in enumerate(audio_chunks)
+            }
+            try:
+                for future in concurrent.futures.as_completed(future_to_index):
+                    index = future_to_index[future]
+                    result = future.result()
+                    if result is not None:
+                        all_transcripts[index] = result
+                    else:
+                        raise Exception(f"转录任务未返回有效文本 (块索引: {index})。")
+
+                    num_transcribed += 1
+                    yield "sub_progress", num_transcribed / len(audio_chunks), f"正在转录... ({num_transcribed}/{len(audio_chunks)})"
+            finally:
+                # 出错或调用方提前关闭生成器 (例如预处理被取消) 时，排队中的音频块不再发出请求
+                executor.shutdown(wait=False, cancel_futures=True)
+
+    except Exception as e:
+        yield "persistent_error", 0, _transcription_error_message(e)
+        return None
+    finally:
+        # 记录本任务在调度器中的排队深度与等待时间
+        metrics.set("whisper_queue", scheduler.unregister_job(metrics.job_id))
+    
+    if any(t is None for t in all_transcripts):
+        yield "persistent_error", 0, INCOMPLETE_TRANSCRIPT_MESSAGE
+        return None
+
+    metrics.record("transcribe", transcribe_started)
+    yield "sub_progress", 1.0, "✅ 音频转录全部完成！"
+    current_progress += 1
+    yield "progress", current_progress / total_steps, "所有音频块转录完成！"
+    shutil.rmtree(output_dir, ignore_errors=True)
+
+    return "\n\n".join(filter(None, all_transcripts))
+
+
+def _run_pipeline(input_path: str, openai_api_key: str, dify_api_key: str, output_filename: str, queries: list[str], single: bool, max_parallel_queries: int, compaction: bool, transfer_mode: str, work_dir: str | None, metrics: JobMetrics, deadline: Deadline, transcription_backend=None, transcript: str | None = None):
+    """main_process_generator 的实际处理流程，各阶段耗时记录在 metrics 中。"""
+    output_dir = os.path.join(work_dir, "output_chunks") if work_dir else "output_chunks"
+    
+    video_exts = VIDEO_EXTS
+    audio_exts = AUDIO_EXTS
+    text_exts = TEXT_EXTS
+
+    file_ext = os.path.splitext(input_path)[1].lower()
+    current_progress = 0
+    full_transcript = ""
+    llm_input = ""  # 实际提交给 Dify 的文本 (转录结果可能经过压缩)
+    llm_input_path = None  # file 传输模式下，落盘后待上传的文字稿
+
+    # --- START of MODIFICATION ---
+    # (已重写) 重写此辅助函数以处理新的安全审查逻辑和更复杂的工作流分支
+    def run_dify_and_yield_results(query, upload_file_id=None):
+        """辅助生成器：运行Dify工作流并处理事件（已适配安全审查流程）。"""
+        handler = _DifyResultHandler(query, output_filename, single, metrics)
+
+        dify_generator = run_workflow_streaming(
+            input_text=llm_input,
+            query=query,
+            user="streamlit_user",
+            dify_api_key=dify_api_key,
+            metrics=metrics,
+            deadline=deadline,
+            upload_file_id=upload_file_id
+        )
+        
+        for event_type, data in dify_generator:
+            event = handler.handle(event_type, data)
+            if event is not None:
+                yield event
+            if handler.finished:
+                break
+        
+        # 工作流已结束，现在分析最终结果
+        yield from handler.result_events()
+
+    def run_all_queries(progress):
+        """
+        辅助生成器：为每个 query 运行 Dify 工作流 (多个时并发)，转发带 query 标签的事件。
+        返回 {query: 保存路径}；全部失败时产出第一个错误。
+        """
+        saved_paths, failures = {}, {}
+        dify_started = metrics.now()
+        upload_file_id = None
+        if transfer_mode == "file":
+            # 只上传一次，所有 query 及其重试都引用同一个文件
+            try:
+                upload_file_id = upload_file(llm_input_path, "streamlit_user", dify_api_key, metrics=metrics, deadline=deadline)
+            except Exception as e:
+                metrics.record("dify", dify_started, ok=False)
+                yield "persistent_error", 0, _upload_error_message(e)
+                return {}
+        sources = {q: run_dify_and_yield_results(q, upload_file_id) for q in queries}
+        for q, event in _fan_out(sources, max_parallel_queries):
+            event = _tag_query_event(q, event, single, progress, saved_paths, failures)
+            if event is not None:
+                yield event
+        metrics.record("dify", dify_started, ok=bool(saved_paths))
+
+        if not saved_paths:
+            yield "persistent_error", 0, _no_result_message(queries, failures)
+        return saved_paths
 
     # --- END of MODIFICATION ---
 
@@ -120,118 +552,49 @@ def main_process_generator(input_path: str, openai_api_key: str, dify_api_key: s
         total_steps = 2
         yield "progress", 0 / total_steps, "步骤 1/2: 正在读取文本文档..."
         try:
-            with open(input_path, 'r', encoding='utf-8') as f:
-                full_transcript = f.read()
+            llm_input, llm_input_path = _read_text_input(input_path, transfer_mode, metrics)
         except Exception as e:
-            user_friendly_error = f"**读取文件失败**\n\n无法读取您上传的文本文档 '{os.path.basename(input_path)}'。\n\n**可能原因:**\n- 文件已损坏或编码格式不是 UTF-8。\n- 程序没有读取该文件的权限。\n\n**原始错误信息:**\n`{e}`"
-            yield "persistent_error", 0, user_friendly_error
+            yield "persistent_error", 0, _read_error_message(input_path, e)
             return
         
         current_progress += 1
         yield "progress", current_progress / total_steps, "步骤 2/2: 正在提交给 Dify 工作流 (流式传输)..."
         
-        final_path = None
         # 使用已修改的辅助函数
-        dify_gen = run_dify_and_yield_results()
-        for event_type, value, *rest in dify_gen:
-            if event_type == "persistent_error":
-                yield event_type, value, rest[0]
-                return
-            elif event_type == "display_classification":
-                yield event_type, value
-            elif event_type == "llm_chunk":
-                yield event_type, value
-            elif event_type == "progress_text":
-                yield "progress", current_progress / total_steps, value
-            elif event_type == "save_path":
-                final_path = value
-                
-        if final_path:
+        saved_paths = yield from run_all_queries(current_progress / total_steps)
+
+        if saved_paths:
             current_progress += 1
             yield "progress", current_progress / total_steps, "处理完成！"
-            yield "done", final_path, "🎉 恭喜！智能笔记已生成！"
+            yield _done_event(saved_paths, queries, single)
         return
 
     # === 视频和音频文件工作流 ===
     elif file_ext in video_exts or file_ext in audio_exts:
         is_video = file_ext in video_exts
         total_steps = 4 if is_video else 3
-        
-        step_name = "视频" if is_video else "音频"
-        yield "progress", current_progress / total_steps, f"步骤 {current_progress + 1}/{total_steps}: 正在切分{step_name}为音频块..."
-        
-        splitter_generator = split_media_to_audio_chunks_generator(input_path, output_dir, 600)
-        audio_chunks = []
-        
-        for event_type, val1, *val2 in splitter_generator:
-            if event_type == 'progress':
-                completed, total = val1, val2[0]
-                yield "sub_progress", completed / total, f"正在切分... ({completed}/{total})"
-            elif event_type == 'result':
-                audio_chunks = val1
-            elif event_type == 'error':
-                user_friendly_error = f"**媒体文件切分失败**\n\n无法处理您上传的媒体文件。这通常与 **FFmpeg** 配置或文件本身有关。\n\n**请检查:**\n1. **FFmpeg 是否已正确安装**: 确保 FFmpeg 已安装并在系统的环境变量 `PATH` 中。\n2. **文件是否完好**: 确认您的文件 `{os.path.basename(input_path)}` 没有损坏且格式受支持。\n\n**原始错误信息:**\n`{val1}`"
-                yield "persistent_error", 0, user_friendly_error
-                return
-        
-        if not audio_chunks:
-            yield "persistent_error", 0, f"**{step_name}切分失败**\n\n未能从您的文件中提取出任何音频块。请确保文件时长不为零，且已正确安装 FFmpeg。"
-            return
-        
-        yield "sub_progress", 1.0, f"✅ {step_name}切分全部完成！"
-        current_progress += 1
-        yield "progress", current_progress / total_steps, f"✅ {step_name}切分完成，准备开始转录..."
-
-        yield "progress", current_progress / total_steps, f"步骤 {current_progress + 1}/{total_steps}: 正在并行转录 {len(audio_chunks)} 个音频块..."
-        all_transcripts = [None] * len(audio_chunks)
-        num_transcribed = 0
-
-        try:
-            with concurrent.futures.ThreadPoolExecutor(max_workers=10) as executor:
-                future_to_index = {
-                    executor.submit(transcribe_single_audio_chunk, chunk, openai_api_key): i
-                    for i, chunk in enumerate(audio_chunks)
-                }
-                for future in concurrent.futures.as_completed(future_to_index):
-                    index = future_to_index[future]
-                    result = future.result() 
-                    if result is not None:
-                        all_transcripts[index] = result
-                    else:
-                        raise Exception(f"转录任务未返回有效文本 (块索引: {index})。")
-                    
-                    num_transcribed += 1
-                    yield "sub_progress", num_transcribed / len(audio_chunks), f"正在转录... ({num_transcribed}/{len(audio_chunks)})"
-
-        except AuthenticationError as e:
-             user_friendly_error = f"**OpenAI API 认证失败**\n\n您的 OpenAI API Key 无效。请在左侧边栏重新输入正确的密钥。\n\n**常见原因:**\n- 密钥拼写错误。\n- 密钥已过期或被禁用。\n- 账户余额不足。\n\n**原始错误信息:**\n`{e}`"
-             yield "persistent_error", 0, user_friendly_error
-             return
-        except Exception as e:
-            user_friendly_error = f"**音频转录失败**\n\n在连接 OpenAI Whisper 服务进行语音转文字时发生无法恢复的错误。\n\n**可能原因:**\n1. **OpenAI 服务中断**: 可前往其官网查看服务状态。\n2. **网络连接问题**: 您的服务器可能无法访问 OpenAI API。\n3. **音频数据问题**: 某个音频块可能已损坏无法处理。\n\n**原始错误信息:**\n`{e}`"
-            yield "persistent_error", 0, user_friendly_error
-            return
-        
-        if any(t is None for t in all_transcripts):
-            yield "persistent_error", 0, "**音频转录不完整**\n\n部分音频块在多次尝试后仍然转录失败。为确保笔记的完整性，处理已中止。"
-            return
 
-        yield "sub_progress", 1.0, "✅ 音频转录全部完成！"
-        current_progress += 1
-        yield "progress", current_progress / total_steps, "所有音频块转录完成！"
-        shutil.rmtree(output_dir, ignore_errors=True)
+        if transcript is None:
+            full_transcript = yield from _transcribe_media(input_path, openai_api_key, output_dir, is_video,
+                                                           metrics, deadline, transcription_backend)
+            if full_transcript is None:
+                return
+        else:
+            # 文字稿已经预先转录好 (例如上传后的预处理，见 speculative.py)，直接进入 Dify 阶段
+            full_transcript = transcript
+            metrics.set("pretranscribed", True)
+            yield "progress", 2 / total_steps, "✅ 已使用预先转录的文字稿，跳过切分与转录。"
+        current_progress = 2
 
         if is_video:
             yield "progress", current_progress / total_steps, f"步骤 {current_progress + 1}/{total_steps}: 正在汇总文字稿并保存..."
         
-        full_transcript = "\n\n".join(filter(None, all_transcripts))
-        
-        transcript_save_path = "source_transcript.txt"
-        try:
-            with open(transcript_save_path, 'w', encoding='utf-8') as f:
-                f.write(full_transcript)
-        except IOError as e:
-            yield "error", 0, f"无法保存文字稿文件: {e}"
+        events, llm_input, llm_input_path = _prepare_llm_input(full_transcript, work_dir, compaction, transfer_mode,
+                                                               metrics, current_progress / total_steps)
+        full_transcript = None  # file 模式下文字稿已落盘，之后从磁盘流式上传，不再在内存中保留全文
+        yield from events
+        if llm_input is None:
+            return
 
         if is_video:
             current_progress += 1
@@ -239,29 +602,15 @@ def main_process_generator(input_path: str, openai_api_key: str, dify_api_key: s
             
         yield "progress", current_progress / total_steps, f"步骤 {current_progress + 1}/{total_steps}: 正在提交给 Dify 工作流 (流式传输)..."
 
-        final_path = None
         # 使用已修改的辅助函数
-        dify_gen = run_dify_and_yield_results()
-        for event_type, value, *rest in dify_gen:
-            if event_type == "persistent_error":
-                yield event_type, value, rest[0]
-                return
-            elif event_type == "display_classification":
-                yield event_type, value
-            elif event_type == "llm_chunk":
-                yield event_type, value
-            elif event_type == "progress_text":
-                 yield "progress", current_progress / total_steps, value
-            elif event_type == "save_path":
-                final_path = value
-        
-        if final_path:
+        saved_paths = yield from run_all_queries(current_progress / total_steps)
+
+        if saved_paths:
             current_progress += 1
             yield "progress", current_progress / total_steps, "处理完成！"
-            yield "done", final_path, "🎉 恭喜！智能笔记已生成！"
+            yield _done_event(saved_paths, queries, single)
         return
         
     else:
-        user_friendly_error = f"**不支持的文件类型**\n\n您上传的文件类型 (`{file_ext}`) 当前不受支持。请参照上传框下的提示，上传指定格式的视频、音频或文本文档。"
-        yield "error", 0, user_friendly_error
-        return
\ No newline at end of file
+        yield "error", 0, _unsupported_type_message(file_ext)
+        return
@@ -0,0 +1,299 @@
+# metrics.py
+"""
+任务级性能指标：按阶段/按音频块的耗时、字节数、重试次数、Dify 节点时间线、首字延迟 (TTFT)。
+
+每个任务创建一个 JobMetrics，把它传给切分、转录和 Dify 调用；任务结束时生成摘要字典，
+以 ('job_summary', 摘要) 事件产出，并可追加写入 JSONL 指标日志。
+进程内的 REGISTRY 汇总所有任务的摘要，可渲染为 Prometheus 文本格式。
+
+时间均以秒为单位，相对于任务开始时刻。
+"""
+import json
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+# 未显式指定时，从该环境变量读取 JSONL 指标日志路径
+METRICS_LOG_ENV = "METRICS_LOG"
+
+
+class JobMetrics:
+    """单个任务的指标收集器，可在多个工作线程中并发使用。"""
+
+    def __init__(self, input_path: str | None = None, query: str | None = None, job_id: str | None = None):
+        self.job_id = job_id or uuid.uuid4().hex[:12]
+        self.input_path = input_path
+        self.query = query
+        self.started_at = time.time()
+        self._t0 = time.perf_counter()
+        self._lock = threading.Lock()
+        self._spans = []
+        self._counters = {}
+        self._info = {}
+        self._dify_nodes = {}
+
+    def now(self) -> float:
+        """距任务开始的秒数。"""
+        return time.perf_counter() - self._t0
+
+    @contextmanager
+    def span(self, stage: str, **attrs):
+        """记录一个阶段的起止时间。attrs 会原样写入该 span (例如 chunk=3)。"""
+        start = self.now()
+        record = {"stage": stage, "start": round(start, 4), **attrs}
+        try:
+            yield record
+            record["ok"] = True
+        except BaseException:
+            record["ok"] = False
+            raise
+        finally:
+            end = self.now()
+            record["end"] = round(end, 4)
+            record["seconds"] = round(end - start, 4)
+            with self._lock:
+                self._spans.append(record)
+
+    def record(self, stage: str, start: float, ok: bool = True, **attrs):
+        """记录一个从 start (由 now() 取得) 持续到当前的阶段，用于无法用 with 包裹的生成器流程。"""
+        end = self.now()
+        record = {"stage": stage, "start": round(start, 4), **attrs, "ok": ok,
+                  "end": round(end, 4), "seconds": round(end - start, 4)}
+        with self._lock:
+            self._spans.append(record)
+
+    def add(self, counter: str, amount: int | float = 1):
+        with self._lock:
+            self._counters[counter] = self._counters.get(counter, 0) + amount
+
+    def set(self, key: str, value):
+        with self._lock:
+            self._info[key] = value
+
+    def set_once(self, key: str, value):
+        """只记录第一次出现的值 (例如首字时间)。"""
+        with self._lock:
+            self._info.setdefault(key, value)
+
+    def _dify_node(self, title: str, query: str | None) -> dict:
+        # 多个生成类型并发运行工作流时节点标题相同，按 (query, 标题) 区分，避免时间线互相覆盖
+        node = self._dify_nodes.get((query, title))
+        if node is None:
+            node = self._dify_nodes[(query, title)] = {"title": title} if query is None else {"query": query, "title": title}
+        return node
+
+    def dify_node_started(self, title: str, query: str | None = None):
+        with self._lock:
+            self._dify_node(title, query)["started"] = round(self.now(), 4)
+
+    def dify_node_finished(self, title: str, status: str | None = None, elapsed: float | None = None,
+                           query: str | None = None):
+        with self._lock:
+            node = self._dify_node(title, query)
+            node["finished"] = round(self.now(), 4)
+            if "started" in node:
+                node["seconds"] = round(node["finished"] - node["started"], 4)
+            if status:
+                node["status"] = status
+            if elapsed is not None:
+                # Dify 服务端自己报告的节点耗时
+                node["server_elapsed"] = elapsed
+
+    def summary(self, status: str) -> dict:
+        """生成任务摘要。stages 按阶段名聚合，spans 保留每个块的明细。"""
+        with self._lock:
+            spans = sorted(self._spans, key=lambda s: s["start"])
+            counters = dict(self._counters)
+            info = dict(self._info)
+            nodes = sorted(self._dify_nodes.values(), key=lambda n: n.get("started", n.get("finished", 0)))
+
+        stages = {}
+        for span in spans:
+            agg = stages.setdefault(span["stage"], {"count": 0, "seconds": 0.0, "max_seconds": 0.0})
+            agg["count"] += 1
+            agg["seconds"] = round(agg["seconds"] + span["seconds"], 4)
+            agg["max_seconds"] = max(agg["max_seconds"], span["seconds"])
+
+        total = self.now()
+        for key in ("media_duration", "transcript_chars"):
+            if key in info and total > 0:
+                info[f"{key}_per_second"] = round(info[key] / total, 3)
+
+        return {
+            "job_id": self.job_id,
+            "input": self.input_path,
+            "query": self.query,
+            "status": status,
+            "started_at": round(self.started_at, 3),
+            "total_seconds": round(total, 4),
+            "stages": stages,
+            "counters": counters,
+            "info": info,
+            "dify_nodes": nodes,
+            "spans": spans,
+        }
+
+
+def write_summary_log(summary: dict, path: str | None = None):
+    """把任务摘要追加到 JSONL 指标日志。path 为空时读取环境变量 METRICS_LOG，都没有则不写。"""
+    path = path or os.getenv(METRICS_LOG_ENV)
+    if not path:
+        return
+    try:
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        with open(path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(summary, ensure_ascii=False) + "\n")
+    except OSError as e:
+        print(f"写入指标日志 '{path}' 失败: {e}")
+
+
+class MetricsRegistry:
+    """进程内的指标汇总，用于 Prometheus 文本格式导出。"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.jobs_total = {}
+        self.jobs_in_progress = 0
+        self.stage_seconds = {}
+        self.counters = {}
+        self.dify_node_seconds = {}
+        self.ttft = [0.0, 0]
+        self.job_seconds = [0.0, 0]
+
+    def job_started(self):
+        with self._lock:
+            self.jobs_in_progress += 1
+
+    def observe_job(self, summary: dict, finished_here: bool = True):
+        """汇总一个任务的摘要。finished_here=False 表示该任务不是由本进程 job_started 计数的。"""
+        with self._lock:
+            if finished_here:
+                self.jobs_in_progress -= 1
+            status = summary.get("status", "unknown")
+            self.jobs_total[status] = self.jobs_total.get(status, 0) + 1
+            self.job_seconds[0] += summary.get("total_seconds", 0.0)
+            self.job_seconds[1] += 1
+            for stage, agg in summary.get("stages", {}).items():
+                acc = self.stage_seconds.setdefault(stage, [0.0, 0])
+                acc[0] += agg["seconds"]
+                acc[1] += agg["count"]
+            for name, value in summary.get("counters", {}).items():
+                self.counters[name] = self.counters.get(name, 0) + value
+            for node in summary.get("dify_nodes", []):
+                if "seconds" in node:
+                    acc = self.dify_node_seconds.setdefault(node["title"], [0.0, 0])
+                    acc[0] += node["seconds"]
+                    acc[1] += 1
+            ttft = summary.get("info", {}).get("dify_ttft_seconds")
+            if ttft is not None:
+                self.ttft[0] += ttft
+                self.ttft[1] += 1
+
+    def render_prometheus(self) -> str:
+        def label(value: str) -> str:
+            return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+        def metric_name(value: str) -> str:
+            return "".join(c if c.isascii() and c.isalnum() else "_" for c in value)
+
+        with self._lock:
+            lines = [
+                "# HELP notes_jobs_total Finished jobs by status.",
+                "# TYPE notes_jobs_total counter",
+            ]
+            lines += [f'notes_jobs_total{{status="{label(s)}"}} {n}' for s, n in sorted(self.jobs_total.items())]
+            lines += [
+                "# HELP notes_jobs_in_progress Jobs currently running in this process.",
+                "# TYPE notes_jobs_in_progress gauge",
+                f"notes_jobs_in_progress {self.jobs_in_progress}",
+                "# HELP notes_job_seconds Wall time of finished jobs.",
+                "# TYPE notes_job_seconds summary",
+                f"notes_job_seconds_sum {self.job_seconds[0]:.4f}",
+                f"notes_job_seconds_count {self.job_seconds[1]}",
+                "# HELP notes_stage_seconds Time spent per pipeline stage.",
+                "# TYPE notes_stage_seconds summary",
+            ]
+            for stage, (total, count) in sorted(self.stage_seconds.items()):
+                lines.append(f'notes_stage_seconds_sum{{stage="{label(stage)}"}} {total:.4f}')
+                lines.append(f'notes_stage_seconds_count{{stage="{label(stage)}"}} {count}')
+            lines += [
+                "# HELP notes_dify_node_seconds Observed Dify node duration (node_started to node_finished).",
+                "# TYPE notes_dify_node_seconds summary",
+            ]
+            for title, (total, count) in sorted(self.dify_node_seconds.items()):
+                lines.append(f'notes_dify_node_seconds_sum{{node="{label(title)}"}} {total:.4f}')
+                lines.append(f'notes_dify_node_seconds_count{{node="{label(title)}"}} {count}')
+            lines += [
+                "# HELP notes_dify_ttft_seconds Time from Dify request to first text chunk.",
+                "# TYPE notes_dify_ttft_seconds summary",
+                f"notes_dify_ttft_seconds_sum {self.ttft[0]:.4f}",
+                f"notes_dify_ttft_seconds_count {self.ttft[1]}",
+            ]
+            for name, value in sorted(self.counters.items()):
+                prom = f"notes_{metric_name(name)}_total"
+                lines += [f"# TYPE {prom} counter", f"{prom} {value}"]
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = MetricsRegistry()
+
+
+def start_metrics_server(port: int, host: str = "127.0.0.1"):
+    """在后台线程中启动只提供 GET /metrics 的 HTTP 服务，返回 ThreadingHTTPServer。"""
+    # http.server 只有导出指标时才需要，不在模块导入时加载
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+        def do_GET(self):
+            if self.path.rstrip("/") != "/metrics":
+                self.send_error(404)
+                return
+            body = REGISTRY.render_prometheus().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+class NullMetrics:
+    """不记录任何内容的替身，供未传入 metrics 的调用方使用。"""
+
+    def now(self) -> float:
+        return 0.0
+
+    @contextmanager
+    def span(self, stage: str, **attrs):
+        yield {}
+
+    def record(self, stage, start, ok=True, **attrs):
+        pass
+
+    def add(self, counter, amount=1):
+        pass
+
+    def set(self, key, value):
+        pass
+
+    def set_once(self, key, value):
+        pass
+
+    def dify_node_started(self, title, query=None):
+        pass
+
+    def dify_node_finished(self, title, status=None, elapsed=None, query=None):
+        pass
+
+
+NULL_METRICS = NullMetrics()
@@ -0,0 +1,344 @@
+# speculative.py
+"""
+上传后立即开始的预处理 (speculative preprocessing)，供 Web 应用使用。
+
+用户上传文件后，通常还要在侧边栏选择生成类型、填写文件名，然后才点击“开始生成”。
+这些选项都不影响切分与转录，所以文件一上传就在后台开始：
+
+1. 落盘：文件按内容 SHA-256 存放在 temp_uploads/ 下
+2. 探测：对音视频运行 ffprobe，尽早得到时长，也能尽早发现损坏的文件
+3. 切分与转录：转录后端可用时运行 main.transcribe_media_generator。
+   openai 后端需要已填写 OpenAI API Key，否则停在探测之后，等用户填写密钥后再继续
+
+点击按钮时调用 process_generator。预处理还没结束时，先转发它的进度事件并等待它完成，
+然后用得到的文字稿调用 main_process_generator(..., transcript=...)，只运行 Dify 阶段。
+预处理失败、被取消或无需转录 (文本文档) 时，按完整流程处理。
+
+条目按 (内容哈希, 转录后端) 区分，在所有会话之间共享：不同会话上传同一份内容时共用同一份文字稿，
+同一会话里多次点击、换生成类型也都复用它。ensure 会记下调用它的会话，取消与清理：
+- 会话换了文件、删除了上传或换了转录后端时，调用方 abandon 旧条目，释放本会话的引用。
+  没有其他会话引用、也没有任务在使用时，才取消后台转录并删除其文件。
+  取消在下一个进度事件时生效；已经发出的转录请求会完成，排队中的音频块不再发出
+- 最后一次访问超过 SPECULATIVE_TTL 秒 (默认 1800) 的条目，由后台清理线程取消并删除
+  (关闭页面的会话不会调用 abandon，它的引用靠这条规则清理)
+- 条目数超过 SPECULATIVE_MAX_ENTRIES (默认 8) 时，淘汰最久未访问、且没有会话引用的条目
+- 正在被任务使用 (claim) 的条目不会被清理；keep_files=True 的条目清理时只移出缓存，不删除文件
+"""
+import hashlib
+import os
+import shutil
+import threading
+import time
+import uuid
+
+from video_processor.backends import backend_name
+
+SPECULATIVE_TTL_ENV = "SPECULATIVE_TTL"
+SPECULATIVE_MAX_ENTRIES_ENV = "SPECULATIVE_MAX_ENTRIES"
+# 后台清理线程的检查间隔 (秒)
+JANITOR_INTERVAL = 60
+
+# 条目状态：probing / transcribing 表示后台仍在运行
+RUNNING_STATES = ("probing", "transcribing")
+
+
+def content_hash(data) -> str:
+    """上传内容 (bytes / memoryview) 的 SHA-256 十六进制摘要。"""
+    return hashlib.sha256(data).hexdigest()
+
+
+class SpeculativeEntry:
+    """一份上传内容在某个转录后端下的预处理状态与结果。"""
+
+    def __init__(self, key: tuple, input_path: str, work_dir: str, transcription_backend: str):
+        self.key = key
+        self.input_path = input_path
+        self.work_dir = work_dir
+        self.transcription_backend = transcription_backend
+        self.status = "ingested"  # ingested / probing / probed / transcribing / ready / failed / cancelled
+        self.duration = None
+        self.transcript = None
+        self.error = None
+        self.keep_files = False
+        self.claims = 0
+        self.sessions = set()
+        self.last_access = time.monotonic()
+        self._events = []
+        self._cond = threading.Condition()
+        self._cancelled = threading.Event()
+        self._discarded = False
+
+    @property
+    def running(self) -> bool:
+        return self.status in RUNNING_STATES
+
+    def describe(self) -> str:
+        """给界面显示的一行状态说明。"""
+        duration = f" (时长 {int(self.duration // 60)}:{int(self.duration % 60):02d})" if self.duration else ""
+        if self.status == "ready":
+            return f"✅ 已在后台完成转录{duration}，点击“开始生成”后直接进入内容生成。"
+        if self.status == "transcribing":
+            latest = self._events[-1][2] if self._events else "正在切分与转录..."
+            return f"⏳ 已在后台开始转录{duration}：{latest}"
+        if self.status == "probed":
+            return f"ℹ️ 文件已就绪{duration}。填写 OpenAI API Key 后将在后台提前开始转录。"
+        if self.status == "failed":
+            return "⚠️ 后台预处理未完成，点击“开始生成”后将重新处理。"
+        return "⏳ 文件已接收，正在后台预处理..."
+
+    def _publish(self, event: tuple):
+        with self._cond:
+            self._events.append(event)
+            self._cond.notify_all()
+
+    def _set_status(self, status: str, error: str | None = None):
+        with self._cond:
+            self.status = status
+            self.error = error
+            self._cond.notify_all()
+            remove = self._discarded and not self.running and not self.keep_files
+        if remove:
+            shutil.rmtree(self.work_dir, ignore_errors=True)
+
+    def follow(self):
+        """从头转发预处理的进度事件，直到后台预处理结束 (供点击后等待尚未完成的预处理)。"""
+        index = 0
+        while True:
+            with self._cond:
+                while index >= len(self._events) and self.running:
+                    self._cond.wait()
+                events = self._events[index:]
+                index = len(self._events)
+                finished = not self.running
+            yield from events
+            if finished and index == len(self._events):
+                return
+
+    def cancel(self):
+        """请求取消后台转录。"""
+        self._cancelled.set()
+
+    def discard(self):
+        """取消后台工作并删除条目的文件 (后台仍在运行时由后台线程结束后删除)。"""
+        self.cancel()
+        with self._cond:
+            self._discarded = True
+            remove = not self.running
+        if remove and not self.keep_files:
+            shutil.rmtree(self.work_dir, ignore_errors=True)
+
+
+class SpeculativeStore:
+    """进程内共享的预处理缓存 (Streamlit 每次重新运行脚本时模块不会重新导入)。"""
+
+    def __init__(self, root: str = "temp_uploads", ttl: float = 1800, max_entries: int = 8):
+        self.root = root
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = {}
+        self._lock = threading.Lock()
+        self._janitor = None
+
+    def ensure(self, digest: str, data, filename: str, openai_api_key: str | None,
+               transcription_backend: str | None = None, session: str | None = None) -> SpeculativeEntry:
+        """
+        返回该内容的预处理条目，不存在时落盘并在后台开始预处理。每次页面重新运行都可以调用：
+        条目已存在时只更新访问时间；之前因缺少 OpenAI API Key 停在探测之后的，拿到密钥后继续转录。
+        digest 为 content_hash(data)，由调用方缓存，避免每次重新运行都重新计算。
+        session 为调用方会话的标识，条目在该会话 abandon 之前不会因为其他会话放弃它而被删除。
+        """
+        backend = backend_name(transcription_backend)
+        key = (digest, backend)
+        self._start_janitor()
+        self.purge_expired()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._touch(entry, session)
+                start = entry.status == "probed" and self._can_transcribe(entry, openai_api_key)
+                self._begin(entry, start)
+        if entry is None:
+            # 上传可能有数 GB，在锁外落盘，不阻塞其他会话。每个条目一个独立目录，
+            # 之前被放弃的同内容条目在后台结束后删除自己的目录时，不会误删新条目的文件
+            work_dir = os.path.join(self.root, f"{digest[:16]}-{backend}-{uuid.uuid4().hex[:8]}")
+            os.makedirs(work_dir, exist_ok=True)
+            input_path = os.path.join(work_dir, os.path.basename(filename))
+            with open(input_path, "wb") as f:
+                f.write(data)
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry is None:
+                    entry = self._entries[key] = SpeculativeEntry(key, input_path, work_dir, backend)
+                    self._touch(entry, session)
+                    evicted = self._evict_over_limit()
+                    start = True
+                else:
+                    # 其他会话同时上传了同一份内容并先完成了登记
+                    self._touch(entry, session)
+                    evicted = [SpeculativeEntry(key, input_path, work_dir, backend)]
+                    start = entry.status == "probed" and self._can_transcribe(entry, openai_api_key)
+                self._begin(entry, start)
+            for stale in evicted:
+                stale.discard()
+        if start:
+            threading.Thread(target=self._run, args=(entry, openai_api_key), name="speculative", daemon=True).start()
+        return entry
+
+    @staticmethod
+    def _begin(entry: SpeculativeEntry, start: bool):
+        # 调用方已持有 self._lock。在锁内改为 probing，其他会话随后的 ensure 不会再次启动同一条目的后台转录
+        if start:
+            entry._set_status("probing")
+
+    @staticmethod
+    def _touch(entry: SpeculativeEntry, session: str | None):
+        # 调用方已持有 self._lock
+        entry.last_access = time.monotonic()
+        if session is not None:
+            entry.sessions.add(session)
+
+    def get(self, key: tuple) -> SpeculativeEntry | None:
+        with self._lock:
+            return self._entries.get(key)
+
+    def claim(self, entry: SpeculativeEntry):
+        """任务开始使用该条目，期间不会被清理。"""
+        with self._lock:
+            entry.claims += 1
+            entry.last_access = time.monotonic()
+
+    def release(self, entry: SpeculativeEntry, keep_files: bool = False):
+        """任务结束。keep_files=True 时条目日后被清理也保留其文件 (对应“保留中间文件”)。"""
+        with self._lock:
+            entry.claims -= 1
+            entry.keep_files = entry.keep_files or keep_files
+            entry.last_access = time.monotonic()
+
+    def abandon(self, key: tuple, session: str | None = None):
+        """
+        会话不再需要该条目 (换了文件或后端)，释放它的引用。没有其他会话引用、也没有任务在使用时，
+        取消后台工作并删除文件。
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return
+            entry.sessions.discard(session)
+            if entry.sessions or entry.claims:
+                return
+            del self._entries[key]
+        entry.discard()
+
+    def purge_expired(self):
+        """清理超过 ttl 未访问且未被使用的条目。"""
+        now = time.monotonic()
+        with self._lock:
+            expired = [k for k, e in self._entries.items() if not e.claims and now - e.last_access > self.ttl]
+            entries = [self._entries.pop(k) for k in expired]
+        for entry in entries:
+            entry.discard()
+
+    def _evict_over_limit(self) -> list:
+        """移出超出数量上限的条目并返回它们，由调用方在锁外 discard (调用方已持有 self._lock)。"""
+        idle = sorted((e for e in self._entries.values() if not e.claims and not e.sessions),
+                      key=lambda e: e.last_access)
+        evicted = idle[:max(0, len(self._entries) - self.max_entries)]
+        for entry in evicted:
+            del self._entries[entry.key]
+        return evicted
+
+    def _start_janitor(self):
+        with self._lock:
+            if self._janitor is None:
+                self._janitor = threading.Thread(target=self._janitor_loop, name="speculative-janitor", daemon=True)
+                self._janitor.start()
+
+    def _janitor_loop(self):
+        while True:
+            time.sleep(JANITOR_INTERVAL)
+            self.purge_expired()
+
+    @staticmethod
+    def _can_transcribe(entry: SpeculativeEntry, openai_api_key: str | None) -> bool:
+        return entry.transcription_backend != "openai" or bool(openai_api_key)
+
+    def _run(self, entry: SpeculativeEntry, openai_api_key: str | None):
+        """(后台线程) 探测，条件满足时继续切分与转录。"""
+        from main import AUDIO_EXTS, VIDEO_EXTS, transcribe_media_generator
+        from video_processor.splitter import get_media_duration
+
+        if os.path.splitext(entry.input_path)[1].lower() not in VIDEO_EXTS | AUDIO_EXTS:
+            entry._set_status("ingested")  # 文本文档读取很快，无需预处理
+            return
+        try:
+            if entry.duration is None:
+                entry.duration = get_media_duration(entry.input_path)
+                if entry.duration is None:
+                    entry._set_status("failed", "无法获取媒体文件时长。")
+                    return
+            if entry._cancelled.is_set():
+                entry._set_status("cancelled")
+                return
+            if not self._can_transcribe(entry, openai_api_key):
+                entry._set_status("probed")
+                return
+
+            entry._set_status("transcribing")
+            generator = transcribe_media_generator(entry.input_path, openai_api_key, work_dir=entry.work_dir,
+                                                   transcription_backend=entry.transcription_backend)
+            status = error = None
+            try:
+                for event in generator:
+                    if entry._cancelled.is_set():
+                        status = "cancelled"
+                        break
+                    if event[0] == "transcript":
+                        entry.transcript = event[1]
+                    elif event[0] in ("persistent_error", "error"):
+                        status, error = "failed", event[2]
+                        break
+                    else:
+                        entry._publish(event)
+            finally:
+                # 关闭生成器时切分与转录的线程池会等待仍在运行的音频块结束。
+                # 结束状态在此之后才设置，条目已被放弃时删除文件不会与仍在写入的线程冲突
+                generator.close()
+            if status is None:
+                status = "ready" if entry.transcript is not None else "failed"
+            entry._set_status(status, error)
+        except Exception as e:
+            entry._set_status("failed", f"{type(e).__name__}: {e}")
+
+
+def process_generator(entry: SpeculativeEntry, openai_api_key: str, dify_api_key: str, output_filename: str, query,
+                      **kwargs):
+    """
+    点击“开始生成”后的处理流程，产出的事件与 main_process_generator 相同。
+    预处理仍在进行时先转发它的进度并等待完成；得到文字稿后只运行 Dify 阶段，否则按完整流程处理。
+    kwargs 原样传给 main_process_generator。
+    """
+    from main import main_process_generator
+
+    if entry.running:
+        for event in entry.follow():
+            yield event
+    if entry.transcript is not None:
+        kwargs["transcript"] = entry.transcript
+    yield from main_process_generator(entry.input_path, openai_api_key, dify_api_key, output_filename, query,
+                                      transcription_backend=entry.transcription_backend, **kwargs)
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_store() -> SpeculativeStore:
+    """返回进程内共享的预处理缓存，首次调用时按环境变量创建。"""
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = SpeculativeStore(
+                ttl=float(os.getenv(SPECULATIVE_TTL_ENV) or 1800),
+                max_entries=int(os.getenv(SPECULATIVE_MAX_ENTRIES_ENV) or 8),
+            )
+        return _store
@@ -0,0 +1,141 @@
+# sse_parser.py
+"""
+增量式 SSE (Server-Sent Events) 解析器，直接处理字节。
+
+- feed(chunk) 接收的字节块可以从任意位置切开，例如只有半行、半个 UTF-8 字符。返回值是已经完整到达的事件
+- 支持多行 data 字段 (按规范以 \\n 连接)、event / id 字段、注释行 (": ping") 以及 \\r\\n 换行
+- 事件的 data 保持为 bytes，不解码成 str。可以先用 peek_event_type 只读开头的 "event" 字段，
+  不关心的事件就不做 JSON 解析
+- find_value 只解码 JSON 中的个别字段。对于回显了整份文字稿的大事件，不需要解析全部内容
+- loads 在安装了 orjson 时使用 orjson (直接接受 bytes)，否则使用标准库 json；
+  设置环境变量 SSE_JSON_BACKEND=json 可以强制使用标准库
+"""
+import json
+import os
+import re
+from collections import namedtuple
+
+try:
+    import orjson
+except ImportError:  # 可选依赖
+    orjson = None
+
+SSEEvent = namedtuple("SSEEvent", ["event", "data", "id"])
+
+_EVENT_TYPE_RE = re.compile(rb'\s*\{\s*"event"\s*:\s*"([^"\\]*)"')
+_SCALAR_RE = re.compile(rb'"(?:[^"\\]|\\.)*"|-?\d+(?:\.\d+)?(?:[eE][+-]?\d+)?|true|false|null')
+_key_patterns = {}
+_decoder = json.JSONDecoder()
+
+
+class SSEParser:
+    """按字节增量解析 SSE 流。一个实例对应一条连接，不是线程安全的。"""
+
+    def __init__(self):
+        self._buffer = bytearray()
+        self._scanned = 0  # 缓冲区中此位置之前确定没有换行符，避免大事件被反复扫描
+        self._data = []
+        self._event = None
+        self.last_event_id = None
+
+    def feed(self, chunk: bytes) -> list:
+        """追加一段字节，返回本次新完成的事件列表 (SSEEvent)。"""
+        buffer = self._buffer
+        buffer += chunk
+        events = []
+        start = 0
+        while True:
+            newline = buffer.find(b"\n", max(start, self._scanned))
+            if newline < 0:
+                break
+            end = newline - 1 if newline > start and buffer[newline - 1] == 0x0D else newline
+            if end == start:
+                self._dispatch(events)
+            else:
+                self._field(buffer, start, end)
+            start = newline + 1
+        if start:
+            del buffer[:start]
+        self._scanned = len(buffer)
+        return events
+
+    def _field(self, buffer: bytearray, start: int, end: int):
+        if buffer.startswith(b"data:", start):
+            value_start = start + 5
+        elif buffer[start] == 0x3A:  # ':' 开头的是注释
+            return
+        else:
+            colon = buffer.find(b":", start, end)
+            name = bytes(buffer[start:end if colon < 0 else colon])
+            value = b"" if colon < 0 else bytes(buffer[colon + 1:end])
+            if value.startswith(b" "):
+                value = value[1:]
+            if name == b"data":
+                self._data.append(value)
+            elif name == b"event":
+                self._event = value.decode("utf-8", "replace")
+            elif name == b"id" and b"\0" not in value:
+                self.last_event_id = value.decode("utf-8", "replace")
+            return  # 其余字段 (retry 等) 忽略
+        if value_start < end and buffer[value_start] == 0x20:
+            value_start += 1
+        self._data.append(bytes(buffer[value_start:end]))
+
+    def _dispatch(self, events: list):
+        if self._data:
+            data = self._data[0] if len(self._data) == 1 else b"\n".join(self._data)
+            events.append(SSEEvent(self._event or "message", data, self.last_event_id))
+        self._data = []
+        self._event = None
+
+
+def get_json_backend() -> str:
+    """返回 loads 实际使用的 JSON 库名称 (orjson / json)。"""
+    if orjson is not None and os.getenv("SSE_JSON_BACKEND", "").lower() != "json":
+        return "orjson"
+    return "json"
+
+
+def loads(data: bytes):
+    """把 JSON 字节解码为 Python 对象，解析失败时抛出 ValueError。"""
+    if get_json_backend() == "orjson":
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def peek_event_type(data: bytes) -> str | None:
+    """
+    不解析 JSON，只读取以 {"event": "..."} 开头的载荷中的事件类型 (Dify 的事件都是这种格式)。
+    开头不是 "event" 字段时返回 None，调用方应退回完整解析。
+    """
+    match = _EVENT_TYPE_RE.match(data)
+    return match.group(1).decode("utf-8") if match else None
+
+
+def find_value(data: bytes, key: str, last: bool = False, default=None):
+    """
+    只解码 JSON 中名为 key 的字段的值，不解析整份载荷。
+    last=False 取第一次出现的字段，last=True 取最后一次出现的字段。
+
+    只能根据字段在文本中的先后位置来定位 (不理解嵌套层级)，适合字段顺序固定的载荷，
+    例如 Dify 的 node_finished：title 在 inputs 之前，outputs、status、elapsed_time 在它们之后。
+    标量值用正则提取后单独解码。对象和数组从该位置开始解码，直到值结束为止。
+    """
+    pattern = _key_patterns.get(key)
+    if pattern is None:
+        pattern = _key_patterns[key] = re.compile(b'"' + re.escape(key.encode("utf-8")) + rb'"\s*:\s*')
+    if last:
+        match = None
+        for match in pattern.finditer(data):
+            pass
+    else:
+        match = pattern.search(data)
+    if match is None:
+        return default
+
+    position = match.end()
+    if data[position:position + 1] in (b"{", b"["):
+        value, _ = _decoder.raw_decode(data[position:].decode("utf-8"))
+        return value
+    scalar = _SCALAR_RE.match(data, position)
+    return json.loads(scalar.group()) if scalar else default
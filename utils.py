@@ -1,34 +1,292 @@
 # utils.py
 import time
+import random
+import threading
 import functools
 
-def retry(max_retries=3, delay=2, allowed_exceptions=()):
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling an upstream whose circuit breaker is open."""
+
+    def __init__(self, upstream: str, retry_in: float):
+        self.upstream = upstream
+        self.retry_in = retry_in
+        super().__init__(f"上游服务 '{upstream}' 暂时不可用 (熔断中)，约 {retry_in:.0f} 秒后再试。")
+
+
+class DeadlineExceeded(Exception):
+    """Raised when a job's time budget runs out before a call could be (re)tried."""
+
+
+class Deadline:
+    """
+    A per-job time budget shared by every retried call of that job.
+
+    :param seconds: Budget in seconds, or None for no limit.
+    """
+
+    def __init__(self, seconds: float | None):
+        self.seconds = seconds
+        self._expires_at = None if seconds is None else time.monotonic() + seconds
+
+    def remaining(self) -> float | None:
+        """Seconds left (never negative), or None when unlimited."""
+        if self._expires_at is None:
+            return None
+        return max(0.0, self._expires_at - time.monotonic())
+
+    def expired(self) -> bool:
+        remaining = self.remaining()
+        return remaining is not None and remaining <= 0
+
+    def check(self, what: str = "操作"):
+        if self.expired():
+            raise DeadlineExceeded(f"任务已超出 {self.seconds:.0f} 秒的时间预算，{what}被终止。")
+
+
+class CircuitBreaker:
+    """
+    Per-upstream circuit breaker shared by all threads (and jobs) in the process.
+
+    closed    -> calls pass; ``failure_threshold`` consecutive failures open the circuit.
+    open      -> calls fail fast with CircuitOpenError for ``recovery_timeout`` seconds.
+    half-open -> a single probe call is let through; success closes, failure re-opens.
+
+    The probe holds a lease of ``recovery_timeout`` seconds: if its caller never
+    reports back (e.g. it was interrupted), the next call after the lease runs out
+    becomes the new probe instead of the circuit staying half-open for good.
+    """
+
+    def __init__(self, name: str, failure_threshold: int = 5, recovery_timeout: float = 30.0):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self.state = "closed"
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+        self._probe_started_at = 0.0
+        self._lock = threading.Lock()
+
+    def before_call(self):
+        with self._lock:
+            if self.state == "closed":
+                return
+            now = time.monotonic()
+            elapsed = now - self._opened_at
+            if self.state == "open" and elapsed >= self.recovery_timeout:
+                self.state = "half_open"
+            if self.state == "half_open":
+                probe_elapsed = now - self._probe_started_at
+                if not self._probe_in_flight or probe_elapsed >= self.recovery_timeout:
+                    self._probe_in_flight = True
+                    self._probe_started_at = now
+                    return
+                elapsed = probe_elapsed
+            raise CircuitOpenError(self.name, max(0.0, self.recovery_timeout - elapsed))
+
+    def record_success(self):
+        with self._lock:
+            self.state = "closed"
+            self._failures = 0
+            self._probe_in_flight = False
+
+    def record_neutral(self):
+        """The call ended with an error that says nothing about upstream health (e.g. bad credentials)."""
+        with self._lock:
+            self._probe_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self.state == "half_open" or self._failures >= self.failure_threshold:
+                if self.state != "open":
+                    print(f"上游 '{self.name}' 连续失败 {self._failures} 次，熔断 {self.recovery_timeout:.0f} 秒。")
+                self.state = "open"
+                self._opened_at = time.monotonic()
+            self._probe_in_flight = False
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def get_circuit_breaker(upstream: str, **kwargs) -> CircuitBreaker:
+    """Return the process-wide breaker for ``upstream``, creating it on first use."""
+    with _breakers_lock:
+        if upstream not in _breakers:
+            _breakers[upstream] = CircuitBreaker(upstream, **kwargs)
+        return _breakers[upstream]
+
+
+def retry_after_seconds(exc: BaseException) -> float | None:
+    """
+    Extract a server back-off hint from an exception carrying an HTTP response
+    (requests.HTTPError, openai.APIStatusError, ...). Understands ``retry-after-ms``
+    and ``Retry-After`` given either as seconds or as an HTTP date.
+    """
+    response = getattr(exc, "response", None)
+    headers = getattr(response, "headers", None)
+    if not headers:
+        return None
+    value = headers.get("retry-after-ms")
+    if value:
+        try:
+            return max(0.0, float(value) / 1000)
+        except ValueError:
+            pass
+    value = headers.get("retry-after")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        import email.utils
+        parsed = email.utils.parsedate_to_datetime(value)
+        if parsed is None:
+            return None
+        return max(0.0, parsed.timestamp() - time.time())
+
+
+def is_rate_limited(exc: BaseException) -> bool:
+    """True for HTTP 429 responses: the upstream is healthy but throttling us."""
+    response = getattr(exc, "response", None)
+    return getattr(response, "status_code", None) == 429
+
+
+def compute_backoff(attempt: int, base_delay: float, max_delay: float, multiplier: float = 2.0,
+                    jitter: bool = True, hint: float | None = None) -> float:
+    """
+    Delay before retry number ``attempt`` (1-based): exponential backoff capped at
+    ``max_delay`` with "full jitter" (uniform in [0, backoff]) so that concurrent
+    workers do not retry in lockstep. A server hint (Retry-After) is treated as a
+    lower bound, with a little jitter on top to spread the herd; like the backoff
+    itself it never exceeds ``max_delay``.
+    """
+    backoff = min(max_delay, base_delay * (multiplier ** (attempt - 1)))
+    delay = random.uniform(0, backoff) if jitter else backoff
+    if hint is not None:
+        delay = max(delay, min(max_delay, hint + (random.uniform(0, min(1.0, hint * 0.1)) if jitter else 0.0)))
+    return delay
+
+
+def _retry_delay(func_name: str, e: Exception, attempts: int, max_retries: int, delay, max_delay, backoff,
+                 jitter, allowed_exceptions, breaker, deadline, metrics) -> float:
+    """
+    Shared bookkeeping for retry() and retry_async() after attempt number ``attempts``
+    failed with ``e``: updates the circuit breaker and either re-raises ``e`` or
+    returns how long to wait before the next attempt.
+    """
+    # If specific exceptions are listed, only retry for them.
+    if allowed_exceptions and not isinstance(e, allowed_exceptions):
+        if breaker is not None:
+            breaker.record_neutral()
+        raise e # Re-raise exception if it's not in the allowed list
+
+    if breaker is not None:
+        # Throttling is handled by honoring Retry-After, not by opening the circuit
+        if is_rate_limited(e):
+            breaker.record_neutral()
+        else:
+            breaker.record_failure()
+    if attempts >= max_retries:
+        print(f"Function '{func_name}' failed after {max_retries} attempts. Re-raising last exception.")
+        raise e
+
+    hint = retry_after_seconds(e)
+    if hint is not None and hint > max_delay:
+        print(f"Function '{func_name}' was asked to wait {hint:.0f} seconds (more than {max_delay:.0f}). Re-raising last exception.")
+        raise e
+    wait = compute_backoff(attempts, delay, max_delay, backoff, jitter, hint)
+    remaining = deadline.remaining() if deadline is not None else None
+    if remaining is not None and wait >= remaining:
+        print(f"Function '{func_name}' would exceed the job time budget by retrying. Re-raising last exception.")
+        raise e
+
+    print(f"Attempt {attempts}/{max_retries} for '{func_name}' failed with error: {e}. Retrying in {wait:.1f} seconds...")
+    if metrics is not None:
+        metrics.add(f"retries.{func_name}")
+    return wait
+
+
+def retry(max_retries=3, delay=2, allowed_exceptions=(), max_delay=30.0, backoff=2.0, jitter=True, upstream=None):
     """
     A decorator to retry a function if it raises an exception.
 
-    :param max_retries: Maximum number of retries.
-    :param delay: Delay between retries in seconds.
-    :param allowed_exceptions: A tuple of exceptions that should trigger a retry. 
+    :param max_retries: Maximum number of attempts.
+    :param delay: Base delay in seconds; attempt n waits up to delay * backoff**(n-1).
+    :param allowed_exceptions: A tuple of exceptions that should trigger a retry.
                                If empty, retries on any Exception.
+    :param max_delay: Upper bound for a single backoff.
+    :param backoff: Exponential growth factor (1.0 gives a fixed delay).
+    :param jitter: Randomize delays ("full jitter") to avoid synchronized retries.
+    :param upstream: Name of the upstream service. When given, calls go through the
+                     shared circuit breaker for it and fail fast while it is open.
+
+    Server hints (Retry-After) found on the exception are honored. If the wrapped
+    call receives a ``deadline`` keyword argument (a Deadline), no retry is
+    scheduled past it. If it receives a ``metrics`` keyword argument (a
+    JobMetrics), each retry is counted on it as ``retries.<function name>``.
     """
     def decorator(func):
         @functools.wraps(func)
         def wrapper(*args, **kwargs):
+            breaker = get_circuit_breaker(upstream) if upstream else None
+            deadline = kwargs.get("deadline")
             attempts = 0
-            while attempts < max_retries:
+            while True:
+                if deadline is not None:
+                    deadline.check(f"'{func.__name__}'")
+                if breaker is not None:
+                    breaker.before_call()
                 try:
-                    return func(*args, **kwargs)
+                    result = func(*args, **kwargs)
+                    if breaker is not None:
+                        breaker.record_success()
+                    return result
                 except Exception as e:
-                    # If specific exceptions are listed, only retry for them.
-                    if allowed_exceptions and not isinstance(e, allowed_exceptions):
-                        raise # Re-raise exception if it's not in the allowed list
+                    attempts += 1
+                    time.sleep(_retry_delay(func.__name__, e, attempts, max_retries, delay, max_delay, backoff, jitter,
+                                            allowed_exceptions, breaker, deadline, kwargs.get("metrics")))
+                except BaseException:
+                    # Interrupted (KeyboardInterrupt, SystemExit ...): give back a claimed half-open probe
+                    if breaker is not None:
+                        breaker.record_neutral()
+                    raise
+        return wrapper
+    return decorator
+
 
+def retry_async(max_retries=3, delay=2, allowed_exceptions=(), max_delay=30.0, backoff=2.0, jitter=True, upstream=None):
+    """
+    The coroutine counterpart of :func:`retry` (same parameters and semantics).
+    Waits between attempts with ``asyncio.sleep`` so the event loop is never blocked.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            import asyncio  # only coroutine callers need it; keeps `import utils` cheap
+            breaker = get_circuit_breaker(upstream) if upstream else None
+            deadline = kwargs.get("deadline")
+            attempts = 0
+            while True:
+                if deadline is not None:
+                    deadline.check(f"'{func.__name__}'")
+                if breaker is not None:
+                    breaker.before_call()
+                try:
+                    result = await func(*args, **kwargs)
+                    if breaker is not None:
+                        breaker.record_success()
+                    return result
+                except Exception as e:
                     attempts += 1
-                    if attempts >= max_retries:
-                        print(f"Function '{func.__name__}' failed after {max_retries} attempts. Re-raising last exception.")
-                        raise e
-                    
-                    print(f"Attempt {attempts}/{max_retries} for '{func.__name__}' failed with error: {e}. Retrying in {delay} seconds...")
-                    time.sleep(delay)
+                    await asyncio.sleep(_retry_delay(func.__name__, e, attempts, max_retries, delay, max_delay, backoff,
+                                                     jitter, allowed_exceptions, breaker, deadline, kwargs.get("metrics")))
+                except BaseException:
+                    # Cancelled (or interrupted) mid-call: give back a claimed half-open probe
+                    if breaker is not None:
+                        breaker.record_neutral()
+                    raise
         return wrapper
-    return decorator
\ No newline at end of file
+    return decorator
@@ -0,0 +1,274 @@
+# backends.py
+"""
+可替换的语音转录后端。两种处理引擎都通过同一个接口转录音频块：
+
+- openai: 远程 Whisper API (transcriber.py)，请求经过共享调度器限速，需要 OpenAI API Key
+- stub:   确定性的模拟转录，不访问网络，相同内容的音频总是得到相同的文本，用于测试和基准测试
+- local:  本地 CPU 推理 (faster-whisper，可选依赖)，从磁盘上已有的模型文件加载。
+          同一模型在进程内只加载一次并常驻，所有任务的音频块排进同一个队列，
+          由一个推理线程依次处理；每个音频块按 30 秒窗口分批 (batch_size) 送入模型
+
+后端可以按任务选择：main_process_generator / main_process_async 的 transcription_backend 参数
+(名称或后端实例)，未指定时读取环境变量 TRANSCRIPTION_BACKEND (默认 openai)。
+
+本地后端的配置从环境变量读取：
+    LOCAL_WHISPER_MODEL          模型目录 (CTranslate2 格式，例如 faster-whisper-small)，必填
+    LOCAL_WHISPER_COMPUTE_TYPE   计算精度 (默认 int8)
+    LOCAL_WHISPER_BATCH_SIZE     每批送入模型的窗口数 (默认 8)
+    LOCAL_WHISPER_CPU_THREADS    推理线程数 (默认 0，由 CTranslate2 决定)
+    LOCAL_WHISPER_LANGUAGE       转录语言 (默认自动检测)
+"""
+import concurrent.futures
+import hashlib
+from abc import ABC, abstractmethod
+import importlib.util
+import os
+import queue
+import threading
+import time
+
+from metrics import NULL_METRICS
+
+BACKENDS = ("openai", "stub", "local")
+DEFAULT_BACKEND = "openai"
+TRANSCRIPTION_BACKEND_ENV = "TRANSCRIPTION_BACKEND"
+
+
+class TranscriptionBackend(ABC):
+    """
+    转录后端的接口。transcribe 在调用线程中阻塞执行 (线程引擎)，子类必须实现；transcribe_async 供 async_pipeline 使用，
+    默认实现把 transcribe 放到线程中运行。两者都返回转录文本，音频文件不存在时返回 None。
+    """
+
+    name = ""
+    # 为 True 时，处理音视频前需要用户提供 OpenAI API Key
+    requires_openai_key = False
+
+    @abstractmethod
+    def transcribe(self, audio_path: str, metrics=None, deadline=None,
+                   job_id: str | None = None, audio_seconds: float | None = None) -> str | None:
+        """转录单个音频块。"""
+
+    async def transcribe_async(self, audio_path: str, metrics=None, deadline=None,
+                               job_id: str | None = None, audio_seconds: float | None = None) -> str | None:
+        import asyncio
+        return await asyncio.to_thread(self.transcribe, audio_path, metrics=metrics, deadline=deadline,
+                                       job_id=job_id, audio_seconds=audio_seconds)
+
+
+class OpenAIWhisperBackend(TranscriptionBackend):
+    """远程 Whisper API。重试、限速与熔断沿用 transcriber 中的实现。"""
+
+    name = "openai"
+    requires_openai_key = True
+
+    def __init__(self, openai_api_key: str):
+        self.openai_api_key = openai_api_key
+
+    def transcribe(self, audio_path, metrics=None, deadline=None, job_id=None, audio_seconds=None):
+        from video_processor.transcriber import transcribe_single_audio_chunk
+        return transcribe_single_audio_chunk(audio_path, self.openai_api_key, metrics=metrics, deadline=deadline,
+                                             job_id=job_id, audio_seconds=audio_seconds)
+
+    async def transcribe_async(self, audio_path, metrics=None, deadline=None, job_id=None, audio_seconds=None):
+        from video_processor.transcriber import get_async_client, transcribe_single_audio_chunk_async
+        return await transcribe_single_audio_chunk_async(audio_path, get_async_client(self.openai_api_key),
+                                                         metrics=metrics, deadline=deadline,
+                                                         job_id=job_id, audio_seconds=audio_seconds)
+
+
+class StubBackend(TranscriptionBackend):
+    """
+    确定性的模拟转录：文本只取决于音频内容 (SHA-256) 与字节数，不访问网络。
+    latency 为每个音频块的模拟耗时 (秒)，用于基准测试中模拟推理时间。
+    """
+
+    name = "stub"
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+
+    def _text(self, audio_path: str) -> str | None:
+        digest, size = hashlib.sha256(), 0
+        try:
+            with open(audio_path, "rb") as audio_file:
+                for block in iter(lambda: audio_file.read(1024 * 1024), b""):
+                    digest.update(block)
+                    size += len(block)
+        except FileNotFoundError:
+            print(f"  > 错误：找不到音频文件: {audio_path}")
+            return None
+        return f"这是音频 {digest.hexdigest()[:12]} 的模拟转录文本，长度为 {size} 字节。"
+
+    def transcribe(self, audio_path, metrics=None, deadline=None, job_id=None, audio_seconds=None):
+        metrics = metrics or NULL_METRICS
+        with metrics.span("transcribe.chunk", chunk=os.path.basename(audio_path), backend=self.name):
+            if self.latency:
+                time.sleep(self.latency)
+            return self._text(audio_path)
+
+    async def transcribe_async(self, audio_path, metrics=None, deadline=None, job_id=None, audio_seconds=None):
+        import asyncio
+        metrics = metrics or NULL_METRICS
+        with metrics.span("transcribe.chunk", chunk=os.path.basename(audio_path), backend=self.name):
+            if self.latency:
+                await asyncio.sleep(self.latency)
+            return self._text(audio_path)
+
+
+class LocalWhisperBackend(TranscriptionBackend):
+    """
+    本地 CPU 推理 (faster-whisper)。模型在第一个音频块到达时加载，之后常驻内存，不会每次调用都重新加载。
+
+    所有调用方 (包括多个任务、两种引擎) 把音频块放进同一个队列，由唯一的推理线程按到达顺序处理，
+    多个任务同时转录时不会各自启动推理而争抢 CPU。每个音频块交给 BatchedInferencePipeline，
+    按语音活动切成不超过 30 秒的窗口，每 batch_size 个窗口一批送入模型。
+    协程调用方等待的是队列返回的 future，等待期间不占用线程。
+    """
+
+    name = "local"
+
+    def __init__(self, model_path: str, compute_type: str = "int8", batch_size: int = 8,
+                 cpu_threads: int = 0, language: str | None = None):
+        self.model_path = model_path
+        self.compute_type = compute_type
+        self.batch_size = batch_size
+        self.cpu_threads = cpu_threads
+        self.language = language
+        self._pipeline = None
+        self._queue = queue.Queue()
+        self._worker = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        from faster_whisper import BatchedInferencePipeline, WhisperModel
+
+        started = time.perf_counter()
+        # local_files_only: 只使用磁盘上已有的模型文件，不会在任务中途联网下载
+        model = WhisperModel(self.model_path, device="cpu", compute_type=self.compute_type,
+                             cpu_threads=self.cpu_threads, local_files_only=True)
+        self._pipeline = BatchedInferencePipeline(model=model)
+        print(f"  > 本地转录模型已加载: {self.model_path} ({time.perf_counter() - started:.1f}s)")
+
+    def _run(self):
+        while True:
+            audio_path, future = self._queue.get()
+            if not future.set_running_or_notify_cancel():
+                continue  # 调用方已放弃 (例如任务被取消)
+            try:
+                if self._pipeline is None:
+                    self._load()
+                future.set_result(self._transcribe_now(audio_path))
+            except BaseException as e:
+                future.set_exception(e)
+
+    def _transcribe_now(self, audio_path: str) -> str | None:
+        if not os.path.exists(audio_path):
+            print(f"  > 错误：找不到音频文件: {audio_path}")
+            return None
+        segments, _ = self._pipeline.transcribe(audio_path, batch_size=self.batch_size, language=self.language)
+        # segments 是惰性生成器，遍历时才真正推理
+        return "".join(segment.text for segment in segments).strip()
+
+    def submit(self, audio_path: str) -> concurrent.futures.Future:
+        """把音频块排进推理队列，返回 future (结果为转录文本)。首次调用时启动推理线程。"""
+        with self._lock:
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._run, name="local-whisper", daemon=True)
+                self._worker.start()
+        future = concurrent.futures.Future()
+        self._queue.put((audio_path, future))
+        return future
+
+    def transcribe(self, audio_path, metrics=None, deadline=None, job_id=None, audio_seconds=None):
+        metrics = metrics or NULL_METRICS
+        audio_filename = os.path.basename(audio_path)
+        print(f"  > 正在本地转录: {audio_filename}")
+        with metrics.span("transcribe.chunk", chunk=audio_filename, backend=self.name):
+            future = self.submit(audio_path)
+            try:
+                text = future.result(timeout=deadline.remaining() if deadline is not None else None)
+            except concurrent.futures.TimeoutError:
+                future.cancel()  # 还在排队时直接撤回
+                deadline.check("本地转录")
+                raise
+        if text is not None:
+            metrics.add("local_whisper.audio_bytes", os.path.getsize(audio_path))
+            print(f"  > ✅ 文件 '{audio_filename}' 本地转录成功！")
+        return text
+
+    async def transcribe_async(self, audio_path, metrics=None, deadline=None, job_id=None, audio_seconds=None):
+        import asyncio
+        metrics = metrics or NULL_METRICS
+        audio_filename = os.path.basename(audio_path)
+        print(f"  > 正在本地转录: {audio_filename}")
+        with metrics.span("transcribe.chunk", chunk=audio_filename, backend=self.name):
+            future = self.submit(audio_path)
+            try:
+                # wait_for 超时或任务被取消时，wrap_future 会一并取消还在排队的 future
+                text = await asyncio.wait_for(asyncio.wrap_future(future),
+                                              deadline.remaining() if deadline is not None else None)
+            except asyncio.TimeoutError:
+                deadline.check("本地转录")
+                raise
+        if text is not None:
+            metrics.add("local_whisper.audio_bytes", os.path.getsize(audio_path))
+            print(f"  > ✅ 文件 '{audio_filename}' 本地转录成功！")
+        return text
+
+
+# 常驻的本地后端 (模型)，按模型配置区分
+_local_backends = {}
+_local_backends_lock = threading.Lock()
+
+
+def _env_int(name: str, default: int) -> int:
+    value = os.getenv(name)
+    return int(value) if value else default
+
+
+def get_local_backend(model_path: str | None = None, compute_type: str | None = None) -> LocalWhisperBackend:
+    """返回进程内共享的本地后端，同一模型配置只创建 (加载) 一次。参数未指定时读取环境变量。"""
+    model_path = model_path or os.getenv("LOCAL_WHISPER_MODEL")
+    if not model_path:
+        raise ValueError("本地转录需要模型文件：请设置环境变量 LOCAL_WHISPER_MODEL 为模型目录。")
+    if not os.path.isdir(model_path):
+        raise ValueError(f"找不到本地转录模型目录: {model_path}")
+    if importlib.util.find_spec("faster_whisper") is None:
+        raise ImportError("本地转录需要 faster-whisper，请运行 'pip install faster-whisper' 安装。")
+    compute_type = compute_type or os.getenv("LOCAL_WHISPER_COMPUTE_TYPE", "int8")
+    key = (os.path.abspath(model_path), compute_type)
+    with _local_backends_lock:
+        if key not in _local_backends:
+            _local_backends[key] = LocalWhisperBackend(
+                model_path, compute_type=compute_type,
+                batch_size=_env_int("LOCAL_WHISPER_BATCH_SIZE", 8),
+                cpu_threads=_env_int("LOCAL_WHISPER_CPU_THREADS", 0),
+                language=os.getenv("LOCAL_WHISPER_LANGUAGE") or None,
+            )
+        return _local_backends[key]
+
+
+def backend_name(backend=None) -> str:
+    """解析后端名称：backend 为 None 时读取环境变量 TRANSCRIPTION_BACKEND，名称无效时抛出 ValueError。"""
+    if isinstance(backend, TranscriptionBackend):
+        return backend.name
+    name = (backend or os.getenv(TRANSCRIPTION_BACKEND_ENV) or DEFAULT_BACKEND).strip().lower()
+    if name not in BACKENDS:
+        raise ValueError(f"未知的转录后端: {name} (可选 {' / '.join(BACKENDS)})")
+    return name
+
+
+def get_backend(backend, openai_api_key: str | None = None) -> TranscriptionBackend:
+    """
+    按名称创建转录后端；backend 已经是后端实例时原样返回，为 None 时读取环境变量 TRANSCRIPTION_BACKEND。
+    本地后端的模型缺失或未安装 faster-whisper 时抛出 ValueError / ImportError。
+    """
+    if isinstance(backend, TranscriptionBackend):
+        return backend
+    name = backend_name(backend)
+    if name == "openai":
+        return OpenAIWhisperBackend(openai_api_key)
+    if name == "stub":
+        return StubBackend(latency=float(os.getenv("STUB_TRANSCRIBE_LATENCY") or 0))
+    return get_local_backend()
@@ -19,14 +19,13 @@ import io
 import os
 import logging
 from pathlib import Path
-from typing import List
+from typing import TYPE_CHECKING, List
 
-import cv2
-import numpy as np
-from PIL import Image
+# cv2, numpy and PIL are imported inside the functions that use them, so importing
+# this module stays cheap and does not fail when the optional dependencies are missing.
+if TYPE_CHECKING:
+    from PIL import Image
 
-# Setup basic logging
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
 def dependencies_required(*deps):
@@ -62,6 +61,9 @@ def dependencies_required(*deps):
 
 def _capture_screenshot(video_path: str, time_sec: float) -> Image.Image:
     r"""Captures a screenshot from a video at a specific time."""
+    import cv2
+    from PIL import Image
+
     cap = cv2.VideoCapture(video_path)
     if not cap.isOpened():
         raise IOError(f"Could not open video file: {video_path}")
@@ -89,6 +91,8 @@ def _normalize_frames(
     frames: List[Image.Image], target_width: int = 512
 ) -> List[Image.Image]:
     r"""Normalize the size of extracted frames."""
+    from PIL import Image
+
     normalized_frames: List[Image.Image] = []
 
     for frame in frames:
@@ -117,7 +121,7 @@ def _normalize_frames(
 
     return normalized_frames
 
-@dependencies_required("cv2", "numpy", "scenedetect")
+@dependencies_required("cv2", "numpy", "PIL", "scenedetect")
 def extract_keyframes(
     video_path: str,
     frame_interval: float = 10.0,
@@ -126,6 +130,8 @@ def extract_keyframes(
 ) -> List[Image.Image]:
     r"""Extract keyframes from a video based on scene changes and
     regular intervals."""
+    import cv2
+    import numpy as np
     from scenedetect import SceneManager, open_video
     from scenedetect.detectors import ContentDetector
 
@@ -218,6 +224,9 @@ def extract_keyframes(
 
 
 if __name__ == '__main__':
+    # Configure logging only when run as a script; importers keep their own logging setup
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
     # ================== USAGE EXAMPLE WITH YOUR OWN VIDEO ==================
     
     # 1. 替换为您自己的视频文件路径
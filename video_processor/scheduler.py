@@ -0,0 +1,347 @@
+# scheduler.py
+"""
+进程内共享的 Whisper 请求调度器。
+
+同一进程里所有任务的 transcribe_single_audio_chunk 调用都要先从这里取得“放行”：
+- 令牌桶限速：每分钟请求数 (RPM) 与每分钟音频秒数，两者同时满足才放行
+- 全局并发上限：同时在途的 Whisper 请求数
+- 任务间公平排队：每个任务一条队列，按轮询 (fair) 依次放行；
+  也可选择最短作业优先 (sjf)，剩余音频最少的任务先走，短录音不会被长课程堵住
+- 按任务统计排队深度与等待时间
+- 线程 (acquire / slot) 与 asyncio 协程 (acquire_async / slot_async) 可以共用同一个调度器
+
+默认配置从环境变量读取：
+    WHISPER_RPM                        每分钟请求数上限 (默认 50)
+    WHISPER_AUDIO_SECONDS_PER_MINUTE   每分钟音频秒数上限 (默认不限)
+    WHISPER_MAX_CONCURRENCY            同时在途的请求数上限 (默认 10)
+    WHISPER_SCHEDULING                 fair 或 sjf (默认 fair)
+"""
+import os
+import threading
+import time
+from collections import deque
+from contextlib import asynccontextmanager, contextmanager
+
+from utils import DeadlineExceeded
+
+DEFAULT_JOB = "default"
+
+
+class TokenBucket:
+    """容量为 capacity、每秒补充 rate 个令牌的令牌桶 (非线程安全，由调度器加锁保护)。"""
+
+    def __init__(self, per_minute: float):
+        self.capacity = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.tokens = self.capacity
+        self._updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def time_until(self, cost: float) -> float:
+        """距离可以支付 cost 个令牌还需等待的秒数 (0 表示现在即可)。"""
+        self._refill()
+        cost = min(cost, self.capacity)  # 超过容量的单次请求按满桶计，避免永远等不到
+        return 0.0 if self.tokens >= cost else (cost - self.tokens) / self.rate
+
+    def consume(self, cost: float):
+        self.tokens -= min(cost, self.capacity)
+
+
+class _JobQueue:
+    def __init__(self, job_id: str, total_audio_seconds: float | None):
+        self.job_id = job_id
+        self.total_audio_seconds = total_audio_seconds
+        self.waiting = deque()
+        self.served = 0
+        self.served_audio_seconds = 0.0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.max_queue_depth = 0
+        self.registered = False
+
+    def remaining_audio(self) -> float:
+        if self.total_audio_seconds is None:
+            return float("inf")
+        return max(0.0, self.total_audio_seconds - self.served_audio_seconds)
+
+    def stats(self) -> dict:
+        return {
+            "queued": len(self.waiting),
+            "max_queue_depth": self.max_queue_depth,
+            "served": self.served,
+            "served_audio_seconds": round(self.served_audio_seconds, 3),
+            "total_wait_seconds": round(self.total_wait, 4),
+            "mean_wait_seconds": round(self.total_wait / self.served, 4) if self.served else 0.0,
+            "max_wait_seconds": round(self.max_wait, 4),
+        }
+
+
+class _Ticket:
+    __slots__ = ("job", "cost", "enqueued_at")
+
+    def __init__(self, job: _JobQueue, cost: float):
+        self.job = job
+        self.cost = cost
+        self.enqueued_at = time.monotonic()
+
+
+class WhisperScheduler:
+    def __init__(self, requests_per_minute: float | None = 50, audio_seconds_per_minute: float | None = None,
+                 max_concurrency: int = 10, policy: str = "fair"):
+        if policy not in ("fair", "sjf"):
+            raise ValueError(f"未知的调度策略: {policy} (可选 fair / sjf)")
+        self.policy = policy
+        self.max_concurrency = max_concurrency
+        self._rpm = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self._audio = TokenBucket(audio_seconds_per_minute) if audio_seconds_per_minute else None
+        self._cond = threading.Condition()
+        self._jobs = {}
+        self._order = []
+        self._rr_index = 0
+        self._in_flight = 0
+        self._async_waiters = []  # (事件循环, future)，状态变化时唤醒
+
+    # --- 任务登记 ---
+    def register_job(self, job_id: str, total_audio_seconds: float | None = None):
+        """登记一个任务。total_audio_seconds 用于最短作业优先；不登记也能直接调用 slot()。"""
+        with self._cond:
+            job = self._get_job(job_id)
+            job.total_audio_seconds = total_audio_seconds
+            job.registered = True
+
+    def unregister_job(self, job_id: str) -> dict:
+        """注销任务并返回其排队统计。"""
+        with self._cond:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return {}
+            stats = job.stats()
+            if not job.waiting:
+                del self._jobs[job_id]
+                self._order.remove(job_id)
+            else:
+                job.registered = False
+            return stats
+
+    def job_stats(self, job_id: str) -> dict:
+        with self._cond:
+            job = self._jobs.get(job_id)
+            return job.stats() if job else {}
+
+    def _get_job(self, job_id: str) -> _JobQueue:
+        job = self._jobs.get(job_id)
+        if job is None:
+            job = self._jobs[job_id] = _JobQueue(job_id, None)
+            self._order.append(job_id)
+        return job
+
+    # --- 调度 ---
+    def _next_ticket(self) -> _Ticket | None:
+        candidates = [self._jobs[j] for j in self._order if self._jobs[j].waiting]
+        if not candidates:
+            return None
+        if self.policy == "sjf":
+            return min(candidates, key=lambda job: job.remaining_audio()).waiting[0]
+        # 轮询：从上次放行的任务之后开始找第一个有排队请求的任务
+        n = len(self._order)
+        for offset in range(n):
+            job = self._jobs[self._order[(self._rr_index + offset) % n]]
+            if job.waiting:
+                return job.waiting[0]
+        return None
+
+    def _time_until_tokens(self, cost: float) -> float:
+        wait = 0.0
+        if self._rpm:
+            wait = max(wait, self._rpm.time_until(1))
+        if self._audio:
+            wait = max(wait, self._audio.time_until(cost))
+        return wait
+
+    def _enqueue(self, job_id: str, audio_seconds: float) -> _Ticket:
+        job = self._get_job(job_id)
+        ticket = _Ticket(job, audio_seconds)
+        job.waiting.append(ticket)
+        job.max_queue_depth = max(job.max_queue_depth, len(job.waiting))
+        return ticket
+
+    def _ready_in(self, ticket: _Ticket) -> float | None:
+        """轮到该请求时返回还需等待令牌的秒数 (0 表示可以放行)，还没轮到时返回 None。"""
+        if self._next_ticket() is ticket and self._in_flight < self.max_concurrency:
+            return self._time_until_tokens(ticket.cost)
+        return None
+
+    def _grant(self, ticket: _Ticket) -> float:
+        job = ticket.job
+        if self._rpm:
+            self._rpm.consume(1)
+        if self._audio:
+            self._audio.consume(ticket.cost)
+        job.waiting.popleft()
+        self._in_flight += 1
+        self._rr_index = (self._order.index(job.job_id) + 1) % len(self._order)
+
+        waited = time.monotonic() - ticket.enqueued_at
+        job.served += 1
+        job.served_audio_seconds += ticket.cost
+        job.total_wait += waited
+        job.max_wait = max(job.max_wait, waited)
+        self._notify()
+        return waited
+
+    def _notify(self):
+        """唤醒所有等待中的线程与协程，由它们各自重新检查是否轮到自己。"""
+        self._cond.notify_all()
+        waiters, self._async_waiters = self._async_waiters, []
+        for loop, waiter in waiters:
+            loop.call_soon_threadsafe(_wake, waiter)
+
+    def _withdraw(self, ticket: _Ticket):
+        """把还没放行的请求撤出队列 (调用方已持有 self._cond)。"""
+        if ticket in ticket.job.waiting:
+            ticket.job.waiting.remove(ticket)
+            self._drop_if_idle(ticket.job.job_id)
+            self._notify()
+
+    @staticmethod
+    def _timed_out(timeout: float) -> DeadlineExceeded:
+        return DeadlineExceeded(f"在任务时间预算内没有排到 Whisper 请求 (已排队 {timeout:.1f} 秒)，请求已撤回。")
+
+    def acquire(self, job_id: str = DEFAULT_JOB, audio_seconds: float = 0.0, timeout: float | None = None) -> float:
+        """
+        阻塞直到本请求被放行，返回排队等待的秒数。放行后必须调用 release()。
+        timeout (通常是任务剩余的时间预算) 内没有放行时撤回请求并抛出 DeadlineExceeded。
+        """
+        give_up_at = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            ticket = self._enqueue(job_id, audio_seconds)
+            while True:
+                wait = self._ready_in(ticket)
+                if wait is not None and wait <= 0:
+                    return self._grant(ticket)
+                if give_up_at is not None:
+                    left = give_up_at - time.monotonic()
+                    if left <= 0:
+                        self._withdraw(ticket)
+                        raise self._timed_out(timeout)
+                    wait = left if wait is None else min(wait, left)
+                self._cond.wait(wait)
+
+    async def acquire_async(self, job_id: str = DEFAULT_JOB, audio_seconds: float = 0.0,
+                            timeout: float | None = None) -> float:
+        """acquire() 的协程版本：等待期间不占用线程。超时或被取消时从队列中撤回请求。"""
+        import asyncio  # 只有异步引擎需要，不在模块导入时加载
+        loop = asyncio.get_running_loop()
+        give_up_at = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            ticket = self._enqueue(job_id, audio_seconds)
+        try:
+            while True:
+                with self._cond:
+                    wait = self._ready_in(ticket)
+                    if wait is not None and wait <= 0:
+                        return self._grant(ticket)
+                    if give_up_at is not None:
+                        left = give_up_at - time.monotonic()
+                        if left <= 0:
+                            raise self._timed_out(timeout)
+                        wait = left if wait is None else min(wait, left)
+                    waiter = loop.create_future()
+                    self._async_waiters.append((loop, waiter))
+                try:
+                    await asyncio.wait_for(waiter, wait)
+                except asyncio.TimeoutError:
+                    pass
+        except BaseException:
+            with self._cond:
+                self._withdraw(ticket)
+            raise
+
+    def release(self, job_id: str = DEFAULT_JOB):
+        with self._cond:
+            self._in_flight -= 1
+            self._drop_if_idle(job_id)
+            self._notify()
+
+    def _drop_if_idle(self, job_id: str):
+        # 未登记的临时任务 (或已注销的任务) 用完即清理
+        job = self._jobs.get(job_id)
+        if job is not None and not job.registered and not job.waiting and job_id != DEFAULT_JOB:
+            del self._jobs[job_id]
+            self._order.remove(job_id)
+            self._rr_index = self._rr_index % len(self._order) if self._order else 0
+
+    @contextmanager
+    def slot(self, job_id: str = DEFAULT_JOB, audio_seconds: float = 0.0, timeout: float | None = None):
+        """with scheduler.slot(job_id, 秒数) as waited: ... 在放行期间发送一次 Whisper 请求。timeout 同 acquire()。"""
+        waited = self.acquire(job_id, audio_seconds, timeout)
+        try:
+            yield waited
+        finally:
+            self.release(job_id)
+
+    @asynccontextmanager
+    async def slot_async(self, job_id: str = DEFAULT_JOB, audio_seconds: float = 0.0, timeout: float | None = None):
+        """async with scheduler.slot_async(job_id, 秒数) as waited: ... slot() 的协程版本。"""
+        waited = await self.acquire_async(job_id, audio_seconds, timeout)
+        try:
+            yield waited
+        finally:
+            self.release(job_id)
+
+
+def _wake(waiter):
+    if not waiter.done():
+        waiter.set_result(None)
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def _env_float(name: str, default: float | None) -> float | None:
+    value = os.getenv(name)
+    return float(value) if value else default
+
+
+def get_scheduler() -> WhisperScheduler:
+    """返回进程内共享的调度器，首次调用时按环境变量创建。"""
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = WhisperScheduler(
+                requests_per_minute=_env_float("WHISPER_RPM", 50),
+                audio_seconds_per_minute=_env_float("WHISPER_AUDIO_SECONDS_PER_MINUTE", None),
+                max_concurrency=int(_env_float("WHISPER_MAX_CONCURRENCY", 10)),
+                policy=os.getenv("WHISPER_SCHEDULING", "fair"),
+            )
+        return _scheduler
+
+
+def configure_scheduler(**kwargs) -> WhisperScheduler:
+    """用给定参数替换进程内共享的调度器 (参数同 WhisperScheduler)。"""
+    global _scheduler
+    with _scheduler_lock:
+        _scheduler = WhisperScheduler(**kwargs)
+        return _scheduler
+
+
+# 可选的进程级 Whisper 请求限制器，任何同时支持 acquire/release 与 with 语句的对象都可以，
+# 例如批处理 CLI 各工作进程共享的 multiprocessing.Semaphore。
+# 放在调度器模块而不是 transcriber 中，安装限制器时不需要导入 openai。
+_request_limiter = None
+
+
+def set_request_limiter(limiter):
+    """安装 (传 None 则清除) 包在每个 Whisper 请求外层的限制器。"""
+    global _request_limiter
+    _request_limiter = limiter
+
+
+def get_request_limiter():
+    """返回当前安装的限制器，没有时返回 None。"""
+    return _request_limiter
@@ -3,7 +3,8 @@ import subprocess
 import os
 import math
 import concurrent.futures
-from utils import retry # <-- Import the retry decorator
+from utils import retry, retry_async # <-- Import the retry decorator
+from metrics import NULL_METRICS
 
 def get_media_duration(media_path: str) -> float | None:
     """使用 ffprobe 获取媒体文件总时长（秒），适用于视频和音频。"""
@@ -22,9 +23,10 @@ def get_media_duration(media_path: str) -> float | None:
         return None
 
 @retry(max_retries=3, delay=2, allowed_exceptions=(subprocess.CalledProcessError,)) # <-- Apply retry decorator
-def _process_chunk(args) -> str | None:
+def _process_chunk(args, metrics=None) -> str | None:
     """(工作函数) 处理单个音频块的生成。"""
     media_path, output_dir, chunk_duration, i, num_chunks = args
+    metrics = metrics or NULL_METRICS
     start_time = i * chunk_duration
     output_filename = os.path.join(output_dir, f"chunk_{i+1:03d}.mp3")
     
@@ -39,7 +41,9 @@ def _process_chunk(args) -> str | None:
     try:
         print(f"开始生成第 {i+1}/{num_chunks} 个音频块: {output_filename}")
         # Capture stderr and stdout to prevent them from printing directly unless an error occurs
-        subprocess.run(command, check=True, capture_output=True, text=True)
+        with metrics.span("split.chunk", chunk=i + 1):
+            subprocess.run(command, check=True, capture_output=True, text=True)
+        metrics.add("split.bytes_out", os.path.getsize(output_filename))
         print(f"完成生成第 {i+1}/{num_chunks} 个音频块。")
         return output_filename
     except subprocess.CalledProcessError as e:
@@ -51,13 +55,16 @@ def _process_chunk(args) -> str | None:
         # This is a setup error, no point in retrying.
         return None
 
-def split_media_to_audio_chunks_generator(media_path: str, output_dir: str, chunk_duration: int = 600):
+def split_media_to_audio_chunks_generator(media_path: str, output_dir: str, chunk_duration: int = 600, metrics=None):
     """
     (生成器版本) 将媒体文件切分为音频块，并实时产出进度。
-    产出事件: ('progress', 已完成数量, 总数量)
+    产出事件: ('duration', 媒体总时长秒数)
+              ('progress', 已完成数量, 总数量)
               ('result', 输出文件列表)
               ('error', 错误信息)
+    metrics: 可选的 JobMetrics，记录 ffprobe/ffmpeg 的耗时与输入输出字节数。
     """
+    metrics = metrics or NULL_METRICS
     if not os.path.exists(media_path):
         yield 'error', f"错误：媒体文件 '{media_path}' 不存在。", None
         return
@@ -69,7 +76,8 @@ def split_media_to_audio_chunks_generator(media_path: str, output_dir: str, chun
         yield 'error', f"错误：创建输出目录 '{output_dir}' 失败: {e}", None
         return
 
-    duration = get_media_duration(media_path)
+    with metrics.span("probe"):
+        duration = get_media_duration(media_path)
     if not duration:
         yield 'error', "无法获取媒体文件时长。", None
         return
@@ -80,30 +88,162 @@ def split_media_to_audio_chunks_generator(media_path: str, output_dir: str, chun
         return
         
     print(f"媒体总时长: {duration:.2f}秒, 将被切分为 {num_chunks} 个音频块。")
+    metrics.set("media_duration", round(duration, 3))
+    metrics.set("num_chunks", num_chunks)
+    metrics.add("split.bytes_in", os.path.getsize(media_path))
+    yield 'duration', duration
 
     tasks_args = [(media_path, output_dir, chunk_duration, i, num_chunks) for i in range(num_chunks)]
     
     output_files = []
     completed_count = 0
     with concurrent.futures.ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
-        future_to_args = {executor.submit(_process_chunk, args): args for args in tasks_args}
-        for future in concurrent.futures.as_completed(future_to_args):
+        future_to_args = {executor.submit(_process_chunk, args, metrics=metrics): args for args in tasks_args}
+        try:
+            for future in concurrent.futures.as_completed(future_to_args):
+                try:
+                    result = future.result()
+                    if result:
+                        output_files.append(result)
+                except Exception as e:
+                    # If a chunk fails after all retries, the exception is raised here.
+                    yield 'error', f"一个音频块在多次尝试后仍然无法处理，已停止。错误: {e}", None
+                    return
+
+                completed_count += 1
+                yield 'progress', completed_count, num_chunks
+        finally:
+            # Cancel remaining futures on failure, or when the caller closes the generator early
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    if not output_files or len(output_files) != num_chunks:
+        yield 'error', "未能成功生成所有音频块，可能部分块处理失败。", None
+        return
+    
+    yield 'result', sorted(output_files)
+
+
+# --- asyncio 版本 (供 async_pipeline 使用)：ffmpeg/ffprobe 作为 asyncio 子进程运行，不占用工作线程 ---
+# asyncio 在函数内导入：同步流程不需要加载它
+
+async def _run_command_async(command: list[str]) -> str:
+    """运行外部命令并返回 stdout；退出码非 0 时抛出 CalledProcessError (与 subprocess.run(check=True) 一致)。"""
+    import asyncio
+    process = await asyncio.create_subprocess_exec(
+        *command, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
+    )
+    try:
+        stdout, stderr = await process.communicate()
+    except asyncio.CancelledError:
+        process.kill()
+        await process.wait()
+        raise
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, command, stdout.decode(errors="replace"),
+                                            stderr.decode(errors="replace"))
+    return stdout.decode(errors="replace")
+
+async def get_media_duration_async(media_path: str) -> float | None:
+    """get_media_duration 的协程版本。"""
+    command = ['ffprobe', '-v', 'error', '-show_entries', 'format=duration', '-of', 'default=noprint_wrappers=1:nokey=1', media_path]
+    try:
+        return float(await _run_command_async(command))
+    except FileNotFoundError:
+        print("错误：找不到 'ffprobe' 命令。请确保 FFmpeg 已经完全安装，并且其 bin 目录已添加到了系统的 PATH 环境变量中。")
+        return None
+    except subprocess.CalledProcessError as e:
+        print(f"ffprobe 执行失败，可能是文件已损坏或格式不支持: {e.stderr}")
+        return None
+    except Exception as e:
+        print(f"获取媒体时长时发生错误: {e}")
+        return None
+
+@retry_async(max_retries=3, delay=2, allowed_exceptions=(subprocess.CalledProcessError,))
+async def _process_chunk_async(args, metrics=None) -> str | None:
+    """_process_chunk 的协程版本。"""
+    media_path, output_dir, chunk_duration, i, num_chunks = args
+    metrics = metrics or NULL_METRICS
+    output_filename = os.path.join(output_dir, f"chunk_{i+1:03d}.mp3")
+    command = [
+        'ffmpeg', '-i', media_path,
+        '-ss', str(i * chunk_duration),
+        '-t', str(chunk_duration),
+        '-vn', '-acodec', 'libmp3lame',
+        '-q:a', '2', '-y', output_filename
+    ]
+    try:
+        print(f"开始生成第 {i+1}/{num_chunks} 个音频块: {output_filename}")
+        with metrics.span("split.chunk", chunk=i + 1):
+            await _run_command_async(command)
+        metrics.add("split.bytes_out", os.path.getsize(output_filename))
+        print(f"完成生成第 {i+1}/{num_chunks} 个音频块。")
+        return output_filename
+    except subprocess.CalledProcessError as e:
+        print(f"处理第 {i+1} 个音频块时失败: {e.stderr}")
+        raise e
+    except FileNotFoundError:
+        print("错误：找不到 'ffmpeg' 命令。请确保 FFmpeg 已经完全安装，并且其 bin 目录已添加到了系统的 PATH 环境变量中。")
+        return None
+
+async def split_media_to_audio_chunks_async(media_path: str, output_dir: str, chunk_duration: int = 600, metrics=None):
+    """
+    split_media_to_audio_chunks_generator 的异步生成器版本，产出的事件完全相同。
+    同时运行的 ffmpeg 进程数不超过 CPU 核数。
+    """
+    import asyncio
+    metrics = metrics or NULL_METRICS
+    if not os.path.exists(media_path):
+        yield 'error', f"错误：媒体文件 '{media_path}' 不存在。", None
+        return
+
+    try:
+        os.makedirs(output_dir, exist_ok=True)
+    except OSError as e:
+        yield 'error', f"错误：创建输出目录 '{output_dir}' 失败: {e}", None
+        return
+
+    with metrics.span("probe"):
+        duration = await get_media_duration_async(media_path)
+    if not duration:
+        yield 'error', "无法获取媒体文件时长。", None
+        return
+
+    num_chunks = math.ceil(duration / chunk_duration)
+    if num_chunks == 0:
+        yield 'result', []
+        return
+
+    print(f"媒体总时长: {duration:.2f}秒, 将被切分为 {num_chunks} 个音频块。")
+    metrics.set("media_duration", round(duration, 3))
+    metrics.set("num_chunks", num_chunks)
+    metrics.add("split.bytes_in", os.path.getsize(media_path))
+    yield 'duration', duration
+
+    limit = asyncio.Semaphore(os.cpu_count() or 1)
+
+    async def process(args):
+        async with limit:
+            return await _process_chunk_async(args, metrics=metrics)
+
+    tasks = [asyncio.ensure_future(process((media_path, output_dir, chunk_duration, i, num_chunks)))
+             for i in range(num_chunks)]
+    output_files = []
+    try:
+        for completed_count, next_done in enumerate(asyncio.as_completed(tasks), start=1):
             try:
-                result = future.result()
-                if result:
-                    output_files.append(result)
+                result = await next_done
             except Exception as e:
-                # If a chunk fails after all retries, the exception is raised here.
                 yield 'error', f"一个音频块在多次尝试后仍然无法处理，已停止。错误: {e}", None
-                # Cancel remaining futures
-                executor.shutdown(wait=False, cancel_futures=True)
                 return
-
-            completed_count += 1
+            if result:
+                output_files.append(result)
             yield 'progress', completed_count, num_chunks
+    finally:
+        for task in tasks:
+            task.cancel()
 
-    if not output_files or len(output_files) != num_chunks:
+    if len(output_files) != num_chunks:
         yield 'error', "未能成功生成所有音频块，可能部分块处理失败。", None
         return
-    
-    yield 'result', sorted(output_files)
\ No newline at end of file
+
+    yield 'result', sorted(output_files)
@@ -1,25 +1,56 @@
 # transcriber.py
-from openai import OpenAI, APIError, AuthenticationError, APIConnectionError, RateLimitError
+from openai import OpenAI, AsyncOpenAI, AuthenticationError, APIConnectionError, RateLimitError, InternalServerError
 import os
-from utils import retry # <-- Import the retry decorator
+import asyncio
+import weakref
+from contextlib import nullcontext
+from utils import retry, retry_async # <-- Import the retry decorator
+from metrics import NULL_METRICS
+# The request limiter lives in the scheduler so installing it does not import openai;
+# set_request_limiter is re-exported here for existing callers.
+from video_processor.scheduler import DEFAULT_JOB, get_request_limiter, get_scheduler, set_request_limiter  # noqa: F401
 
-# Define which OpenAI errors are worth retrying
-RETRYABLE_EXCEPTIONS = (APIError, APIConnectionError, RateLimitError)
+# Define which OpenAI errors are worth retrying (network errors/timeouts, 429 and 5xx).
+# Other 4xx responses will not go away by retrying.
+RETRYABLE_EXCEPTIONS = (APIConnectionError, RateLimitError, InternalServerError)
 
-@retry(max_retries=3, delay=5, allowed_exceptions=RETRYABLE_EXCEPTIONS) # <-- Apply retry decorator
-def transcribe_single_audio_chunk(audio_path: str, openai_api_key: str) -> str | None:
-    """调用 Whisper API 转录单个音频文件"""
-    client = OpenAI(api_key=openai_api_key) # Initialization is lightweight
+# AsyncOpenAI clients per event loop and API key, see get_async_client
+_async_clients = weakref.WeakKeyDictionary()
+
+@retry(max_retries=4, delay=2, max_delay=30, allowed_exceptions=RETRYABLE_EXCEPTIONS, upstream="whisper") # <-- Apply retry decorator
+def transcribe_single_audio_chunk(audio_path: str, openai_api_key: str, metrics=None, deadline=None,
+                                  job_id: str | None = None, audio_seconds: float | None = None) -> str | None:
+    """
+    调用 Whisper API 转录单个音频文件。
+    metrics 为可选的 JobMetrics，记录每块耗时与字节数；deadline 为可选的任务时间预算 (utils.Deadline)。
+    每次请求 (包括重试) 都先经过进程内共享的 Whisper 调度器排队，job_id 与 audio_seconds
+    用于按任务公平排队和按音频时长限速。
+    """
+    metrics = metrics or NULL_METRICS
+    remaining = deadline.remaining() if deadline is not None else None
+    # 重试统一由 utils.retry 负责 (退避、Retry-After、熔断)，关闭 SDK 自带的重试以免叠加
+    client = OpenAI(
+        api_key=openai_api_key,
+        max_retries=0,
+        timeout=max(1.0, remaining) if remaining is not None else 600.0,
+    ) # Initialization is lightweight
     
     audio_filename = os.path.basename(audio_path)
     print(f"  > 正在转录: {audio_filename}")
     
     try:
-        with open(audio_path, "rb") as audio_file:
-            transcription = client.audio.transcriptions.create(
-              model="whisper-1", 
-              file=audio_file
-            )
+        scheduler = get_scheduler()
+        # 在调度器中排队也计入任务时间预算，超时时撤回请求并抛出 DeadlineExceeded
+        with scheduler.slot(job_id or DEFAULT_JOB, audio_seconds or 0.0, remaining) as waited, \
+                get_request_limiter() or nullcontext(), open(audio_path, "rb") as audio_file:
+            metrics.add("whisper.queue_wait_seconds", round(waited, 4))
+            with metrics.span("transcribe.chunk", chunk=audio_filename):
+                transcription = client.audio.transcriptions.create(
+                  model="whisper-1", 
+                  file=audio_file
+                )
+        metrics.add("whisper.bytes_out", os.path.getsize(audio_path))
+        metrics.add("whisper.bytes_in", len(transcription.text.encode("utf-8")))
         print(f"  > ✅ 文件 '{audio_filename}' 转录成功！")
         return transcription.text
     
@@ -39,4 +70,66 @@ def transcribe_single_audio_chunk(audio_path: str, openai_api_key: str) -> str |
     except Exception as e:
         # For other unexpected errors
         print(f"  > 调用 Whisper API 时发生未知失败: {e}")
-        raise e # Re-raise to be caught by the main process
\ No newline at end of file
+        raise e # Re-raise to be caught by the main process
+
+
+def get_async_client(openai_api_key: str) -> AsyncOpenAI:
+    """
+    Return the AsyncOpenAI client shared by all jobs on the running event loop that use this key.
+    Building a client costs tens of milliseconds of CPU (TLS setup), which would stall the loop
+    if every job made its own; sharing one also keeps connections alive between jobs.
+    SDK retries are disabled because retry_async handles them.
+    """
+    clients = _async_clients.setdefault(asyncio.get_running_loop(), {})
+    if openai_api_key not in clients:
+        clients[openai_api_key] = AsyncOpenAI(api_key=openai_api_key, max_retries=0, timeout=600.0)
+    return clients[openai_api_key]
+
+@retry_async(max_retries=4, delay=2, max_delay=30, allowed_exceptions=RETRYABLE_EXCEPTIONS, upstream="whisper")
+async def transcribe_single_audio_chunk_async(audio_path: str, client: AsyncOpenAI, metrics=None, deadline=None,
+                                              job_id: str | None = None, audio_seconds: float | None = None) -> str | None:
+    """
+    transcribe_single_audio_chunk 的协程版本 (供 async_pipeline 使用)。
+    使用调用方传入的 AsyncOpenAI 客户端 (通常来自 get_async_client)；排队通过共享调度器的 slot_async 完成，等待期间不占用线程。
+    """
+    metrics = metrics or NULL_METRICS
+    remaining = deadline.remaining() if deadline is not None else None
+    if remaining is not None:
+        client = client.with_options(timeout=max(1.0, remaining))
+
+    audio_filename = os.path.basename(audio_path)
+    print(f"  > 正在转录: {audio_filename}")
+
+    try:
+        async with get_scheduler().slot_async(job_id or DEFAULT_JOB, audio_seconds or 0.0, remaining) as waited:
+            metrics.add("whisper.queue_wait_seconds", round(waited, 4))
+            limiter = get_request_limiter()
+            if limiter is not None:
+                # 批处理 CLI 的跨进程信号量只有阻塞接口，在线程中获取
+                await asyncio.to_thread(limiter.acquire)
+            try:
+                with open(audio_path, "rb") as audio_file, metrics.span("transcribe.chunk", chunk=audio_filename):
+                    transcription = await client.audio.transcriptions.create(
+                        model="whisper-1",
+                        file=audio_file
+                    )
+            finally:
+                if limiter is not None:
+                    limiter.release()
+        metrics.add("whisper.bytes_out", os.path.getsize(audio_path))
+        metrics.add("whisper.bytes_in", len(transcription.text.encode("utf-8")))
+        print(f"  > ✅ 文件 '{audio_filename}' 转录成功！")
+        return transcription.text
+
+    except FileNotFoundError:
+        print(f"  > 错误：找不到音频文件: {audio_path}")
+        return None
+    except AuthenticationError as e:
+        print("  > OpenAI API 错误：身份验证失败，请检查您的 OPENAI_API_KEY 是否正确。")
+        raise e
+    except RETRYABLE_EXCEPTIONS as e:
+        print(f"  > 调用 Whisper API 时发生可重试错误: {e}")
+        raise e
+    except Exception as e:
+        print(f"  > 调用 Whisper API 时发生未知失败: {e}")
+        raise e